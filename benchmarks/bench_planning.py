@@ -0,0 +1,207 @@
+"""
+Planning throughput benchmark.
+
+Generates a synthetic template & input tree (see synthetic.py), then
+measures jobs/second for:
+
+- prepare, expand, render, check & save_scripts - in process, the
+  last three with the phase profiler during a dry run
+- `k3 run --dryrun` & `k3 pbs` (writing submit scripts) - end to end,
+  as subprocesses
+
+Results can be saved as a baseline & compared against later:
+
+    python benchmarks/bench_planning.py --files 10000 --save base.json
+    python benchmarks/bench_planning.py --files 10000 --compare base.json
+"""
+
+import argparse
+import contextlib
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+from time import perf_counter
+
+import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+K3 = [sys.executable, '-c',
+      'import sys; sys.argv[0] = "k3"; from kea3.cli import dispatch; '
+      'dispatch()']
+
+PHASES = ('render', 'check', 'save_scripts')
+
+
+def _clean(workdir):
+    # start every repeat without caches, build log & scripts
+    for name in ('k3', 'out', 'run.sh'):
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+
+
+def bench_inprocess(workdir, template) -> dict:
+    """
+    Time the planning phases of one dry run, in process
+    """
+    import leip
+    from kea3.job import K3Job
+    from kea3.profiler import K3Profiler
+
+    app = leip.app(name='kea3')
+    args = argparse.Namespace(template=template, arguments=[], force=False,
+                              dryrun=True, timeout=None)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        job = K3Job(app, args, template, [])
+        job.profiler = K3Profiler()
+        rv = {}
+
+        start = perf_counter()
+        job.prepare()
+        rv['prepare'] = perf_counter() - start
+
+        start = perf_counter()
+        jobs = list(job.expand())
+        rv['expand'] = perf_counter() - start
+
+        with open(os.devnull, 'w') as null, \
+                contextlib.redirect_stdout(null):
+            for newjob in jobs:
+                newjob.run()
+        job.finish()
+    finally:
+        os.chdir(cwd)
+
+    totals = dict((name, total) for cat, name, count, total, longest
+                  in job.profiler.summary() if cat == 'phase')
+    for phase in PHASES:
+        rv[phase] = totals.get(phase, 0.)
+    return rv
+
+
+def bench_cli(workdir, argv) -> float:
+    """
+    Time a k3 invocation
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    start = perf_counter()
+    sp.run(K3 + argv, cwd=workdir, env=env, stdout=sp.DEVNULL,
+           stderr=sp.DEVNULL, check=True)
+    return perf_counter() - start
+
+
+def run_benchmarks(args) -> dict:
+    jobs = args.files * max(args.sweep, 1)
+    times = {}
+
+    def _best(name, seconds):
+        times[name] = min(times.get(name, seconds), seconds)
+
+    with tempfile.TemporaryDirectory(prefix='k3bench') as workdir:
+        template = synthetic.make_benchmark(
+            workdir, args.files, args.subdirs, args.io, args.parameters,
+            args.lines, args.sweep)
+        packed = ['--packed'] if args.packed else []
+
+        for repeat in range(args.repeat):
+            _clean(workdir)
+            for name, seconds in bench_inprocess(workdir, template).items():
+                _best(name, seconds)
+
+            _clean(workdir)
+            _best('k3 run --dryrun', bench_cli(
+                workdir, ['run', '--dryrun'] + packed + [template]))
+
+            _clean(workdir)
+            _best('k3 pbs', bench_cli(
+                workdir, ['pbs', '-A', 'bench', '-W', '1', '-j',
+                          str(args.jobs_per_node)] + packed + [template]))
+
+    return {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'jobs': jobs,
+            'params': dict((k, v) for k, v in vars(args).items()
+                           if k not in ('save', 'compare', 'threshold')),
+        },
+        'results': dict(
+            (name, {'seconds': seconds,
+                    'jobs_per_sec': jobs / seconds if seconds else None})
+            for name, seconds in times.items()),
+    }
+
+
+def report(results, baseline=None, threshold=0.1) -> int:
+    """
+    Print the results - compared to a baseline if given. Returns the no
+    of benchmarks that got slower by more than threshold.
+    """
+    regressions = 0
+    print('%d jobs' % results['meta']['jobs'])
+    print('%-20s %12s %14s %10s' % ('benchmark', 'seconds', 'jobs/s',
+                                    'vs base'))
+    for name, result in results['results'].items():
+        line = '%-20s %12.4f %14.1f' % (name, result['seconds'],
+                                        result['jobs_per_sec'] or 0)
+        base = (baseline or {}).get('results', {}).get(name)
+        if base and base.get('jobs_per_sec') and result['jobs_per_sec']:
+            ratio = result['jobs_per_sec'] / base['jobs_per_sec']
+            line += ' %9.2fx' % ratio
+            if ratio < 1 - threshold:
+                line += ' SLOWER'
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    synthetic.add_arguments(parser)
+    parser.add_argument('--jobs-per-node', type=int, default=16,
+                        help='jobs per pbs batch (default: 16)')
+    parser.add_argument('--packed', action='store_true',
+                        help='run k3 with --packed')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='report the best of N runs (default: 3)')
+    parser.add_argument('--save', help='save the results (json) to this file')
+    parser.add_argument('--compare', help='compare to a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='report a regression if more than this ' +
+                        'fraction slower (default: 0.1)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as F:
+            baseline = json.load(F)
+        if baseline['meta']['params'] != results['meta']['params']:
+            print('warning: baseline was run with other parameters: %s' %
+                  baseline['meta']['params'])
+
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, 'w') as F:
+            json.dump(results, F, indent=2)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Synthetic k3 templates & input trees, for benchmarking.
+
+    python benchmarks/synthetic.py DIR --files 10000 --io 2 --parameters 4
+
+writes DIR/data/... (the input files) and DIR/bench.k3
+"""
+
+import argparse
+import os
+
+TEMPLATE_NAME = 'bench'
+
+
+def make_tree(root, files, subdirs=0) -> str:
+    """
+    Create `files` (empty) input files under root/data, spread over
+    `subdirs` sub directories. Returns the glob pattern matching them.
+    """
+    data = os.path.join(root, 'data')
+    for i in range(files):
+        if subdirs:
+            dirname = os.path.join(data, 'd%04d' % (i % subdirs))
+        else:
+            dirname = data
+        if i < max(subdirs, 1):
+            os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, 'f%07d.txt' % i), 'w'):
+            pass
+    return 'data/{**}.txt' if subdirs else 'data/{*}.txt'
+
+
+def make_template(path, pattern, io=1, parameters=1, lines=10,
+                  sweep=0) -> str:
+    """
+    Write a template with `io` input & output fields, `parameters`
+    parameters and `lines` lines of script. With `sweep`, parameter p0
+    is swept over that many values (multiplying the no of jobs).
+    """
+    out = ['io:']
+    for i in range(io):
+        out += ['  - name: input%d' % i,
+                '    default: "%s"' % (pattern if i == 0 else
+                                       'data/{g}.txt')]
+    for i in range(io):
+        out += ['  - name: output%d' % i,
+                '    default: "out/{g}.o%d"' % i]
+
+    out.append('parameters:')
+    for i in range(parameters):
+        out += ['  - name: p%d' % i]
+        if i == 0 and sweep:
+            out += ['    sweep: true',
+                    '    default: "%s"' % ','.join(
+                        'v%d' % j for j in range(sweep))]
+        else:
+            out += ['    default: "v%d"' % i]
+    if sweep and parameters:
+        out.append('expand: product')
+
+    out += ['cl_args: {}', 'pbs: {}', 'template: |']
+    for i in range(lines):
+        out.append('  echo {{ p%d }} {{ input%d }} > {{ output%d }}' % (
+            i % max(parameters, 1), i % io, i % io) if parameters else
+            '  cat {{ input%d }} > {{ output%d }}' % (i % io, i % io))
+
+    with open(path, 'w') as F:
+        F.write('\n'.join(out) + '\n')
+    return path
+
+
+def make_benchmark(root, files=1000, subdirs=0, io=1, parameters=1,
+                   lines=10, sweep=0) -> str:
+    """
+    Create an input tree & template in root, return the template path
+    """
+    pattern = make_tree(root, files, subdirs)
+    return make_template(os.path.join(root, TEMPLATE_NAME + '.k3'),
+                         pattern, io, parameters, lines, sweep)
+
+
+def add_arguments(parser):
+    parser.add_argument('--files', type=int, default=1000,
+                        help='no of input files (default: 1000)')
+    parser.add_argument('--subdirs', type=int, default=0,
+                        help='spread the files over this many dirs')
+    parser.add_argument('--io', type=int, default=1,
+                        help='no of input (and output) fields')
+    parser.add_argument('--parameters', type=int, default=1,
+                        help='no of parameters')
+    parser.add_argument('--lines', type=int, default=10,
+                        help='no of lines in the template')
+    parser.add_argument('--sweep', type=int, default=0,
+                        help='sweep the first parameter over N values')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('root')
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(make_benchmark(args.root, args.files, args.subdirs, args.io,
+                         args.parameters, args.lines, args.sweep))
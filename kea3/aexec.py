@@ -0,0 +1,142 @@
+"""
+asyncio based job executor.
+
+All jobs run as subprocesses managed by a single asyncio event loop in
+a background thread - no thread per job. stdout & stderr of every job
+go straight to log files next to its scripts, so the output of
+concurrent jobs does not interleave. A job exceeding its timeout is
+killed together with everything it started (its process group).
+
+What happens when a job is done (its callback: recording the state,
+post_run hooks) runs in a worker thread, in order of completion, so it
+does not hold up the event loop.
+"""
+
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import os
+import signal
+import sys
+import threading
+
+lg = logging.getLogger('k3.aexec')
+
+#: seconds between SIGTERM and SIGKILL when a job times out
+KILL_GRACE = 5
+
+
+def _set_child_watcher(loop):
+    """
+    Before python 3.12 the default child watcher starts a thread per
+    subprocess - use pidfds instead, where available
+    """
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open') or \
+            not hasattr(asyncio, 'PidfdChildWatcher'):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return
+    watcher = asyncio.PidfdChildWatcher()
+    watcher.attach_loop(loop)
+    asyncio.set_child_watcher(watcher)
+
+
+class K3AsyncExecutor:
+    def __init__(self, scheduler=None):
+        """
+        :param scheduler: K3Scheduler - limits what runs concurrently
+        """
+        self.scheduler = scheduler
+        self.pending = 0
+        self._cond = threading.Condition()
+        self.loop = asyncio.new_event_loop()
+        _set_child_watcher(self.loop)
+        self._completions = ThreadPoolExecutor(max_workers=1)
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def _kill(self, proc, sig):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    async def _run(self, cl, stdout, stderr, timeout):
+        # the child keeps its own copy of the log file descriptors
+        with open(stdout, 'wb') as out, open(stderr, 'wb') as err:
+            proc = await asyncio.create_subprocess_exec(
+                '/bin/sh', '-c', cl, stdin=asyncio.subprocess.DEVNULL,
+                stdout=out, stderr=err, start_new_session=True)
+        try:
+            return await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            lg.warning("job timed out after %ss, killing: %s", timeout, cl)
+            self._kill(proc, signal.SIGTERM)
+            try:
+                return await asyncio.wait_for(proc.wait(), KILL_GRACE)
+            except asyncio.TimeoutError:
+                self._kill(proc, signal.SIGKILL)
+                return await proc.wait()
+
+    def submit(self, cl, stdout, stderr, timeout=None, demand=None,
+               callback=None) -> Future:
+        """
+        Start a command line - blocks while the scheduler is full.
+
+        :param cl: command line (run with /bin/sh)
+        :param stdout: log file for stdout
+        :param stderr: log file for stderr
+        :param timeout: seconds after which the job is killed
+        :param demand: resources this job needs (see K3Scheduler)
+        :param callback: called with the return code when done
+        """
+        reserved = None
+        if self.scheduler is not None:
+            reserved = self.scheduler.acquire(demand or {})
+
+        with self._cond:
+            self.pending += 1
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(cl, stdout, stderr, timeout), self.loop)
+
+        def _finish(f):
+            try:
+                rc = f.result()
+            except Exception:
+                lg.exception("failed to run: %s", cl)
+                rc = -1
+            try:
+                if callback is not None:
+                    callback(rc)
+            except Exception:
+                lg.exception("error handling the end of: %s", cl)
+            finally:
+                if reserved is not None:
+                    self.scheduler.release(reserved)
+                with self._cond:
+                    self.pending -= 1
+                    self._cond.notify_all()
+
+        # called in the event loop thread - hand off
+        future.add_done_callback(
+            lambda f: self._completions.submit(_finish, f))
+        return future
+
+    def join(self):
+        """
+        Wait for all submitted jobs to finish
+        """
+        with self._cond:
+            while self.pending > 0:
+                self._cond.wait()
+
+    def close(self):
+        self.join()
+        self._completions.shutdown()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
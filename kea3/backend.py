@@ -0,0 +1,363 @@
+"""
+Cluster backends.
+
+A backend renders a batch of job command lines into a submit script,
+submits it and reports the status of submitted jobs. Available
+backends:
+
+- pbs: Torque/PBS, through qsub & qstat
+- emulate: a local stand-in for qsub/qstat, running the submitted
+  scripts on this machine with N slots - to test and benchmark
+  submission without a cluster
+"""
+
+import logging
+import os
+import queue
+import re
+import subprocess as sp
+import threading
+import time
+
+lg = logging.getLogger('k3.backend')
+
+PBS_SUBMIT_SCRIPT_HEADER = """
+#PBS -N {{ job_id }}
+#PBS -S /bin/bash
+#PBS -e {{ pbs_dir }}/{{ job_id }}.$PBS_JOBID.err
+#PBS -o {{ pbs_dir }}/{{ job_id }}.$PBS_JOBID.out
+#PBS -l walltime={{ pbs.walltime }}:00:00{% if pbs_array %}
+#PBS {{ pbs.get('array_flag', '-t') }} {{ pbs_array }}{% endif %}
+#PBS -A {{ pbs.group }}{% if pbs.nodes %}
+#PBS -l nodes={{pbs.nodes}}
+    {%- if pbs.ppn %}:ppn={{pbs.ppn}}{% endif %}{% endif %}{%if pbs.mem %}
+#PBS -l mem={{ pbs.mem }}{% endif %}
+
+### this script is autogenerated by k3
+
+### Display the job context
+echo Running on host `hostname`
+echo Time is `date`
+echo Directory is `pwd`
+echo Using ${NPROCS} processors across ${NNODES} nodes
+
+set -v  # verbose output
+set -e  # catch errors
+
+{% if pyenv %}
+#load python virtual environment
+source {{ pyenv }}/bin/activate
+{% endif %}
+
+# make sure we're in the work directory
+cd {{ cwd }}
+
+## Starting jobs ({{ pbs.get('jobs_per_node', 1) }} per node)
+
+""".lstrip()
+
+# node side worker pool: starts the next job as soon as enough cores are
+# free, keeping at most <slots> cores busy (needs bash >= 4.3, wait -n)
+NODE_POOL = r"""
+k3_pool() {
+    local slots=$1 used=0 spec cores pid
+    local -A k3_cores
+    shift
+    set +e
+    for spec in "$@"; do
+        cores=${spec%%:*}
+        (( cores > slots )) && cores=$slots
+        while (( used + cores > slots )); do
+            wait -n
+            for pid in "${!k3_cores[@]}"; do
+                if ! kill -0 $pid 2>/dev/null; then
+                    used=$(( used - k3_cores[$pid] ))
+                    unset "k3_cores[$pid]"
+                fi
+            done
+        done
+        # errexit as in the header of the script
+        ( set -e; ${spec#*:} ) &
+        k3_cores[$!]=$cores
+        used=$(( used + cores ))
+    done
+    wait
+}
+""".lstrip()
+
+
+def pool_batch(jobs, slots) -> str:
+    """
+    Return a script body running a batch of jobs with a worker pool
+
+    :param jobs: list of (cores, command line list) tuples - cores as
+                 parsed by K3Job.resources
+    :param slots: no of cores the pool may keep busy
+    """
+    script = ''
+    specs = []
+    for i, (cores, cl) in enumerate(jobs):
+        script += 'k3_job_%d() {\n    ' % i
+        script += '\n    '.join(cl)
+        script += '\n}\n\n'
+        specs.append('%d:k3_job_%d' % (cores, i))
+
+    script += NODE_POOL + '\n'
+    script += 'k3_pool %d \\\n    ' % slots
+    script += ' \\\n    '.join(specs)
+    script += '\n\n'
+    return script
+
+
+class K3Backend:
+    """
+    Base class for cluster backends
+    """
+
+    name = None
+
+    #: template with the header of a submit script
+    header = None
+
+    #: submit, even if not asked to (i.e. without k3 pbs -q)
+    always_submit = False
+
+    def render_batch(self, renderer, ctx, body) -> str:
+        """
+        Return a submit script: the rendered header plus the body
+        running the batch of jobs
+        """
+        renderer.register('batch_header', self.header)
+        return renderer.render('batch_header', ctx) + body
+
+    def submit(self, script, depend=None) -> str:
+        """
+        Submit a script, return the job id
+
+        :param depend: ids of jobs that have to finish successfully
+            before this one starts
+        """
+        raise NotImplementedError()
+
+    def status(self, jobids) -> dict:
+        """
+        Return the state of jobs: Q(ueued), R(unning) or C(ompleted)
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PbsBackend(K3Backend):
+    name = 'pbs'
+    header = PBS_SUBMIT_SCRIPT_HEADER
+
+    def submit(self, script, depend=None) -> str:
+        cl = ['qsub']
+        if depend:
+            cl.extend(['-W', 'depend=afterok:%s' % ':'.join(depend)])
+        out = sp.check_output(cl + [str(script)])
+        jobid = out.decode().strip()
+        lg.debug("submitted %s: %s", script, jobid)
+        return jobid
+
+    def status(self, jobids) -> dict:
+        # jobs unknown to qstat have finished
+        rv = dict((j, 'C') for j in jobids)
+        out = sp.run(['qstat'] + list(jobids), stdout=sp.PIPE,
+                     stderr=sp.DEVNULL).stdout.decode()
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) >= 6 and fields[0] in rv:
+                rv[fields[0]] = fields[4]
+        return rv
+
+
+class _EmulatedJob:
+    __slots__ = ('jobid', 'script', 'env', 'out', 'err', 'depend', 'state',
+                 'rc', 'submitted', 'started', 'ended')
+
+    def __init__(self, jobid, script, env, out, err, depend=None):
+        self.jobid = jobid
+        self.script = script
+        self.env = env
+        self.out = out
+        self.err = err
+        self.depend = depend or []
+        self.state = 'Q'
+        self.rc = None
+        self.submitted = time.time()
+        self.started = None
+        self.ended = None
+
+
+class PbsEmulatorBackend(PbsBackend):
+    """
+    Local stand-in for qsub/qstat: submitted scripts are queued and run
+    on this machine, with at most `slots` running at the same time.
+    Array jobs (#PBS -t / -J) are expanded in their elements. A job
+    with dependencies (afterok) waits for them, and does not run if one
+    failed.
+    """
+    name = 'emulate'
+    always_submit = True
+
+    def __init__(self, slots=None):
+        self.slots = slots or os.cpu_count() or 1
+        self.jobs = {}
+        self.submit_times = []
+        self._queue = queue.Queue()
+        self._counter = 0
+        self._lock = threading.Lock()
+        # notified when a job is done
+        self._done = threading.Condition(self._lock)
+        self._workers = [threading.Thread(target=self._worker, daemon=True)
+                         for _ in range(self.slots)]
+        for w in self._workers:
+            w.start()
+
+    def _directives(self, script):
+        rv = {}
+        with open(script) as F:
+            for line in F:
+                m = re.match(r'#PBS\s+(-\w)\s+(.*)$', line.strip())
+                if m:
+                    rv[m.group(1)] = m.group(2)
+        return rv
+
+    def submit(self, script, depend=None) -> str:
+        start = time.time()
+        directives = self._directives(script)
+        with self._lock:
+            self._counter += 1
+            no = self._counter
+        jobid = '%d.emulator' % no
+
+        array = directives.get('-t') or directives.get('-J')
+        if array:
+            first, _, last = array.partition('-')
+            elements = [('%d.emulator[%d]' % (no, i),
+                         {'PBS_ARRAYID': str(i), 'PBS_ARRAY_INDEX': str(i)})
+                        for i in range(int(first), int(last or first) + 1)]
+        else:
+            elements = [(jobid, {})]
+
+        for eid, extra_env in elements:
+            env = dict(os.environ, PBS_JOBID=eid,
+                       PBS_O_WORKDIR=os.getcwd(), **extra_env)
+            out = directives.get('-o', '%s.out' % script)\
+                .replace('$PBS_JOBID', eid)
+            err = directives.get('-e', '%s.err' % script)\
+                .replace('$PBS_JOBID', eid)
+            ejob = _EmulatedJob(eid, str(script), env, out, err, depend)
+            with self._lock:
+                self.jobs[eid] = ejob
+            self._queue.put(ejob)
+
+        self.submit_times.append(time.time() - start)
+        lg.debug("emulator: queued %s as %s (%d element(s))", script,
+                 jobid, len(elements))
+        return jobid
+
+    def _worker(self):
+        while True:
+            ejob = self._queue.get()
+            if self._wait_for(ejob.depend):
+                ejob.state = 'R'
+                ejob.started = time.time()
+                with open(ejob.out, 'wb') as out, \
+                        open(ejob.err, 'wb') as err:
+                    ejob.rc = sp.call(['/bin/bash', ejob.script],
+                                      env=ejob.env, stdout=out, stderr=err)
+            else:
+                lg.warning("emulator: %s not run, a dependency failed",
+                           ejob.jobid)
+                ejob.started = time.time()
+                ejob.rc = -1
+            ejob.ended = time.time()
+            with self._done:
+                ejob.state = 'C'
+                self._done.notify_all()
+            self._queue.task_done()
+
+    def _wait_for(self, depend) -> bool:
+        """
+        Block until the jobs in depend are done - True if all succeeded.
+        Jobs are queued after their dependencies, so these are running
+        or done already.
+        """
+        if not depend:
+            return True
+        with self._done:
+            while True:
+                jobs = [j for jobid in depend for j in self._elements(jobid)]
+                if all(j.state == 'C' for j in jobs):
+                    return all(j.rc == 0 for j in jobs)
+                self._done.wait()
+
+    def _elements(self, jobid):
+        # a job, or all elements of an array job
+        prefix = jobid.split('.')[0] + '.'
+        return [j for j in self.jobs.values() if j.jobid.startswith(prefix)]
+
+    def status(self, jobids) -> dict:
+        rv = {}
+        with self._lock:
+            for jobid in jobids:
+                states = set(j.state for j in self._elements(jobid))
+                if 'R' in states:
+                    rv[jobid] = 'R'
+                elif 'Q' in states:
+                    rv[jobid] = 'Q'
+                else:
+                    rv[jobid] = 'C'
+        return rv
+
+    def stats(self) -> dict:
+        """
+        Submission latency & packing efficiency of the finished jobs
+        """
+        done = [j for j in self.jobs.values() if j.ended is not None]
+        if not done:
+            return {}
+        makespan = max(j.ended for j in done) - \
+            min(j.submitted for j in done)
+        busy = sum(j.ended - j.started for j in done)
+        return {
+            'jobs': len(done),
+            'failed': sum(1 for j in done if j.rc != 0),
+            'submit_latency': sum(self.submit_times) /
+            len(self.submit_times),
+            'queue_wait': sum(j.started - j.submitted for j in done) /
+            len(done),
+            'makespan': makespan,
+            'efficiency': busy / (self.slots * makespan) if makespan else 1,
+        }
+
+    def close(self):
+        """
+        Wait for all queued jobs and report
+        """
+        self._queue.join()
+        stats = self.stats()
+        if stats:
+            print(('emulator: %(jobs)d jobs (%(failed)d failed), ' +
+                   'submit latency %(submit_latency).4fs, ' +
+                   'mean queue wait %(queue_wait).2fs, ' +
+                   'makespan %(makespan).2fs, ' +
+                   'slot efficiency %(efficiency).1f%%') %
+                  dict(stats, efficiency=100 * stats['efficiency']))
+
+
+BACKENDS = {
+    'pbs': PbsBackend,
+    'emulate': PbsEmulatorBackend,
+}
+
+
+def get_backend(name, **kwargs) -> K3Backend:
+    if name not in BACKENDS:
+        raise ValueError('unknown backend: %s (choose from %s)' %
+                         (name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name](**kwargs)
@@ -0,0 +1,102 @@
+"""
+Persistent record of job signatures, used to decide if a job is up to
+date.
+
+Modelled after the ninja build log: an append-only text file with one
+`key<TAB>signature` line per recorded job, which is read into a dict
+once. Later lines override earlier ones, the file is compacted when
+it contains too many stale lines.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+
+lg = logging.getLogger('k3.builddb')
+
+HEADER = '# k3 build log v1\n'
+
+
+def signature(*parts) -> str:
+    """
+    Hash the string representation of all parts
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode('utf-8', 'surrogateescape'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class K3BuildDB:
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self._lock = threading.Lock()
+        self._no_lines = 0
+        self._fh = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as F:
+            if F.readline() != HEADER:
+                lg.warning("ignoring build log with unknown format: %s",
+                           self.path)
+                return
+            for line in F:
+                key, _, sig = line.rstrip('\n').partition('\t')
+                if not sig:
+                    # possibly a truncated line from a crashed run
+                    continue
+                self.index[key] = sig
+                self._no_lines += 1
+        lg.debug("loaded %d signatures from %s", len(self.index),
+                 self.path)
+
+    def get(self, key):
+        return self.index.get(key)
+
+    def record(self, key, sig):
+        with self._lock:
+            if self.index.get(key) == sig:
+                return
+            self.index[key] = sig
+            if self._fh is None:
+                new = not os.path.exists(self.path) or \
+                    os.path.getsize(self.path) == 0
+                torn = False
+                if not new:
+                    with open(self.path, 'rb') as F:
+                        F.seek(-1, os.SEEK_END)
+                        torn = F.read(1) != b'\n'
+                self._fh = open(self.path, 'a')
+                if new:
+                    self._fh.write(HEADER)
+                elif torn:
+                    # do not append to a torn line
+                    self._fh.write('\n')
+            self._fh.write('%s\t%s\n' % (key, sig))
+            # flush - so a crash loses no finished jobs
+            self._fh.flush()
+            self._no_lines += 1
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            if self._no_lines > 2 * len(self.index) + 1000:
+                self._compact()
+
+    def _compact(self):
+        lg.debug("compacting build log %s", self.path)
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as F:
+            F.write(HEADER)
+            for key, sig in self.index.items():
+                F.write('%s\t%s\n' % (key, sig))
+        os.replace(tmp, self.path)
+        self._no_lines = len(self.index)
@@ -3,6 +3,20 @@ import sys
 
 import leip
 
+app = None
+
+
+def get_app():
+    """
+    Return the Kea3 app - created on first use, so importing this
+    module is cheap
+    """
+    global app
+    if app is None:
+        app = leip.app(name='kea3')
+        app.discover(globals())
+    return app
+
 
 def dispatch():
     """
@@ -17,8 +31,4 @@ def dispatch():
     #     if command not in k3commands:
     #         sys.argv = sys.argv[:1] + ['run'] + sys.argv[1:]
             
-    app.run()
-
-
-app = leip.app(name='kea3')
-app.discover(globals())
+    get_app().run()
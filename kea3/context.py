@@ -0,0 +1,126 @@
+"""
+Layered job context.
+
+Every expanded job gets a K3Context: a small overlay on top of a
+read-only snapshot of the context of the parent job. Values set by a
+job only end up in its own overlay, so per-job memory is proportional
+to what differs from the parent. Mutable values (lists, dicts, sets)
+are copied into the overlay on first access, so a job modifying e.g.
+ctx['prolog'] never affects other jobs - even when they run
+concurrently.
+
+Expensive values can be added as Lazy(function): the function is called
+with the job context when the value is first accessed, and the result
+is stored in the overlay of that job. Jobs that never use the value
+never compute it.
+"""
+
+from collections import ChainMap
+from collections.abc import MutableMapping
+import copy
+from types import MappingProxyType
+
+MUTABLE = (list, dict, set)
+
+
+class Lazy:
+    """
+    A context value computed on first access: function(ctx) -> value
+    """
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+    def __repr__(self):
+        return 'Lazy(%r)' % self.function
+
+
+class _View(ChainMap):
+    """
+    Read-only view on the layers of a context, evaluating lazy values
+    on access
+    """
+    def __init__(self, ctx):
+        super().__init__(ctx._local, ctx._parent)
+        self.ctx = ctx
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if isinstance(value, Lazy):
+            value = self.ctx[key]
+        return value
+
+
+class K3Context(MutableMapping):
+    __slots__ = ('_parent', '_local')
+
+    def __init__(self, parent=None, local=None):
+        self._parent = MappingProxyType({}) if parent is None else parent
+        self._local = {} if local is None else local
+
+    def __getitem__(self, key):
+        try:
+            value = self._local[key]
+        except KeyError:
+            value = self._parent[key]
+            if isinstance(value, MUTABLE):
+                # copy on first access - the job might modify it
+                value = copy.copy(value)
+                self._local[key] = value
+        if isinstance(value, Lazy):
+            value = self._local[key] = value.function(self)
+        return value
+
+    def __setitem__(self, key, value):
+        self._local[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._local and key in self._parent:
+            raise TypeError('cannot delete inherited context key: %s' %
+                            key)
+        del self._local[key]
+
+    def __contains__(self, key):
+        return key in self._local or key in self._parent
+
+    def __iter__(self):
+        yield from self._local
+        for key in self._parent:
+            if key not in self._local:
+                yield key
+
+    def __len__(self):
+        return len(self._local) + \
+            sum(1 for k in self._parent if k not in self._local)
+
+    def __repr__(self):
+        return 'K3Context(%r)' % dict(self.layers())
+
+    def layers(self):
+        """
+        Read-only view on all values as they are - lazy values are not
+        evaluated
+        """
+        return ChainMap(self._local, self._parent)
+
+    def view(self):
+        """
+        Read-only view on all values - without copying mutable values
+        (e.g. to render templates). Lazy values are evaluated when
+        looked up.
+        """
+        return _View(self)
+
+    def freeze(self):
+        """
+        Return a read-only snapshot, to be used as parent of the job
+        contexts
+        """
+        return MappingProxyType(dict(self.layers()))
+
+    def child(self):
+        """
+        Return a new context on top of a snapshot of this one
+        """
+        return K3Context(self.freeze())
@@ -0,0 +1,141 @@
+"""
+Lazy combination of expansion dimensions.
+
+A dimension is an iterable of (values, matches) tuples: `values` maps
+field names to their value for one job, `matches` maps glob field names
+to the part of the path matched by the wildcard. Dimensions are zipped
+within a group, groups are combined as a cartesian product. Nothing is
+materialized except the items of the inner product groups, which need
+to be replayed, and zipped dimensions, which are checked for equal
+length before the first job is generated.
+"""
+
+import logging
+
+lg = logging.getLogger('k3.expansion')
+
+
+class Replay:
+    """
+    Iterate an iterable once, replay the cached items afterwards
+    """
+    def __init__(self, iterable):
+        self._it = iter(iterable)
+        self._cache = []
+        self._done = False
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i < len(self._cache):
+                yield self._cache[i]
+            elif self._done:
+                return
+            else:
+                try:
+                    item = next(self._it)
+                except StopIteration:
+                    self._done = True
+                    return
+                self._cache.append(item)
+                yield item
+            i += 1
+
+
+def _merge(items):
+    values, matches = {}, {}
+    for v, m in items:
+        values.update(v)
+        matches.update(m)
+    return values, matches
+
+
+def strict_zip(*dimensions, names=None):
+    """
+    Zip dimensions, raise a ValueError if they differ in length
+    """
+    iterators = [iter(d) for d in dimensions]
+    sentinel = object()
+    while True:
+        items = [next(it, sentinel) for it in iterators]
+        done = [item is sentinel for item in items]
+        if all(done):
+            return
+        if any(done):
+            raise ValueError(
+                'cannot zip expanded fields of different length: %s' %
+                ', '.join(names or []))
+        yield _merge(items)
+
+
+def lazy_product(*dimensions):
+    """
+    Cartesian product - the first dimension is streamed, the others
+    are cached while they are iterated the first time
+    """
+    if not dimensions:
+        yield {}, {}
+        return
+    first, rest = dimensions[0], [Replay(d) for d in dimensions[1:]]
+
+    def _product(prefix, rest):
+        if not rest:
+            yield _merge(prefix)
+            return
+        for item in rest[0]:
+            yield from _product(prefix + [item], rest[1:])
+
+    for item in first:
+        yield from _product([item], rest)
+
+
+def parse_groups(spec, names) -> list:
+    """
+    Parse the `expand` field of a template into groups of dimension
+    names. Dimensions within a group are zipped, groups are combined
+    in a product.
+
+    - `zip` (default): one group with all dimensions
+    - `product`: every dimension is a group
+    - a list of names or lists of names, e.g. [[in1, in2], k]
+    """
+    if spec is None or spec == 'zip':
+        return [list(names)] if names else []
+    if spec == 'product':
+        return [[n] for n in names]
+    if not isinstance(spec, list):
+        raise ValueError('invalid expand specification: %s' % spec)
+
+    groups = [[g] if isinstance(g, str) else list(g) for g in spec]
+    listed = [n for g in groups for n in g]
+    unknown = sorted(set(listed) - set(names))
+    if unknown:
+        raise ValueError('expand: unknown field(s): %s' % ', '.join(unknown))
+    unlisted = [n for n in names if n not in listed]
+    if unlisted:
+        raise ValueError('expand: field(s) not listed: %s' %
+                         ', '.join(unlisted))
+    return groups
+
+
+def combine(groups, dimensions):
+    """
+    Lazily generate all combinations.
+
+    :param groups: list of lists of dimension names (see parse_groups)
+    :param dimensions: dict name -> iterable of (values, matches)
+    :raises ValueError: if zipped dimensions differ in length
+    """
+    zipped = []
+    for group in groups:
+        group_dims = [dimensions[n] for n in group]
+        if len(group_dims) > 1:
+            # refuse a mismatch before any job runs
+            group_dims = [list(d) for d in group_dims]
+            if len(set(len(d) for d in group_dims)) > 1:
+                raise ValueError(
+                    'cannot zip expanded fields of different length: %s' %
+                    ', '.join('%s (%d)' % (n, len(d))
+                              for n, d in zip(group, group_dims)))
+        zipped.append(strict_zip(*group_dims, names=group))
+    return lazy_product(*zipped)
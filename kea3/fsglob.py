@@ -0,0 +1,174 @@
+"""
+Streaming expansion of k3 glob patterns.
+
+A k3 glob pattern contains one `{*}` or `{**}` wildcard. `{*}` matches
+within a single path component, `{**}` matches across directories. The
+part of the path matched by the wildcard is returned with every match,
+it is used to fill `{g}` in the other fields.
+
+Directories are read with os.scandir, one directory at a time and
+sorted per directory, so matches are yielded as soon as they are found,
+in a deterministic order.
+"""
+
+import fnmatch
+import logging
+import os
+import re
+
+lg = logging.getLogger('k3.glob')
+
+WILDCARD = '{*}'
+RECURSIVE_WILDCARD = '{**}'
+
+_magic = re.compile(r'[*?[]|\{\*\*?\}')
+
+
+def is_glob(pattern) -> bool:
+    return isinstance(pattern, str) and \
+        (WILDCARD in pattern or RECURSIVE_WILDCARD in pattern)
+
+
+def _has_magic(part):
+    return _magic.search(part) is not None
+
+
+def _translate(part, recursive=False):
+    """
+    Translate one (or, if recursive, more) pattern components into a
+    compiled regex. The k3 wildcard becomes the first capture group.
+    """
+    marker = RECURSIVE_WILDCARD if recursive else WILDCARD
+    rx = []
+    for i, chunk in enumerate(part.split(marker)):
+        if i > 0:
+            rx.append('(.*)' if recursive else '([^/]*)')
+        if chunk:
+            # strip the \Z (and flags) fnmatch adds to the translation
+            trans = fnmatch.translate(chunk)
+            trans = re.sub(r'^\(\?s:(.*)\)\\Z$', r'\1', trans)
+            trans = re.sub(r'\\Z(\(\?ms\))?$', '', trans)
+            rx.append(trans)
+    return re.compile(''.join(rx) + r'\Z', re.S)
+
+
+def _scandir(dirname):
+    """
+    Return the sorted entries of a directory (empty if unreadable)
+    """
+    try:
+        with os.scandir(dirname or '.') as it:
+            entries = list(it)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+
+def _join(dirname, name):
+    if not dirname:
+        return name
+    if dirname.endswith('/'):
+        return dirname + name
+    return dirname + '/' + name
+
+
+def _walk(dirname, regex, prefix, show_hidden, ancestors=frozenset()):
+    """
+    Recursively walk `dirname`, yield (path, match) for all entries
+    whose path relative to the walk start matches `regex`. Symlinked
+    directories are followed, unless they point to a directory the
+    walk is in already (a loop).
+    """
+    try:
+        st = os.stat(dirname or '.')
+    except OSError:
+        return
+    key = (st.st_dev, st.st_ino)
+    if key in ancestors:
+        return
+    ancestors = ancestors | {key}
+
+    for entry in _scandir(dirname):
+        if not show_hidden and entry.name.startswith('.'):
+            continue
+        relpath = prefix + entry.name
+        path = _join(dirname, entry.name)
+        m = regex.match(relpath)
+        if m:
+            yield path, m.group(1)
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            yield from _walk(path, regex, relpath + '/', show_hidden,
+                             ancestors)
+
+
+def _iglob(dirname, parts, repl):
+    part, rest = parts[0], parts[1:]
+
+    if RECURSIVE_WILDCARD in part:
+        regex = _translate('/'.join(parts), recursive=True)
+        yield from _walk(dirname, regex, '', part.startswith('.'))
+        return
+
+    if not _has_magic(part):
+        path = _join(dirname, part)
+        if rest:
+            if os.path.isdir(path):
+                yield from _iglob(path, rest, repl)
+        elif os.path.lexists(path):
+            yield path, repl
+        return
+
+    regex = _translate(part)
+    show_hidden = part.startswith('.')
+    for entry in _scandir(dirname):
+        if not show_hidden and entry.name.startswith('.'):
+            continue
+        m = regex.match(entry.name)
+        if not m:
+            continue
+        path = _join(dirname, entry.name)
+        this_repl = m.group(1) if WILDCARD in part else repl
+        if not rest:
+            yield path, this_repl
+            continue
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            yield from _iglob(path, rest, this_repl)
+
+
+def iglob(pattern):
+    """
+    Lazily expand a k3 glob pattern.
+
+    :param pattern: path pattern with one `{*}` or `{**}` wildcard,
+                    other glob wildcards (`*`, `?`, `[...]`) are allowed
+    :returns: generator of (path, match) tuples, `match` being the part
+              of the path matched by the k3 wildcard
+    """
+    if not is_glob(pattern):
+        raise ValueError('not a k3 glob pattern: %s' % pattern)
+
+    if pattern.count(WILDCARD) + pattern.count(RECURSIVE_WILDCARD) > 1:
+        raise ValueError('only one {*} or {**} allowed: %s' % pattern)
+
+    parts = pattern.split('/')
+    dirname = ''
+    if parts[0] == '':
+        # absolute path
+        dirname = '/'
+        parts = parts[1:]
+    while len(parts) > 1 and not _has_magic(parts[0]):
+        dirname = _join(dirname, parts[0])
+        parts = parts[1:]
+
+    lg.debug('streaming glob of %s in %s', '/'.join(parts),
+             dirname or '.')
+    yield from _iglob(dirname, parts, None)
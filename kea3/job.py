@@ -2,21 +2,57 @@ import argparse
 
 import copy
 from datetime import datetime
-import glob
+import json
 import logging
+import os
 import re
 import subprocess as sp
-import uuid
+import sys
+import threading
+import time
 
-import fantail
-import fantail.util
-import jinja2
 from path import Path
 
+from kea3 import expansion, fsglob, yamlcache
+from kea3.builddb import K3BuildDB, signature
+from kea3.context import K3Context
+from kea3.pack import K3ScriptPack
+from kea3.profiler import NO_PROFILER
+from kea3.scratch import K3Scratch
+from kea3.statcache import K3StatCache
+from kea3.resolve import K3ResolveError, is_template, resolve
+from kea3.scheduler import parse_cores
+
 lg = logging.getLogger('k3.job')
 
 TEMPLATE = None
 
+#: expanded jobs are handled in chunks, growing from MIN to MAX size
+MIN_CHUNK_SIZE = 16
+MAX_CHUNK_SIZE = 1024
+
+#: default no of inputs (or partial outputs) per job in tree-reduce mode
+FAN_IN = 16
+
+
+def _yaml_load(path):
+    import fantail
+    return fantail.yaml_file_loader(path)
+
+
+def _yaml_save(data, path):
+    import fantail
+    fantail.yaml_file_save(data, path)
+
+
+def get_stamp() -> str:
+    """
+    Return a time stamp to name scripts (UTC, second resolution)
+    """
+    stamp = datetime.utcnow()
+    stamp = stamp.replace(microsecond=0)
+    return datetime.isoformat(stamp).replace(':', '').replace('-', '')
+
 
 class K3Job:
     def __init__(self, app, args, template='.', argv=[], transient=False):
@@ -32,14 +68,58 @@ class K3Job:
         self.template = template
         self._template_file = None
         # the context will be used for parameter expaions
-        self.ctx = fantail.Fantail()
+        self.ctx = K3Context()
+        # template renderer - shared with all expanded jobs
+        self.renderer = None
+        # signatures of earlier runs
+        self.builddb = None
+        # jobs completed in earlier runs, keyed by their expanded values
+        self.stemdb = None
+        self.plan_signature = None
+        self.stem = None
+        self.no_unchanged = 0
+        # file metadata - prefetched per chunk of expanded jobs
+        self.stats = K3StatCache()
+        # asyncio executor - if None jobs run synchronously
+        self.aexec = None
+        # script pack - if None every job gets its own scripts
+        self.pack = None
+        # state of all jobs of this invocation - None if not recorded
+        self.runstate = None
+        # times phases & hooks (see --profile)
+        self.profiler = NO_PROFILER
+        # jobs that ran, waiting for the post_run_batch hook - shared
+        # with all expanded jobs
+        self.post_run_queue = []
+        self._batch_lock = threading.Lock()
+        # variables the templates refer to - see find_references()
+        self.referenced = None
+        # fields to expand
+        self.glob_fields = []
+        self.sweep_fields = []
+        self.expand_groups = []
+        # workspace of a transient run - shared with all expanded jobs
+        self.scratch = None
+        # renderer template with the script of this job - combine jobs
+        # of a tree-reduce use the `combine` template
+        self.script_template = 'template'
+        # jobs this job needs the output of (tree-reduce)
+        self.depends_on = []
+        # waits until all jobs handed out so far are done - between the
+        # levels of a tree-reduce. None if they run synchronously.
+        self.barrier = None
+        # return code, once the job ran
+        self.rc = None
+        # rendered, ready for the pre_run hook - see prepare_run()
+        self.prepared = False
+        self.prepare_error = None
 
     @property
     def workdir(self):
         if self.transient:
-            wd = Path("~/.k3/%s" % uuid.uuid4())
-            wd.makedirs_p()
-            return wd
+            if self.scratch is None:
+                self.scratch = K3Scratch.from_conf(self.app.conf).allocate()
+            return self.scratch
         else:
             wd = Path('./k3') / self.name
             wd.makedirs_p()
@@ -59,10 +139,66 @@ class K3Job:
         return self.workdir / 'arguments.k3'
 
     def prepare(self):
-        self.get_template()
-        self.load_template()
-        self.parse_arguments()
-        self.prepare_io()
+        profiler = self.profiler
+        if self.transient:
+            # allocate the workspace before jobs get copied
+            self.scratch = K3Scratch.from_conf(self.app.conf).allocate()
+        with profiler.phase('get_template'):
+            self.get_template()
+        with profiler.phase('load_template'):
+            self.load_template()
+        with profiler.phase('prepare_renderer'):
+            self.prepare_renderer()
+        with profiler.phase('parse_arguments'):
+            self.parse_arguments()
+        with profiler.phase('prepare_io'):
+            self.prepare_io()
+        if not self.transient:
+            self.builddb = K3BuildDB(self.workdir / 'build.log')
+            self.stemdb = K3BuildDB(self.workdir / 'expanded.log')
+
+    def prepare_pack(self):
+        """
+        Write all job scripts into one pack, run by a single driver
+        """
+        self.pack = K3ScriptPack(
+            self.workdir / 'script', self.name, get_stamp(),
+            [f['name'] for f in self.data['io'] + self.data['parameters']])
+
+    def prepare_runstate(self):
+        """
+        Record the state of all jobs of this invocation in
+        k3/<name>/runstate.db
+        """
+        from kea3.runstate import K3RunState
+
+        if self.transient:
+            return
+        run_id = '%s.%d' % (get_stamp(), os.getpid())
+        self.runstate = K3RunState(self.workdir / 'runstate.db', run_id,
+                                   ' '.join(sys.argv))
+
+    def set_state(self, state, **fields):
+        """
+        Record the state of this job
+        """
+        if self.runstate is not None:
+            self.runstate.update(self.ctx['i'], state=state,
+                                 stamp=self.ctx.get('stamp'), **fields)
+
+    def prepare_renderer(self):
+        """
+        Create the renderer & register the templates of this job
+        """
+        # jinja2 is only imported when there is something to render
+        from kea3.render import K3Renderer
+
+        cache_dir = None if self.transient else self.workdir / 'jinja'
+        self.renderer = K3Renderer(cache_dir=cache_dir)
+        for name in 'template combine'.split():
+            source = self.data.get(name)
+            if isinstance(source, str):
+                self.renderer.register(name, source)
 
     def get_template(self):
         """
@@ -135,13 +271,19 @@ class K3Job:
 
         lg.debug("Found template: %s", self.name)
 
-        self.ctx['template']['name'] = self.name
+        self.ctx['template'] = {'name': self.name}
 
     def retrieve_template_file(self, template_file):
-        self.data = fantail.yaml_file_loader(template_file)
         assert template_file.exists()
+        if self.transient:
+            # no place to keep a cache
+            self.data = _yaml_load(template_file)
+        else:
+            self.data = yamlcache.load(
+                template_file, _yaml_load,
+                cache=self.workdir / '.source.k3.pickle')
 
-        for fref in 'template epilog prolog'.split():
+        for fref in 'template combine epilog prolog'.split():
             tpath = self.data.get(fref, '')
             if tpath.startswith('file://'):
                 tpath = tpath.replace('file://', '')
@@ -160,20 +302,28 @@ class K3Job:
 
     def load_template(self):
         """
-        Load the local template.
+        Load the local template - parsed only if it changed since
+        the last time
         """
-        self.data = fantail.yaml_file_loader(self.template_file)
+        self.data = yamlcache.load(self.template_file, _yaml_load)
 #        if self.data.get('template', '').startswith('file://'):
 #            self.data['template'] = fantail.yaml_file_loader(
 #                sefl.data['template'].replace('file://', '')
 
     def save_template(self):
         """
-        Save the current data structure to the local template
+        Save the current data structure to the local template - if it
+        changed
         """
         if not self.transient:
-            self.data['template'] = fantail.util.literal_str(self.data['template'])
-            fantail.yaml_file_save(self.data, self.template_file)
+            import fantail.util
+
+            with self.profiler.phase('save_template'):
+                if not isinstance(self.data['template'],
+                                  fantail.util.literal_str):
+                    self.data['template'] = \
+                        fantail.util.literal_str(self.data['template'])
+                yamlcache.save(self.data, self.template_file, _yaml_save)
 
     def parse_arguments(self):
         def _process_parameter(parser, par, cl_args):
@@ -230,55 +380,20 @@ class K3Job:
         for k, v in self.data['cl_args'].items():
             lg.debug('raw parameter: %s=%s', k, v)
 
-        # expand variables & io parameters
-        vctx = {}
-        jinja_env = jinja2.Environment(undefined=jinja2.StrictUndefined)
-        args_ok = set()
-        iteration = 0
-        last_no_args_ok = 0
-        while True:
-            iteration += 1
-            for k, v in self.data['cl_args'].items():
-                if not isinstance(v, str):
-                    args_ok.add(k)
-                    vctx[k] = v
-                elif '{{' in v:
-                    # attempt to expand
-                    try:
-                        nv = jinja_env.from_string(v).render(vctx)
-                        # this seems to have worked - this var is ok
-                        args_ok.add(k)
-                        self.data['cl_args'][k] = nv
-                        vctx[k] = nv
-                        lg.debug('success fill for %s: %s -> %s', k, v, nv)
-
-                    except jinja2.exceptions.UndefinedError:
-                        lg.debug('(iteration %d - failed fill for %s: %s',
-                                 iteration, k, v)
-                        # somethings is still undefined - ignore
-                        pass
-
-                else:
-                    vctx[k] = v
-                    args_ok.add(k)
-
-            lg.debug(('iteration: %d, no args: %d, args ok: %d, ' +
-                      'args_ok_last_round: %d'), iteration,
-                     len(self.data['cl_args']), len(args_ok), last_no_args_ok)
-
-            # check if we're done
-            if len(args_ok) == len(self.data['cl_args']):
-                lg.debug("Parameter expansion, excellent, all is well")
-                # done!
-                break
-            elif iteration > 5 or len(args_ok) == last_no_args_ok:
-                lg.debug("cannot resolve parameters at the moment: %s" %
-                         str(self.data['cl_args']))
-                break
-            else:
-                last_no_args_ok = len(args_ok)
-                # let's try another round
-                pass
+        # expand variables & io parameters - references to variables
+        # that are not known yet (e.g. ctx variables, or parameters that
+        # are swept) are left for run()
+        sweep = set(par['name'] for par in self.data['parameters']
+                    if par.get('sweep'))
+        try:
+            resolved = resolve(
+                dict((k, v) for k, v in self.data['cl_args'].items()
+                     if k not in sweep),
+                self.renderer, missing='defer')
+        except K3ResolveError as e:
+            lg.error("Cannot resolve parameters: %s", e)
+            exit(-1)
+        self.data['cl_args'].update(resolved)
 
         for par in self.data['parameters']:
             lg.debug('par found: %s=%s', par['name'],
@@ -293,10 +408,14 @@ class K3Job:
 
     def prepare_io(self):
         """
-        If there are glob patterns in the io fields - expand them now
+        Find the fields to expand: io fields with a glob pattern and
+        parameters marked with `sweep: true`. These are expanded lazily,
+        during expand(), and combined according to the `expand` field
+        of the template (zip, product, or a list of groups).
         """
 
-        glob_fields = []
+        self.glob_fields = []
+        self.sweep_fields = []
 
         for io in self.data['io']:
             name = io['name']
@@ -309,144 +428,517 @@ class K3Job:
 
             io['pattern'] = value
 
-            if '{*}' in value:
-                glob_fields.append(name)
-
-        if len(glob_fields) == 0:
-            # nothing to expand - single run
-            for io in self.data['io']:
-                io['all'] = [io['pattern']]
-            for par in self.data['parameters']:
-                par['all'] = [par['pattern']]
-            return
+            if fsglob.is_glob(value):
+                self.glob_fields.append(name)
 
-        if len(glob_fields) > 1:
-            raise ValueError('more than one glob to unpack')
+        for par in self.data['parameters']:
+            if par.get('sweep'):
+                self.sweep_fields.append(par['name'])
 
+        self.expand_groups = expansion.parse_groups(
+            self.data.get('expand'), self.glob_fields + self.sweep_fields)
 
-        # expand pattern
-        gf = glob_fields[0]
+    def _fill(self, pattern, matches):
+        """
+        Fill the glob matches into a pattern: `{g:<name>}` refers to the
+        match of io field <name>, `{g}` and `{*}` to the first glob
+        """
+        if not isinstance(pattern, str) or '{' not in pattern:
+            return pattern
+        for name, repl in matches.items():
+            pattern = pattern.replace('{g:%s}' % name, repl)
+        if self.glob_fields:
+            repl = matches[self.glob_fields[0]]
+            pattern = pattern.replace('{g}', repl).replace('{*}', repl)
+        return pattern
+
+    def _iter_glob(self, name, pattern):
+        no_matches = 0
+        for path, repl in fsglob.iglob(pattern):
+            if no_matches < 3:
+                lg.debug(' (%d): %s - pattern: %s', no_matches, path, repl)
+            no_matches += 1
+            yield {name: path}, {name: repl}
+        if no_matches == 0:
+            lg.warning("no files match %s", pattern)
+
+    def _iter_sweep(self, par):
+        values = par['pattern']
+        if isinstance(values, str):
+            values = values.split(',')
+        elif not isinstance(values, list):
+            values = [values]
+        for value in values:
+            yield {par['name']: value}, {}
+
+    def iter_expanded(self):
+        """
+        Yield, for each job, a dict with the values of the io &
+        parameter fields. Glob matches are streamed from the file
+        system and combinations are generated lazily, jobs can start
+        as soon as the first one is known - only globs zipped with
+        other fields are listed first, to check their lengths.
+        """
+        dimensions = {}
         for io in self.data['io']:
-            if gf == io['name']:
-                pattern = io['pattern']
-                break
+            if io['name'] in self.glob_fields:
+                lg.debug('io expansion of %s', io['pattern'])
+                dimensions[io['name']] = \
+                    self._iter_glob(io['name'], io['pattern'])
+        for par in self.data['parameters']:
+            if par['name'] in self.sweep_fields:
+                dimensions[par['name']] = self._iter_sweep(par)
 
-        patloc = pattern.find('{*}')
-        patstart = pattern[:patloc]
-        patend = pattern[patloc + 3:]
+        try:
+            combinations = expansion.combine(self.expand_groups, dimensions)
+        except ValueError as e:
+            lg.error("Cannot expand: %s", e)
+            exit(-1)
 
-        globpat = patstart + '*' + patend
-        allfiles = glob.glob(globpat)
+        for values, matches in combinations:
+            for field in self.data['io'] + self.data['parameters']:
+                name = field['name']
+                if name not in values:
+                    values[name] = self._fill(field['pattern'], matches)
+            yield values
 
-        lg.debug('io expansion of %d files', len(allfiles))
+    def _varies(self, field) -> bool:
+        """
+        Does the value of this field differ between jobs?
+        """
+        name, pattern = field['name'], field['pattern']
+        if name in self.glob_fields or name in self.sweep_fields:
+            return True
+        if not self.glob_fields or not isinstance(pattern, str):
+            return False
+        return '{g' in pattern or field in self.data['parameters']
 
-        for i, a in enumerate(allfiles):
-            if len(patend) == 0:
-                repl = a[len(patstart):]
-            else:
-                repl = a[len(patstart):-len(patend)]
-            if i < 3:
-                lg.debug(' (%d): %s - pattern: %s: %d %d', i, a, repl,
-                         len(patend), len(a))
-
-            # add a value to the 'expanded' list
-            def _exp_add(d, v):
-                if 'expanded' not in d:
-                    d['expanded'] = []
-                d['expanded'].append(v)
-
-            for io in self.data['io']:
-                name = io['name']
-                if name == gf:
-                    _exp_add(io, a)
-                elif '{g}' in io['pattern']:
-                    to_fill = io['pattern'].replace('{g}', repl)
-                    _exp_add(io, to_fill)
-            for par in self.data['parameters']:
-                name = par['name']
-                if isinstance(par['pattern'], str):
-                    to_fill = par['pattern']
-                    if '{g}' in str(par['pattern']):
-                        to_fill = to_fill.replace('{g}', repl)
-                    if '{*}' in str(par['pattern']):
-                        to_fill = to_fill.replace('{*}', repl)
-                    _exp_add(par, to_fill)
+    def find_references(self) -> frozenset:
+        """
+        Return the names of the variables used by the (combine) template,
+        submit script header & templated values of this job
+        """
+        sources = [self.data.get(name) for name in
+                   ('template', 'combine')]
+        backend = getattr(self, 'backend', None)
+        if backend is not None:
+            sources.append(backend.header)
+        sources.extend(self.data['cl_args'].values())
+        sources.extend(self.data.get('resources', {}).values())
+        sources.extend(self.ctx.layers().values())
+
+        names = set()
+        for source in sources:
+            if is_template(source):
+                names |= self.renderer.variables(source)
+        return frozenset(names)
+
+    def uses(self, name) -> bool:
+        """
+        Do the templates of this job refer to variable `name`?
+        """
+        if self.referenced is None:
+            self.referenced = self.find_references()
+        return name in self.referenced
 
     def expand(self):
 
         self.ctx['epilog'] = []
         self.ctx['prolog'] = []
 
+        # plugins add (lazy) values to the context of all jobs - values
+        # not used by the templates are best added as Lazy, so they are
+        # only computed when accessed
+        self.referenced = self.find_references()
+        lg.debug("templates use: %s", ', '.join(sorted(self.referenced)))
+        self.app.run_hook('context', self)
+
+        self.plan_signature = self.find_plan_signature()
+        self.no_unchanged = 0
+
         lg.debug("start expansion")
 
+        if self.data.get('mode') == 'tree-reduce':
+            yield from self.tree_reduce()
+            return
+
         if self.data.get('mode') in ['start', 'reduce']:
             lg.warning('%s mode - generate one job', self.data['mode'])
             self.ctx['i'] = 0
-            for io in self.data['io']:
-                if 'expanded' in io:
-                    self.ctx[io['name']] = io['expanded']
+            all_values = list(self.profiler.iterate('expand',
+                                                    self.iter_expanded()))
+            for field in self.data['io'] + self.data['parameters']:
+                name = field['name']
+                if self._varies(field):
+                    # pass on all values
+                    self.ctx[name] = [v[name] for v in all_values]
                 else:
-                    self.ctx[io['name']] = io['pattern']
-            for par in self.data['parameters']:
-                if 'expanded' in par:
-                    self.ctx[par['name']] = par['expanded']
-                else:
-                    self.ctx[par['name']] = par['pattern']
+                    self.ctx[name] = field['pattern']
 
+            self.app.run_hook('expanded_batch', [self])
             self.app.run_hook('expanded', self)
+            self.set_state('planned')
+            self.app.run_hook('pre_check_batch', [self])
+            self._pre_run_batch([self])
             yield self
             return
 
         # assume map mode
+        lg.info("generating jobs")
 
-        nojobs = set()
-        expfields = []
-
-        for io in self.data['io']:
-            if 'expanded' in io:
-                expfields.append(io['name'])
-                nojobs.add(len(io['expanded']))
-            else:
-                expfields.append(None)
-                nojobs.add(1)
-
-        for par in self.data['parameters']:
-            if 'expanded' in par:
-                expfields.append(par['name'])
-                nojobs.add(len(par['expanded']))
-
-        if len(nojobs) == 0:
-            nojobs = 0
-        elif len(nojobs) == 1:
-            nojobs = list(nojobs)[0]
-        else:
-            raise Exception("Invalid job")
+        # the parent ctx is shared, read-only, by all jobs
+        parent_ctx = self.ctx.freeze()
 
-        lg.info("generating %d jobs", nojobs)
-
-        for i in range(nojobs):
+        chunk = []
+        chunk_size = MIN_CHUNK_SIZE
+        for i, values in enumerate(self.profiler.iterate(
+                'expand', self.iter_expanded())):
             # copying shallowly...
             newjob = copy.copy(self)
-            # ...but ensure it has its own context
-            newjob.ctx = fantail.Fantail()
-            newjob.ctx.update(self.ctx)
+            # ...but ensure it has its own context layer
+            newjob.ctx = K3Context(parent_ctx)
             newjob.ctx['i'] = i
 
             # fill the io data into the ctx
-            for io in self.data['io']:
-                if 'expanded' in io:
-                    newjob.ctx[io['name']] = io['expanded'][i]
-                else:
-                    newjob.ctx[io['name']] = io['pattern']
+            newjob.ctx.update(values)
+
+            chunk.append(newjob)
+            if len(chunk) >= chunk_size:
+                yield from self._expanded_chunk(chunk)
+                chunk = []
+                # start small, so the first jobs start quickly
+                chunk_size = min(2 * chunk_size, MAX_CHUNK_SIZE)
+
+        yield from self._expanded_chunk(chunk)
+        if self.no_unchanged:
+            lg.info("skipped %d job(s) completed earlier, with unchanged "
+                    "files (use --recheck to check all)", self.no_unchanged)
+
+    def tree_reduce(self):
+        """
+        Expand a reduction into a tree of jobs: level 0 jobs reduce
+        chunks of `fan_in` inputs into partial outputs, the jobs of the
+        next levels merge `fan_in` partial outputs of the level below,
+        with the `combine` template, until one job writes the output.
+
+        In combine jobs the input fields hold the partial outputs of
+        the level below, `partials` maps each output field to its
+        partial outputs. All jobs get their `level` and `chunk` in the
+        context.
+        """
+        fan_in = int(self.data.get('fan_in', FAN_IN))
+        if fan_in < 2:
+            lg.error("fan_in must be at least 2")
+            exit(-1)
+
+        fields = self.data['io'] + self.data['parameters']
+        outputs = [io['name'] for io in self.data['io']
+                   if io['cat'] == 'output']
+        for field in self.data['io']:
+            if field['name'] in outputs and self._varies(field):
+                lg.error("the output of a tree-reduce must be a single "
+                         "file: %s", field['name'])
+                exit(-1)
+        varies = set(f['name'] for f in fields if self._varies(f))
+        script_template = 'combine' if 'combine' in self.renderer.sources \
+            else 'template'
+
+        parent_ctx = self.ctx.freeze()
+        values = list(self.profiler.iterate('expand', self.iter_expanded()))
+        # level 0 reduces the expanded values, the other levels the
+        # jobs of the level below
+        below = values
+        level = 0
+        i = 0
+        while True:
+            no_chunks = max(1, (len(below) + fan_in - 1) // fan_in)
+            jobs = []
+            for chunk in range(no_chunks):
+                items = below[chunk * fan_in:(chunk + 1) * fan_in]
+                newjob = copy.copy(self)
+                newjob.ctx = K3Context(parent_ctx)
+                newjob.ctx['i'] = i
+                newjob.ctx['level'] = level
+                newjob.ctx['chunk'] = chunk
+                i += 1
+
+                partials = dict((name, [job.ctx[name] for job in items])
+                                for name in outputs) if level else {}
+                for field in fields:
+                    name = field['name']
+                    if name in outputs:
+                        value = field['pattern']
+                        if no_chunks > 1:
+                            value = self.partial_file(name, level, chunk,
+                                                      value)
+                    elif name not in varies:
+                        value = field['pattern']
+                    elif level == 0:
+                        value = [v[name] for v in items]
+                    elif field.get('cat') == 'input':
+                        value = [f for files in partials.values()
+                                 for f in files]
+                    else:
+                        value = [v for job in items for v in job.ctx[name]]
+                    newjob.ctx[name] = value
+                if level:
+                    newjob.ctx['partials'] = partials
+                    newjob.script_template = script_template
+                    newjob.depends_on = items
+                jobs.append(newjob)
+
+            lg.info("tree-reduce level %d: %d job(s)", level, len(jobs))
+            for start in range(0, len(jobs), MAX_CHUNK_SIZE):
+                yield from self._expanded_chunk(
+                    jobs[start:start + MAX_CHUNK_SIZE])
+            if no_chunks == 1:
+                return
+
+            self.wait_for(jobs)
+            failed = [job for job in jobs if job.rc not in (None, 0)]
+            if failed:
+                lg.error("%d job(s) of tree-reduce level %d failed, not "
+                         "combining their output", len(failed), level)
+                return
+            below = jobs
+            level += 1
+
+    def partial_file(self, name, level, chunk, output) -> Path:
+        """
+        File holding the partial output of one job of a tree-reduce
+        """
+        partial_dir = self.workdir / 'partial'
+        partial_dir.makedirs_p()
+        return partial_dir / ('%s.%d.%d.%s' % (name, level, chunk,
+                                               Path(output).basename()))
 
-            for par in self.data['parameters']:
-                if 'expanded' in par:
-                    newjob.ctx[par['name']] = par['expanded'][i]
+    def wait_for(self, jobs):
+        """
+        Wait until these jobs (a level of a tree-reduce) are done
+        """
+        if self.barrier is not None:
+            self.barrier()
+
+    def _expanded_chunk(self, jobs):
+        """
+        Prefetch the file metadata for a chunk of expanded jobs, run the
+        hooks, then hand them out.
+
+        Plugins get the chunk in the `expanded_batch` hook (before the
+        per job `expanded` hook), in `pre_check_batch` (before the
+        jobs run and their per job `pre_check` hook) and, once the jobs
+        are rendered, in `pre_run_batch` (before their per job `pre_run`
+        hook) - to fetch what they need for all jobs at once.
+        """
+        with self.profiler.phase('prefetch'):
+            self.stats.prefetch(
+                f for job in jobs for cat, name, filenames in job.io_files()
+                if cat != 'executable' for f in filenames)
+        if self.stemdb is not None:
+            for job in jobs:
+                job.stem = job.find_stem()
+            if self.incremental():
+                todo = [job for job in jobs if not job.unchanged()]
+                self.no_unchanged += len(jobs) - len(todo)
+                jobs = todo
+        if jobs:
+            self.app.run_hook('expanded_batch', jobs)
+        for job in jobs:
+            self.app.run_hook('expanded', job)
+            job.set_state('planned')
+        if jobs:
+            self.app.run_hook('pre_check_batch', jobs)
+            self._pre_run_batch(jobs)
+        yield from jobs
+
+    def _pre_run_batch(self, jobs):
+        """
+        Render a chunk of jobs, then run the `pre_run_batch` hook for
+        those that rendered - an error is raised again when the job runs
+        """
+        for job in jobs:
+            try:
+                job.prepare_run()
+            except Exception as e:
+                job.prepare_error = e
+        prepared = [job for job in jobs if job.prepare_error is None]
+        if prepared:
+            self.app.run_hook('pre_run_batch', prepared)
+
+    def incremental(self) -> bool:
+        """
+        Skip jobs that completed in an earlier run, before they are
+        rendered & checked - unless forced, or with --recheck
+        """
+        return self.stemdb is not None and not self.runargs.force and \
+            not getattr(self.runargs, 'recheck', False)
+
+    def find_plan_signature(self) -> str:
+        """
+        Signature of everything, besides the expanded values, that
+        goes into the jobs: the whole template data (templates,
+        parameters, resources & what plugins use, e.g. modules or pbs)
+        """
+        return signature(json.dumps(self.data, sort_keys=True,
+                                    default=str))
+
+    def find_stem(self):
+        """
+        Return (key, files) of this job in the expansion log: the key is
+        based on the expanded io & parameter values. None for jobs
+        without output, or with values that are resolved later on.
+        """
+        values = []
+        for field in self.data['io'] + self.data['parameters']:
+            value = self.ctx[field['name']]
+            if is_template(value) or (isinstance(value, list) and
+                                      any(is_template(v) for v in value)):
+                return None
+            values.append('%s=%r' % (field['name'], value))
+        files = []
+        no_output = 0
+        for cat, name, filenames in self.io_files():
+            if cat == 'executable':
+                continue
+            if cat == 'output':
+                no_output += len(filenames)
+            files.extend(filenames)
+        if no_output == 0:
+            return None
+        return signature(*values), files
+
+    def stem_signature(self, files) -> str:
+        parts = [self.plan_signature]
+        for f in files:
+            st = self.stats.stat(f)
+            if st is None:
+                parts.append('%s:-' % f)
+            else:
+                parts.append('%s:%d:%d' % (f, st.st_mtime_ns, st.st_size))
+        return signature(*parts)
+
+    def unchanged(self) -> bool:
+        """
+        Did this job complete in an earlier run - with the same template
+        & parameters, and are its input & output files unchanged since?
+        """
+        if self.stem is None:
+            return False
+        key, files = self.stem
+        recorded = self.stemdb.get(key)
+        return recorded is not None and \
+            recorded == self.stem_signature(files)
+
+    def record_stem(self):
+        """
+        Record this (completed or up to date) job in the expansion log
+        """
+        if self.stemdb is None or self.stem is None:
+            return
+        key, files = self.stem
+        self.stemdb.record(key, self.stem_signature(files))
+
+    def io_files(self):
+        """
+        Yield (cat, name, [filenames]) for all io fields of this job
+        """
+        for io in self.data['io']:
+            value = self.ctx[io['name']]
+            if isinstance(value, list):
+                filenames = [Path(x) for x in value]
+            else:
+                filenames = [Path(value)]
+            yield io['cat'], io['name'], filenames
+
+    def build_key(self):
+        """
+        Key of this job in the build database - based on the output
+        files. Jobs without output are not recorded.
+        """
+        outputs = sorted(str(f) for cat, name, filenames in self.io_files()
+                         if cat == 'output' for f in filenames)
+        if not outputs:
+            return None
+        return signature(*outputs)
+
+    def build_signature(self) -> str:
+        """
+        Signature of this job: the rendered script, prolog & epilog,
+        parameter values and the stat of all input & output files
+        """
+        # script paths in the prolog & epilog carry the stamp
+        stamp = self.ctx.get('stamp', '')
+        parts = [self.code,
+                 '\n'.join(self.ctx['prolog']).replace(stamp, ''),
+                 '\n'.join(self.ctx['epilog']).replace(stamp, '')]
+        for par in self.data['parameters']:
+            parts.append('%s=%r' % (par['name'], self.ctx[par['name']]))
+        for cat, name, filenames in self.io_files():
+            if cat == 'executable':
+                continue
+            for f in filenames:
+                st = self.stats.stat(f)
+                if st is None:
+                    parts.append('%s:%s:-' % (name, f))
                 else:
-                    newjob.ctx[par['name']] = par['pattern']
+                    parts.append('%s:%s:%d:%d' % (name, f, st.st_mtime_ns,
+                                                  st.st_size))
+        return signature(*parts)
+
+    def record_build(self):
+        """
+        Record the signature of this (up to date) job
+        """
+        if self.builddb is None:
+            return
+        key = self.build_key()
+        if key is not None:
+            self.builddb.record(key, self.build_signature())
+        self.record_stem()
+
+    def finish(self):
+        """
+        Called on the parent job when all jobs are done
+        """
+        if self.aexec is not None:
+            self.aexec.close()
+        self.flush_post_run()
+        self.app.run_hook('finish', self)
+        if self.pack is not None:
+            self.pack.close()
+        if self.builddb is not None:
+            self.builddb.close()
+        if self.stemdb is not None:
+            self.stemdb.close()
+        if self.runstate is not None:
+            self.runstate.close()
+        self.stats.close()
+
+    def all_cores(self) -> int:
+        """
+        No of cores a job asking for `cores: all` gets
+        """
+        return os.cpu_count() or 1
 
-            self.app.run_hook('expanded', newjob)
-            yield newjob
+    def resources(self) -> dict:
+        """
+        Resources this job needs, from the `resources` field of the
+        template (e.g. cores, mem, custom tokens) - cores is always a
+        whole number
+        """
+        rv = {}
+        for name, amount in self.data.get('resources', {}).items():
+            if isinstance(amount, str) and '{' in amount:
+                amount = self.renderer.render_string(amount,
+                                                     self.ctx.view())
+            rv[name] = amount
+        if 'cores' in rv:
+            try:
+                rv['cores'] = parse_cores(rv['cores'], self.all_cores())
+            except ValueError as e:
+                lg.error("Invalid resources: %s", e)
+                exit(-1)
+        return rv
 
     def check(self):
 
@@ -456,6 +948,17 @@ class K3Job:
             lg.debug("run - forced")
             return True
 
+        key = self.build_key() if self.builddb is not None else None
+        if key is not None:
+            recorded = self.builddb.get(key)
+            if recorded is not None:
+                if recorded == self.build_signature():
+                    lg.info("job is up to date")
+                    self.record_stem()
+                    return False
+                lg.info("command, parameters or files changed, run")
+                return True
+
         latest_source_mtime = None
         earliest_output_mtime = None
         no_output = 0
@@ -479,13 +982,13 @@ class K3Job:
 
             if cat == 'output':
                 for f in filenames:
-                    if not f.exists():
+                    if not self.stats.exists(f):
                         # an output file does not exist, run
                         lg.info('output file (%s) missing, run', f)
 
                         return True
 
-            mtimes = [x.mtime for x in filenames]
+            mtimes = [self.stats.mtime(x) for x in filenames]
 
             if cat == 'output':
                 no_output += 1
@@ -511,18 +1014,24 @@ class K3Job:
         else:
             lg.info("%d output file(s) newer than %d input file(s)", no_output,
                     no_input)
+            self.record_build()
             return False
 
     def prep_save_scripts(self) -> None:
 
-        stamp = datetime.utcnow()
-        stamp = stamp.replace(microsecond=0)
-        stamp = datetime.isoformat(stamp).replace(':', '').replace('-', '')
+        stamp = get_stamp()
 
         self.ctx['stamp'] = stamp
         script_dir = self.workdir / 'script'
         script_dir.makedirs_p()
 
+        if self.pack is not None:
+            # all scripts go into the pack - this is only used to name
+            # log files
+            self.main_script = Path('%s.%s' % (self.pack.path,
+                                               self.ctx['i']))
+            return
+
         self.prolog_script = script_dir \
             / ('%s__%s__%s.prolog.sh' % (self.name, self.ctx['i'], stamp))
         self.prolog_script = self.prolog_script.abspath()
@@ -538,6 +1047,18 @@ class K3Job:
 
         rv = {}
 
+        if self.pack is not None:
+            prolog, epilog = '', ''
+            if len(self.ctx['prolog']) > 0:
+                prolog = "#!/bin/bash\n\n" + "\n\n".join(self.ctx['prolog'])
+            if len(self.ctx['epilog']) > 0:
+                epilog = "#!/bin/bash\n\n" + "\n\n".join(self.ctx['epilog'])
+            values = dict((f['name'], self.ctx[f['name']])
+                          for f in self.data['io'] + self.data['parameters'])
+            rv['main'] = self.pack.add(self.ctx['i'], prolog, self.code,
+                                       epilog, values)
+            return rv
+
         if len(self.ctx['prolog']) > 0:
             with open(self.prolog_script, 'w') as F:
                 F.write("#!/bin/bash\n\n")
@@ -560,63 +1081,134 @@ class K3Job:
 
         return rv
 
-    def executor(self, cl: list) -> int:
+    def timeout(self):
+        """
+        Max runtime of this job in seconds (None: no limit) - from the
+        command line or the `timeout` field of the template
+        """
+        timeout = getattr(self.runargs, 'timeout', None) or \
+            self.data.get('timeout')
+        return None if timeout is None else float(timeout)
+
+    def executor(self, cl: list):
+        """
+        Run the job - returns the return code, or a Future of it when
+        running asynchronously (aexec)
+        """
         cl = "; ".join(cl)
         lg.info('run: %s', cl)
+        self.set_state('running', start=time.time())
+        if self.aexec is not None:
+            # run asynchronously, output goes to log files
+            return self.aexec.submit(
+                cl, self.main_script + '.out', self.main_script + '.err',
+                timeout=self.timeout(), demand=self.resources(),
+                callback=self.finished)
         # print(cl)
         rc = sp.call(cl, shell=True)
+        return self.finished(rc)
+
+    def flush_post_run(self, job=None):
+        """
+        Queue a job that ran successfully for the `post_run_batch` hook,
+        which gets up to MAX_CHUNK_SIZE jobs at once. Without a job,
+        run the hook for whatever is queued.
+        """
+        with self._batch_lock:
+            if job is not None:
+                self.post_run_queue.append(job)
+                if len(self.post_run_queue) < MAX_CHUNK_SIZE:
+                    return
+            # the list is shared with all jobs - empty it in place
+            batch = self.post_run_queue[:]
+            del self.post_run_queue[:]
+        if batch:
+            self.app.run_hook('post_run_batch', batch)
+
+    def finished(self, rc: int) -> int:
+        """
+        Handle the return code of a job that ran
+        """
         if rc != 0:
             lg.warning("Run finished with RC: %s", rc)
         else:
             lg.info("Run finished successfully")
+        self.rc = rc
+        self.set_state('done' if rc == 0 else 'failed', rc=rc,
+                       end=time.time())
         if rc == 0:
+            # the outputs have changed
+            self.stats.invalidate(
+                f for cat, name, filenames in self.io_files()
+                if cat == 'output' for f in filenames)
+            self.record_build()
             self.app.run_hook('post_run', self)
+            self.flush_post_run(self)
         return rc
 
     def run(self) -> int:
         """ actually run """
-
+        try:
+            return self._run()
+        except K3ResolveError as e:
+            lg.error("Cannot resolve parameters of job %s: %s",
+                     self.ctx['i'], e)
+            self.rc = -1
+            self.set_state('failed', rc=-1, end=time.time())
+            return -1
+        except Exception:
+            # e.g. a template error - so the job does not count as done
+            self.rc = -1
+            self.set_state('failed', rc=-1, end=time.time())
+            raise
+
+    def prepare_run(self):
+        """
+        Render the job, up to its `pre_run` hook - done per chunk of
+        expanded jobs, otherwise when the job runs
+        """
         self.app.run_hook('pre_check', self)
 
-        # first fix ctx - variables might still carry variables
-        while True:
-            no_changed = 0
-            for k, v in self.ctx.items():
-                if not isinstance(v, str):
-                    continue
-                if '{{' not in v and '{%' not in v:
-                    continue
-                # attempt render
-                template = jinja2.Template(v)
-                vv = template.render(self.ctx)
-                if vv != v:
-                    no_changed += 1
-                    self.ctx[k] = vv
-            if no_changed == 0:
-                break
-
-        template = self.data['template']
-        _last_template = template
-        _template_i = 0
-        while True:
-            _template_i += 1
-            template = jinja2.Template(template)
-            template = template.render(self.ctx)
-            if '{{' not in template and '{%' not in template:
-                break
-            if template == _last_template:
-                break
-            if _template_i > 4:
-                break
-            _last_template = template
-
-        self.code = template
-
-        scripts = self.prep_save_scripts()
-
+        profiler = self.profiler
+        with profiler.phase('render'):
+            # first fix ctx - variables might still carry variables
+            renderer = self.renderer
+            templated = dict((k, v) for k, v in self.ctx.layers().items()
+                             if is_template(v))
+            self.ctx.update(resolve(templated, renderer,
+                                    context=self.ctx.view(),
+                                    missing='ignore'))
+
+            template = renderer.render(self.script_template,
+                                       self.ctx.view())
+            _last_template = self.data[self.script_template]
+            _template_i = 1
+            while '{{' in template or '{%' in template:
+                if template == _last_template or _template_i > 4:
+                    break
+                _template_i += 1
+                _last_template = template
+                # the output of a render pass is unique to this job
+                template = renderer.render_string(template, self.ctx.view(),
+                                                  cache=False)
+
+            self.code = template
+
+        with profiler.phase('save_scripts'):
+            self.prep_save_scripts()
+        self.prepared = True
+
+    def _run(self) -> int:
+        if self.prepare_error is not None:
+            raise self.prepare_error
+        if not self.prepared:
+            self.prepare_run()
+
+        profiler = self.profiler
         self.app.run_hook('pre_run', self)
 
-        scripts = self.save_scripts()
+        with profiler.phase('save_scripts'):
+            scripts = self.save_scripts()
 
         cl = []
 
@@ -628,9 +1220,13 @@ class K3Job:
         if 'epilog' in scripts:
             cl.append('%s' % scripts['epilog'])
 
-        if not self.check():
+        with profiler.phase('check'):
+            todo = self.check()
+
+        if not todo:
             lg.info("skipping")
             self.skipped = True
+            self.set_state('skipped')
             self.app.run_hook('skip_run', self)
             return
 
@@ -639,8 +1235,10 @@ class K3Job:
         if self.runargs.dryrun:
             print(self.code)
             print("#" + '-' * 80)
+            self.set_state('dryrun')
             self.app.run_hook('dry_run', self)
             return 0
         else:
             # actually execute cl
-            return self.executor(cl)
+            with profiler.phase('execute'):
+                return self.executor(cl)
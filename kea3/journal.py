@@ -0,0 +1,174 @@
+"""
+Crash safe transaction journal.
+
+Transactions are appended, as JSON lines, to a journal file (e.g.
+k3/<name>/transactions.jsonl) in chunks. A commit hands all pending
+transactions to one call of a commit function, and is recorded in two
+steps:
+
+    {"commit": <token>, "ids": [...]}     - before the call
+    {"committed": <token>}                - after the call
+
+After a crash, transactions without a commit are still pending, and an
+interrupted commit is retried with the same token, so the commit
+function can check how far it got. A torn last line is ignored.
+
+The journal is compacted - rewritten with only what is not committed
+yet - when it is opened and after each commit.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import threading
+import uuid
+
+lg = logging.getLogger('k3.journal')
+
+#: write the buffer to disk every CHUNK_SIZE transactions
+CHUNK_SIZE = 1000
+
+
+class K3Journal:
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = str(path)
+        self.chunk_size = chunk_size
+        # id -> transaction, not committed yet
+        self.pending = OrderedDict()
+        # token -> ids of commits that did not finish
+        self.interrupted = OrderedDict()
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._no_lines = 0
+        self._replay()
+        if self._no_lines > len(self.pending) + len(self.interrupted):
+            self._compact()
+        self._F = open(self.path, 'a')
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as F:
+            data = F.read()
+        for line in data.decode('utf-8', 'replace').splitlines():
+            self._no_lines += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # torn write
+                continue
+            if 'committed' in record:
+                for tid in self.interrupted.pop(record['committed'], []):
+                    self.pending.pop(tid, None)
+            elif 'commit' in record:
+                self.interrupted[record['commit']] = record['ids']
+            else:
+                self.pending[record['id']] = record
+        if data and not data.endswith(b'\n'):
+            # do not append to a torn line
+            with open(self.path, 'a') as F:
+                F.write('\n')
+            self._no_lines += 1
+        if self.pending:
+            lg.info("%d uncommitted transaction(s) in %s", len(self.pending),
+                    self.path)
+
+    def _write(self, lines, sync=True):
+        self._F.write(''.join(line + '\n' for line in lines))
+        self._F.flush()
+        if sync:
+            os.fsync(self._F.fileno())
+        self._no_lines += len(lines)
+
+    def _compact(self):
+        """
+        Rewrite the journal with only the transactions & commits that
+        are still pending
+        """
+        lg.debug("compacting journal %s", self.path)
+        lines = [json.dumps(record) for record in self.pending.values()]
+        lines.extend(json.dumps({'commit': token, 'ids': ids})
+                     for token, ids in self.interrupted.items())
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as F:
+            F.write(''.join(line + '\n' for line in lines))
+            F.flush()
+            os.fsync(F.fileno())
+        os.replace(tmp, self.path)
+        self._no_lines = len(lines)
+
+    def _flush(self, sync=True):
+        if self._buffer:
+            self._write(self._buffer, sync)
+            self._buffer = []
+
+    def add(self, tid, **data):
+        """
+        Add transaction `tid`
+        """
+        record = dict(data, id=tid)
+        with self._lock:
+            self.pending[tid] = record
+            self._buffer.append(json.dumps(record))
+            if len(self._buffer) >= self.chunk_size:
+                self._flush()
+
+    def flush(self, sync=True):
+        """
+        Write the buffered transactions - without sync, they survive k3
+        being killed, but not a crash of the machine
+        """
+        with self._lock:
+            if not self._F.closed:
+                self._flush(sync)
+
+    def _commit(self, token, ids, function, retry):
+        records = [self.pending[t] for t in ids if t in self.pending]
+        if not retry:
+            self._write([json.dumps({'commit': token, 'ids': ids})])
+        if records:
+            function(token, records, retry)
+        self._write([json.dumps({'committed': token})])
+        for tid in ids:
+            self.pending.pop(tid, None)
+        return len(records)
+
+    def commit(self, function) -> int:
+        """
+        Commit all pending transactions: function(token, records, retry)
+        is called once per commit - retry is True if the commit with
+        this token got interrupted earlier. Returns the no of committed
+        transactions.
+        """
+        with self._lock:
+            self._flush()
+            done = 0
+            batches = [(token, ids, True)
+                       for token, ids in self.interrupted.items()]
+            self.interrupted.clear()
+            committing = set(t for token, ids, retry in batches for t in ids)
+            rest = [t for t in self.pending if t not in committing]
+            if rest:
+                batches.append((uuid.uuid4().hex, rest, False))
+            for i, (token, ids, retry) in enumerate(batches):
+                if retry:
+                    lg.warning("retrying interrupted commit %s", token)
+                try:
+                    done += self._commit(token, ids, function, retry)
+                except Exception:
+                    # retry these later
+                    for token, ids, retry in batches[i:]:
+                        self.interrupted[token] = ids
+                    raise
+            if self._no_lines > len(self.pending):
+                self._F.close()
+                self._compact()
+                self._F = open(self.path, 'a')
+            return done
+
+    def close(self):
+        with self._lock:
+            if not self._F.closed:
+                self._flush()
+                self._F.close()
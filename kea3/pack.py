@@ -0,0 +1,173 @@
+"""
+Packed job scripts.
+
+Instead of writing a prolog, main script and epilog per job, a packed
+run appends the scripts of all jobs to a single pack file. A TSV index
+holds, per job, the offset & length of each script plus the values of
+the io & parameter fields. One shared driver script runs a job by its
+index:
+
+    k3/<name>/script/<name>__<stamp>.driver.sh <i>
+
+The driver finds the offsets of job i in a file with fixed width
+records (record i at byte i * RECORD_SIZE), so starting a job does not
+depend on the no of jobs in the pack.
+
+So a run of 100k jobs creates four files instead of 300k.
+"""
+
+import logging
+import shlex
+import threading
+
+from path import Path
+
+lg = logging.getLogger('k3.pack')
+
+DRIVER = r"""#!/bin/bash
+# k3 packed job driver - run a job by index: {driver} <i>
+K3_PACK={pack}
+K3_OFFSETS={offsets}
+
+k3_extract() {{
+    tail -c +$(( $1 + 1 )) "$K3_PACK" | head -c "$2"
+}}
+
+# record $1 of the offsets file - tail seeks, so this takes as long for
+# the last job of a large pack as for the first
+k3_row=$(tail -c +$(( $1 * {record_size} + 1 )) "$K3_OFFSETS" \
+    2> /dev/null | head -c {record_size} | tr -d '\0')
+read -r k3_pro_off k3_pro_len k3_main_off k3_main_len \
+    k3_epi_off k3_epi_len <<< "$k3_row"
+if [ -z "$k3_epi_len" ]; then
+    echo "k3: no job $1 in $K3_OFFSETS" >&2
+    exit 1
+fi
+
+k3_tmp=$(mktemp -d)
+trap 'rm -rf "$k3_tmp"' EXIT
+
+if [ "$k3_pro_len" -gt 0 ]; then
+    k3_extract $k3_pro_off $k3_pro_len > "$k3_tmp/prolog"
+    source "$k3_tmp/prolog"
+fi
+
+k3_extract $k3_main_off $k3_main_len > "$k3_tmp/main"
+chmod +x "$k3_tmp/main"
+"$k3_tmp/main"
+k3_rc=$?
+
+if [ "$k3_epi_len" -gt 0 ]; then
+    k3_extract $k3_epi_off $k3_epi_len > "$k3_tmp/epilog"
+    bash "$k3_tmp/epilog"
+    k3_rc=$?
+fi
+
+exit $k3_rc
+"""
+
+INDEX_COLUMNS = ['i', 'prolog_offset', 'prolog_length', 'main_offset',
+                 'main_length', 'epilog_offset', 'epilog_length']
+
+#: a record of the offsets file: offset & length of the prolog, main &
+#: epilog script, space padded
+RECORD = ' '.join(['%15d'] * 6) + '\n'
+RECORD_SIZE = len(RECORD % ((0,) * 6))
+
+
+def _tsv_value(value):
+    return str(value).replace('\t', ' ').replace('\n', ' ')
+
+
+class K3ScriptPack:
+    def __init__(self, script_dir, name, stamp, fields=()):
+        """
+        :param script_dir: directory to write the pack to
+        :param name: template name
+        :param stamp: time stamp of this invocation
+        :param fields: names of the io & parameter fields to list in the
+                       index
+        """
+        base = (Path(script_dir) / ('%s__%s' % (name, stamp))).abspath()
+        self.path = Path(base + '.pack')
+        self.index = Path(base + '.pack.tsv')
+        self.offsets = Path(base + '.pack.offsets')
+        self.driver = Path(base + '.driver.sh')
+        self.fields = list(fields)
+        self._lock = threading.Lock()
+        self._offset = 0
+        self.no_jobs = 0
+
+        Path(script_dir).makedirs_p()
+        self._pack = open(self.path, 'wb')
+        self._index = open(self.index, 'w')
+        self._index.write('#' + '\t'.join(INDEX_COLUMNS + self.fields) +
+                          '\n')
+        self._offsets = open(self.offsets, 'wb')
+        with open(self.driver, 'w') as F:
+            F.write(DRIVER.format(driver=shlex.quote(self.driver),
+                                  pack=shlex.quote(self.path),
+                                  offsets=shlex.quote(self.offsets),
+                                  record_size=RECORD_SIZE))
+        self.driver.chmod('a+x')
+
+    def add(self, i, prolog, main, epilog, values=None) -> str:
+        """
+        Add the scripts of job `i`, return the command running it
+        """
+        row = [i]
+        with self._lock:
+            for script in (prolog, main, epilog):
+                data = script.encode('utf-8')
+                self._pack.write(data)
+                row += [self._offset, len(data)]
+                self._offset += len(data)
+            values = values or {}
+            # record i - jobs that are not added leave a gap (of zeros)
+            self._offsets.seek(int(i) * RECORD_SIZE)
+            self._offsets.write((RECORD % tuple(row[1:])).encode('ascii'))
+            row += [_tsv_value(values.get(f, '')) for f in self.fields]
+            self._index.write('\t'.join(map(str, row)) + '\n')
+            # the job might start right away
+            self._pack.flush()
+            self._index.flush()
+            self._offsets.flush()
+            self.no_jobs += 1
+        return '%s %s' % (shlex.quote(self.driver), i)
+
+    def close(self):
+        with self._lock:
+            self._pack.close()
+            self._index.close()
+            self._offsets.close()
+        lg.info("packed %d jobs in %s", self.no_jobs, self.path)
+
+
+def read_index(index):
+    """
+    Read a pack index - returns the header and a list of rows (dicts)
+    """
+    with open(index) as F:
+        header = F.readline().lstrip('#').rstrip('\n').split('\t')
+        rows = [dict(zip(header, line.rstrip('\n').split('\t')))
+                for line in F]
+    return header, rows
+
+
+def read_job(index, i) -> dict:
+    """
+    Return the prolog, main & epilog of packed job i
+    """
+    header, rows = read_index(index)
+    pack = str(index)[:-len('.tsv')]
+    for row in rows:
+        if row['i'] == str(i):
+            break
+    else:
+        raise KeyError('no job %s in %s' % (i, index))
+    rv = {}
+    with open(pack, 'rb') as F:
+        for name in ('prolog', 'main', 'epilog'):
+            F.seek(int(row[name + '_offset']))
+            rv[name] = F.read(int(row[name + '_length'])).decode('utf-8')
+    return rv
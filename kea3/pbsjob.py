@@ -0,0 +1,204 @@
+"""
+Jobs submitted to a cluster (k3 pbs).
+
+Instead of running, a K3JobPbs adds its command line to a batch. Full
+batches are rendered into a submit script by the cluster backend and
+submitted - or, with --array, added to a pack that is submitted as one
+array job at the end. Each job writes its rc to the run state rc
+directory when done, for k3 status.
+
+The combine jobs of a tree-reduce are submitted with a dependency on
+the batches holding the jobs they combine the output of.
+"""
+
+import logging
+import os
+import shlex
+
+from path import Path
+
+from kea3.backend import pool_batch
+from kea3.job import K3Job
+
+lg = logging.getLogger('k3.run')
+
+
+class K3JobPbs(K3Job):
+    # pack with the batches of an array job - None if not an array job
+    array = None
+    # cluster backend to render & submit batches
+    backend = None
+
+    def executor(self, cl: list) -> None:
+        """
+        execute a pbs job
+        """
+
+        cores = self.resources().get('cores', 1)
+        if self.runstate is not None:
+            # record the rc of the main script (after the sourced
+            # prolog) for k3 status - the epilog still only runs if it
+            # succeeded (set -e)
+            main = 1 if cl[0].startswith('source ') else 0
+            rc_file = shlex.quote(self.runstate.rc_file(self.ctx['i']))
+            cl = cl[:main] + [
+                'k3_rc=0',
+                '%s || k3_rc=$?' % cl[main],
+                'echo "$k3_rc $(date +%%s)" > %s.tmp && mv %s.tmp %s' % (
+                    rc_file, rc_file, rc_file),
+                '[ $k3_rc -eq 0 ] || return $k3_rc'] + cl[main + 1:]
+        depends_on = [job.ctx['i'] for job in self.depends_on]
+        self.app.cl_cache.append((self.ctx['i'], cores, cl, depends_on))
+        if len(self.app.cl_cache) >= self.ctx['pbs'].get('jobs_per_node', 1):
+            self.run_flush()
+
+    def all_cores(self) -> int:
+        """
+        All cores of a node - needs ppn
+        """
+        ppn = self.ctx['pbs'].get('ppn')
+        if not ppn:
+            lg.error("cores: all needs the no of cores per node (--ppn)")
+            exit(-1)
+        return ppn
+
+    def write_script(self, body, jobid=None) -> None:
+        """
+        Write a submit script running `body`
+        """
+        self.ctx['cwd'] = os.getcwd()
+        if jobid is None:
+            jobid = '%s.%s.%s' % (self.ctx['template']['name'],
+                                  self.ctx['stamp'], self.ctx['i'])
+
+        self.ctx['job_id'] = jobid
+
+        lg.info('pbs submit job: %s', jobid)
+
+        self.pbs_script = self.ctx['pbs_dir'] / ('%s.qsub' %
+                                                 self.ctx['job_id'])
+
+        script = self.backend.render_batch(self.renderer, self.ctx.view(),
+                                           body)
+        with open(self.pbs_script, 'w') as F:
+            F.write(script)
+
+    def get_batch(self) -> str:
+        """
+        Return the script lines running the cached jobs - with at most
+        ppn cores in use (all at once if ppn is not set)
+        """
+        jobs = [(cores, cl) for i, cores, cl, deps in self.app.cl_cache]
+        slots = self.ctx['pbs'].get('ppn') or \
+            sum(cores for cores, cl in jobs)
+        return pool_batch(jobs, slots)
+
+    def record_submitted(self, batch, jobid) -> None:
+        """
+        Record the pbs job id of the jobs in a batch
+        """
+        if jobid is None:
+            return
+        for i in batch:
+            self.app.pbs_ids[i] = jobid
+        if self.runstate is None:
+            return
+        for i in batch:
+            self.runstate.update(i, state='submitted', pbs_id=jobid)
+
+    def get_depend(self) -> list:
+        """
+        Return the job ids the cached jobs have to wait for
+        """
+        return sorted(set(self.app.pbs_ids[d]
+                          for i, cores, cl, deps in self.app.cl_cache
+                          for d in deps if d in self.app.pbs_ids))
+
+    def submit(self, depend=None):
+        """
+        Submit the last written script - returns the job id (or None if
+        not submitted)
+        """
+        if self.app.trans['args'].qsub or self.backend.always_submit:
+            jobid = self.backend.submit(self.pbs_script, depend=depend)
+            lg.info('submitted %s', jobid)
+            return jobid
+        else:
+            print(str(Path(self.pbs_script).relpath()))
+
+    def run_flush(self) -> None:
+
+        if self.array is not None:
+            # add the batch as an element of the array job
+            self.array.add(self.array.no_jobs, '',
+                           '#!/bin/bash\n\n' + self.get_batch(), '')
+            self.app.array_batches.append(
+                [i for i, cores, cl, deps in self.app.cl_cache])
+            self.app.cl_cache = []
+            return
+
+        self.write_script(self.get_batch())
+        batch = [i for i, cores, cl, deps in self.app.cl_cache]
+        depend = self.get_depend()
+        self.app.cl_cache = []
+        self.record_submitted(batch, self.submit(depend))
+
+    def wait_for(self, jobs) -> None:
+        """
+        Submit what is cached of this level of a tree-reduce - the next
+        level depends on the job ids
+        """
+        if len(self.app.cl_cache) > 0:
+            jobs[-1].run_flush()
+
+    def submit_all(self, jobstorun=None) -> None:
+        """
+        Expand & run all jobs (called on the parent job), then submit
+        the last batch, or the array job
+
+        :param jobstorun: max no of jobs to run - skipped jobs do not
+            count
+        """
+        # there might be no jobs at all
+        newjob = self
+        for i, newjob in enumerate(self.expand()):
+            newjob.run()
+            if newjob.skipped and jobstorun:
+                jobstorun += 1
+            if jobstorun is not None and i + 1 >= jobstorun:
+                break
+
+        # make sure the last job gets run/written as well
+        if len(self.app.cl_cache) > 0:
+            newjob.run_flush()
+
+        if self.array is not None:
+            newjob.array_flush()
+
+    def array_flush(self) -> None:
+        """
+        Submit all batches as one array job
+        """
+        self.array.close()
+        if self.array.no_jobs == 0:
+            return
+
+        self.ctx['pbs_array'] = '0-%d' % (self.array.no_jobs - 1)
+        # torque sets PBS_ARRAYID, PBS Pro PBS_ARRAY_INDEX
+        self.write_script(
+            '%s ${PBS_ARRAYID:-$PBS_ARRAY_INDEX}\n' %
+            shlex.quote(self.array.driver),
+            '%s.%s.array' % (self.ctx['template']['name'],
+                             self.ctx['stamp']))
+
+        lg.info('array job with %d elements', self.array.no_jobs)
+        jobid = self.submit()
+        if jobid is None:
+            return
+        for no, batch in enumerate(self.app.array_batches):
+            # torque: 123[].server -> 123[0].server
+            if '[]' in jobid:
+                element = jobid.replace('[]', '[%d]' % no)
+            else:
+                element = '%s[%d]' % (jobid, no)
+            self.record_submitted(batch, element)
@@ -1,10 +1,35 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
 import os
+import pickle
+import threading
+
 import leip
 
-from mad2.util import get_mad_file
+from kea3.context import Lazy
+
+lg = logging.getLogger('k3.mad')
 
 MADAPP = None
 
+#: no of threads reading mad files
+THREADS = 8
+
+#: default max no of files in the metadata cache
+CACHE_SIZE = 10000
+
+CACHE = None
+
+#: per directory mad2 configuration, applies to all files below it
+DIR_CONFIG = 'mad.config'
+
+#: mad2 user configuration
+USER_CONFIG = os.path.join(os.path.expanduser('~'), '.config', 'mad2')
+
+USER_KEY = None
+
 
 def get_mad_app():
     global MADAPP
@@ -13,19 +38,215 @@ def get_mad_app():
     return MADAPP
 
 
-@leip.hook('expanded')
-def madexpand(app, job):
+def sidecar(fname) -> str:
+    """
+    The mad file holding the metadata of fname (.<name>.mad)
+    """
+    dirname, basename = os.path.split(fname)
+    return os.path.join(dirname, '.%s.mad' % basename)
+
+
+def load_mad(fname) -> dict:
+    from mad2.util import get_mad_file
+
+    madfile = get_mad_file(get_mad_app(), fname)
+    d = {}
+    for s in madfile.stack[::-1]:
+        d.update(dict(s))
+    return d
+
+
+class MadCache:
+    """
+    LRU cache of merged mad metadata per file. An entry is valid as long
+    as the stat (mtime & size) of the file, its sidecar and the mad2
+    configuration layers above it are the same.
+    """
+
+    def __init__(self, size=CACHE_SIZE, filename=None):
+        """
+        :param size: max no of files to cache
+        :param filename: pickle to load the cache from & save it to
+        """
+        self.size = size
+        self.filename = filename
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self._lock = threading.Lock()
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, 'rb') as F:
+                    self.data.update(pickle.load(F))
+            except Exception as e:
+                lg.warning("ignoring mad cache %s: %s", filename, e)
+            self._trim()
+
+    def _trim(self):
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def get(self, fname, key):
+        with self._lock:
+            item = self.data.get(fname)
+            if item is not None and item[0] == key:
+                self.data.move_to_end(fname)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            return None
+
+    def put(self, fname, key, value):
+        with self._lock:
+            self.data[fname] = (key, value)
+            self.data.move_to_end(fname)
+            self.dirty = True
+            self._trim()
+
+    def save(self):
+        if self.filename is None or not self.dirty:
+            return
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        with self._lock:
+            with open(tmp, 'wb') as F:
+                pickle.dump(self.data, F, pickle.HIGHEST_PROTOCOL)
+            self.dirty = False
+        os.replace(tmp, self.filename)
+
+
+def get_cache(app, job) -> MadCache:
+    global CACHE
+    if CACHE is None:
+        conf = app.conf['plugin']['mad_metadata']
+        filename = None
+        if conf.get('disk_cache', True) and not job.transient:
+            filename = str(job.workdir / 'mad.cache')
+        CACHE = MadCache(int(conf.get('cache_size', CACHE_SIZE)), filename)
+    return CACHE
+
+
+def dir_configs(fname) -> list:
+    """
+    The mad2 directory configuration files that apply to fname
+    """
+    rv = []
+    dirname = os.path.dirname(os.path.abspath(fname))
+    while True:
+        rv.append(os.path.join(dirname, DIR_CONFIG))
+        parent = os.path.dirname(dirname)
+        if parent == dirname:
+            return rv
+        dirname = parent
+
+
+def _st(st):
+    return None if st is None else (st.st_mtime_ns, st.st_size)
+
+
+def _user_key():
+    global USER_KEY
+    if USER_KEY is None:
+        try:
+            names = sorted(os.listdir(USER_CONFIG))
+        except OSError:
+            names = []
+        USER_KEY = tuple(
+            (name, _st(os.stat(os.path.join(USER_CONFIG, name))))
+            for name in names)
+    return USER_KEY
+
+
+def _stat_key(stats, fname):
+    st = stats.stat(fname)
+    return (st.st_mtime_ns, st.st_size, _st(stats.stat(sidecar(fname))),
+            tuple(_st(stats.stat(c)) for c in dir_configs(fname)),
+            _user_key())
+
+
+def lazy_mad(app, job, ctx) -> dict:
+    """
+    Return the mad metadata of the io files of one job (ctx)
+    """
+    cache = get_cache(app, job)
+    rv = {}
     for io in job.data['io']:
-        iname = io['name']
-        fname = job.ctx[iname]
-        if not isinstance(fname, str):
+        fname = ctx[io['name']]
+        if not isinstance(fname, str) or not job.stats.exists(fname):
             continue
-        if os.path.exists(fname):
-            madfile = get_mad_file(get_mad_app(), fname)
-            d = {}
-            for s in madfile.stack[::-1]:
-                d.update(dict(s))
+        job.stats.prefetch([sidecar(fname)] + dir_configs(fname))
+        key = _stat_key(job.stats, fname)
+        value = cache.get(fname, key)
+        if value is None:
+            value = load_mad(fname)
+            cache.put(fname, key, value)
+        rv[io['name']] = dict(value)
+    return rv
+
+
+@leip.hook('context')
+def madcontext(app, job):
+    """
+    If the templates do not use the mad metadata, only load it for jobs
+    where it is accessed
+    """
+    if not job.uses('mad'):
+        job.ctx['mad'] = Lazy(partial(lazy_mad, app, job))
+
+
+@leip.hook('expanded_batch')
+def madexpand(app, jobs):
+    """
+    Load the mad metadata of the input & output files of a chunk of jobs
+    - from the cache if unchanged, otherwise concurrently, every file once
+    """
+    if not jobs[0].uses('mad'):
+        return
+
+    files = {}
+    for job in jobs:
+        for io in job.data['io']:
+            fname = job.ctx[io['name']]
+            if not isinstance(fname, str):
+                continue
+            # file metadata is prefetched for the chunk
+            if job.stats.exists(fname):
+                files.setdefault(fname, []).append((job, io['name']))
+    if not files:
+        return
+
+    stats = jobs[0].stats
+    stats.prefetch(set(sidecar(f) for f in files).union(
+        *(dir_configs(f) for f in files)))
+    cache = get_cache(app, jobs[0])
+
+    metadata = {}
+    todo = {}
+    for fname in files:
+        key = _stat_key(stats, fname)
+        value = cache.get(fname, key)
+        if value is None:
+            todo[fname] = key
+        else:
+            metadata[fname] = value
+
+    if todo:
+        get_mad_app()
+        with ThreadPoolExecutor(THREADS) as pool:
+            for fname, value in zip(todo, pool.map(load_mad, todo)):
+                cache.put(fname, todo[fname], value)
+                metadata[fname] = value
+
+    for fname, refs in files.items():
+        for job, iname in refs:
             if not 'mad' in job.ctx:
                 job.ctx['mad'] = {}
-            job.ctx['mad'][iname] = d
-#    print(job.ctx)
+            job.ctx['mad'][iname] = dict(metadata[fname])
+
+
+@leip.hook('finish')
+def madfinish(app, job):
+    if CACHE is None:
+        return
+    lg.info("mad cache: %d hits, %d misses", CACHE.hits, CACHE.misses)
+    CACHE.save()
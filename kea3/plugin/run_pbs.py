@@ -1,99 +1,28 @@
 import argparse
 import logging
-import os
 import sys
 
-import jinja2
-from path import Path
 # from xtermcolor import colorize as cz
 
 import leip
 
-from kea3.job import K3Job
+from kea3.backend import BACKENDS
 
 lg = logging.getLogger('k3.run')
 
 TEMPLATE = None
-PBS_SUBMIT_SCRIPT_HEADER = """
-#PBS -N {{ job_id }}
-#PBS -S /bin/bash
-#PBS -e {{ pbs_dir }}/{{ job_id }}.$PBS_JOBID.err
-#PBS -o {{ pbs_dir }}/{{ job_id }}.$PBS_JOBID.out
-#PBS -l walltime={{ pbs.walltime }}:00:00
-#PBS -A {{ pbs.group }}{% if pbs.nodes %}
-#PBS -l nodes={{pbs.nodes}}
-    {%- if pbs.ppn %}:ppn={{pbs.ppn}}{% endif %}{% endif %}{%if pbs.mem %}
-#PBS -l mem={{ pbs.mem }}{% endif %}
 
-### this script is autogenerated by k3
+# names that used to live here - imported on first access
+_MOVED = {'K3JobPbs': 'kea3.pbsjob',
+          'PBS_SUBMIT_SCRIPT_HEADER': 'kea3.backend'}
 
-### Display the job context
-echo Running on host `hostname`
-echo Time is `date`
-echo Directory is `pwd`
-echo Using ${NPROCS} processors across ${NNODES} nodes
 
-set -v  # verbose output
-set -e  # catch errors
-
-{% if pyenv %}
-#load python virtual environment
-source {{ pyenv }}/bin/activate
-{% endif %}
-
-# make sure we're in the work directory
-cd {{ cwd }}
-
-## Starting jobs ({{ pbs.get('jobs_per_node', 1) }} per node)
-
-""".lstrip()
-
-
-class K3JobPbs(K3Job):
-    def executor(self, cl: list) -> None:
-        """
-        execute a pbs job
-        """
-
-        self.app.cl_cache.append(cl)
-        if len(self.app.cl_cache) >= self.ctx['pbs'].get('jobs_per_node', 1):
-            self.run_flush()
-
-    def get_header(self) -> str:
-
-        self.ctx['cwd'] = os.getcwd()
-        jobid = '%s.%s.%s' % (self.ctx['template']['name'], self.ctx['stamp'],
-                              self.ctx['i'])
-
-        self.ctx['job_id'] = jobid
-
-        lg.info('pbs submit job: %s', jobid)
-
-        self.pbs_script = self.ctx['pbs_dir'] / ('%s.qsub' %
-                                                 self.ctx['job_id'])
-
-        script = jinja2.Template(PBS_SUBMIT_SCRIPT_HEADER).render(self.ctx)
-        return script
-
-    def run_flush(self) -> None:
-
-        script = self.get_header()
-
-        for j in self.app.cl_cache:
-            script += '(  '
-            script += '\n   '.join(j)
-            script += ' ) & \n\n'
-
-        script += "wait\n\n"
-
-        with open(self.pbs_script, 'w') as F:
-            F.write(script)
-
-        self.app.cl_cache = []
-        if self.app.trans['args'].qsub:
-            os.system('qsub %s' % self.pbs_script)
-        else:
-            print(str(Path(self.pbs_script).relpath()))
+def __getattr__(name):
+    if name not in _MOVED:
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+    import importlib
+    return getattr(importlib.import_module(_MOVED[name]), name)
 
 
 @leip.arg('arguments', nargs=argparse.REMAINDER)
@@ -101,10 +30,13 @@ class K3JobPbs(K3Job):
 @leip.flag('-q', '--qsub', help='actually qsub - otherwise write script files')
 @leip.flag(
     '-B', '--always_run', dest='force', help='force run, regardless of checks')
+@leip.flag('--recheck', help='check all jobs, also those completed ' +
+           'earlier with unchanged files')
 @leip.arg('-n', '--jobstorun', help='no of jobs to run', type=int)
 @leip.arg('-j',
           '--jobs-per-node',
-          help='no of jobs to run in parallel per pbs job',
+          help='no of jobs per pbs job - these run with at most ' +
+          'ppn cores in use',
           type=int)
 @leip.arg('-A', '--group', help='group to take pbs credits from')
 @leip.arg('-W', '--walltime', help='walltime for the job (hours)')
@@ -115,9 +47,26 @@ class K3JobPbs(K3Job):
           type=int,
           default=1)
 @leip.arg('-P', '--ppn', help='no of nodes for the pbs job', type=int)
+@leip.flag('--packed', help='write all job scripts into a single pack ' +
+           'file, run by one driver script')
+@leip.flag('--array', help='submit all batches of jobs as a single ' +
+           'array job')
+@leip.arg('--backend', choices=sorted(BACKENDS),
+          help='cluster backend (default: pbs) - "emulate" runs the ' +
+          'submitted scripts locally')
+@leip.arg('--slots', type=int,
+          help='no of slots of the local emulator (default: no of cores)')
+@leip.arg('--profile', metavar='FILE',
+          help='time all phases & hooks, write a chrome trace to FILE')
 @leip.arg('template')
 @leip.command
 def pbs(app, args):
+    # imported here, so k3 starts fast when not running pbs
+    from kea3.backend import get_backend
+    from kea3.job import get_stamp
+    from kea3.pack import K3ScriptPack
+    from kea3.pbsjob import K3JobPbs
+    from kea3.profiler import K3Profiler
 
     # first - maintain a run.sh script
     if ('-h' not in sys.argv) and ('--help' not in sys.argv):
@@ -125,8 +74,17 @@ def pbs(app, args):
             F.write('# %s\n' % " ".join(sys.argv))
 
     job = K3JobPbs(app, args, args.template, args.arguments)
+    if args.profile:
+        job.profiler = K3Profiler()
+        job.profiler.attach(app)
     app.cl_cache = []
+    app.array_batches = []
+    # job i -> id of the submitted batch, for dependencies
+    app.pbs_ids = {}
     job.prepare()
+    job.prepare_runstate()
+    if args.packed:
+        job.prepare_pack()
 
     pbs_dir = (job.workdir / 'pbs').abspath()
     pbs_dir.makedirs_p()
@@ -151,16 +109,22 @@ def pbs(app, args):
         if v is not None:
             job.ctx['pbs'][k] = v
 
+    backend = args.backend or job.ctx['pbs'].get('backend', 'pbs')
+    job.backend = get_backend(backend, **(
+        {'slots': args.slots} if backend == 'emulate' else {}))
+
+    if args.array:
+        if job.data.get('mode') == 'tree-reduce':
+            lg.error("--array cannot be used in tree-reduce mode")
+            exit(-1)
+        job.array = K3ScriptPack(pbs_dir, job.name + '.array', get_stamp())
+
     # expand - generate a subjob for possible io/globs
-    jobstorun = args.jobstorun
-
-    for i, newjob in enumerate(job.expand()):
-        newjob.run()
-        if newjob.skipped and jobstorun:
-            jobstorun += 1
-        if jobstorun is not None and i + 1 >= jobstorun:
-            break
-
-    # make sure the last job gets run/written as well
-    if len(app.cl_cache) > 0:
-        newjob.run_flush()
+    job.submit_all(args.jobstorun)
+
+    job.backend.close()
+
+    with job.profiler.phase('finish'):
+        job.finish()
+    if args.profile:
+        job.profiler.report(args.profile)
@@ -3,14 +3,26 @@ import sys
 import argparse
 import logging
 import leip
-from xtermcolor import colorize as cz
 
-from kea3.job import K3Job
+# the job machinery (jinja2, fantail, asyncio, sqlite3 ...) is imported
+# by the commands that need it, so k3 starts fast
 
 lg = logging.getLogger('k3.run')
 
 TEMPLATE = None
 
+
+def resource_arg(value) -> tuple:
+    """
+    Type of the -R argument: name=amount
+    """
+    from kea3.scheduler import parse_resource
+    try:
+        return parse_resource(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
 @leip.arg('arguments', nargs=argparse.REMAINDER)
 @leip.arg('-n', '--jobstorun', help='no of jobs to run', type=int)
 @leip.arg('-j',
@@ -18,9 +30,19 @@ TEMPLATE = None
           help='no of jobs to run in parallel',
           type=int,
           default=1)
+@leip.arg('-R', '--resource', action='append', type=resource_arg,
+          help='resource capacity for -j, e.g. -R mem=64G -R io=2')
+@leip.flag('-a', '--asyncio', help='run jobs on an asyncio event loop, ' +
+           'output goes to log files in k3/<name>/script')
+@leip.arg('-T', '--timeout', type=float,
+          help='kill jobs running longer than this (seconds, with -a)')
+@leip.flag('--packed', help='write all job scripts into a single pack ' +
+           'file, run by one driver script')
 @leip.flag('-d', '--dryrun', help='do not run')
 @leip.flag(
     '-B', '--always_run', dest='force', help='force run, regardless of checks')
+@leip.arg('--profile', metavar='FILE',
+          help='time all phases & hooks, write a chrome trace to FILE')
 @leip.arg('template')
 @leip.command
 def t(app, args):
@@ -35,13 +57,28 @@ def t(app, args):
           help='no of jobs to run in parallel',
           type=int,
           default=1)
+@leip.arg('-R', '--resource', action='append', type=resource_arg,
+          help='resource capacity for -j, e.g. -R mem=64G -R io=2')
+@leip.flag('-a', '--asyncio', help='run jobs on an asyncio event loop, ' +
+           'output goes to log files in k3/<name>/script')
+@leip.arg('-T', '--timeout', type=float,
+          help='kill jobs running longer than this (seconds, with -a)')
+@leip.flag('--packed', help='write all job scripts into a single pack ' +
+           'file, run by one driver script')
 @leip.flag('-d', '--dryrun', help='do not run')
 @leip.flag('-t', '--transient', help='do not copy the template')
 @leip.flag(
     '-B', '--always_run', dest='force', help='force run, regardless of checks')
+@leip.flag('--recheck', help='check all jobs, also those completed ' +
+           'earlier with unchanged files')
+@leip.arg('--profile', metavar='FILE',
+          help='time all phases & hooks, write a chrome trace to FILE')
 @leip.arg('template')
 @leip.command
 def run(app, args):
+    from kea3.job import K3Job
+    from kea3.profiler import K3Profiler
+    from kea3.scheduler import K3Scheduler, machine_capacity
 
     # first - maintain a run.sh script
     if ('-h' not in sys.argv) and ('--help' not in sys.argv):
@@ -50,35 +87,68 @@ def run(app, args):
 
     job = K3Job(app, args, args.template, args.arguments,
                 transient = args.transient)
+    if args.profile:
+        job.profiler = K3Profiler()
+        job.profiler.attach(app)
 
     job.prepare()
+    job.prepare_runstate()
+    if args.packed:
+        job.prepare_pack()
 
     # expand - generate a subjob for possible io/globs
     jobstorun = args.jobstorun
 
-    if args.threads == 1:
+    resources = dict(app.conf.get('resources', {}))
+    resources.update(args.resource or [])
+
+    if args.asyncio:
+        # all jobs run as subprocesses of one event loop, -j limits the
+        # no of jobs running at the same time
+        from kea3.aexec import K3AsyncExecutor
+
+        scheduler = K3Scheduler(machine_capacity(args.threads, resources))
+        job.aexec = K3AsyncExecutor(scheduler)
+        job.barrier = job.aexec.join
+        for i, newjob in enumerate(job.expand()):
+            if jobstorun is not None and i >= jobstorun:
+                break
+            newjob.run()
+    elif args.threads == 1:
         for i, newjob in enumerate(job.expand()):
             if jobstorun is not None and i >= jobstorun:
                 break
             newjob.run()
     else:
-        import multiprocessing.dummy as mp
-        import itertools
-
-        def _runner(runjob):
-            runjob.run()
+        # pack the jobs against the machine capacity - expansion
+        # blocks while the machine is full
+        capacity = machine_capacity(args.threads, resources)
+        lg.info("local capacity: %s", capacity)
+        scheduler = K3Scheduler(capacity)
+        job.barrier = scheduler.join
+        for i, newjob in enumerate(job.expand()):
+            if jobstorun is not None and i >= jobstorun:
+                break
+            scheduler.submit(newjob.run, newjob.resources())
+        scheduler.join()
 
-        p = mp.Pool(args.threads)
-        if jobstorun is not None:
-            p.map(_runner, itertools.islice(job.expand(), jobstorun))
-        else:
-            p.map(_runner, job.expand())
+    with job.profiler.phase('finish'):
+        job.finish()
+    if args.profile:
+        job.profiler.report(args.profile)
 
 
 @leip.flag('-r', '--raw')
+@leip.arg('-p', '--packed-job', type=int,
+          help='show the scripts of this job from the latest pack')
 @leip.arg('template', default='.', nargs='?')
 @leip.commandName('show')
 def k3_show(app, args):
+    from xtermcolor import colorize as cz
+
+    from kea3.job import K3Job
+    from kea3.pack import read_index, read_job
+
     job = K3Job(app, args, args.template)
     job.get_template()
     job.load_template()
@@ -87,6 +157,21 @@ def k3_show(app, args):
         print(job.data.pretty())
         return
 
+    script_dir = job.workdir / 'script'
+    packs = sorted(script_dir.files('*.pack.tsv')) \
+        if script_dir.exists() else []
+
+    if args.packed_job is not None:
+        if not packs:
+            lg.error("no packed jobs found")
+            exit(-1)
+        scripts = read_job(packs[-1], args.packed_job)
+        for name in ('prolog', 'main', 'epilog'):
+            if scripts[name]:
+                print(cz(('-' * 30 + name + '-' * 30), ansi=242))
+                print(scripts[name])
+        return
+
     c_green = 106
     c_red = 160
     c_blue = 26
@@ -112,10 +197,93 @@ def k3_show(app, args):
         print('- %s: %s%s' % (cz(par['name'], ansi=c_blue),
                               par.get('default', '<none>'), nof))
 
+    if packs:
+        print(cz('packs:', ansi=c_red))
+        for index in packs:
+            header, rows = read_index(index)
+            print('- %s (#%d)' % (cz(index.basename().replace('.tsv', ''),
+                                     ansi=c_blue), len(rows)))
+
     print(cz(('-' * 30 + 'template' + '-' * 30), ansi=c_grey))
     print(job.data['template'])
 
 
+@leip.arg('-n', '--failures', type=int, default=20,
+          help='max no of failed jobs to list')
+@leip.arg('-r', '--run', help='run to report on (default: the latest)')
+@leip.flag('-l', '--list', help='list all runs')
+@leip.arg('template', default='.', nargs='?')
+@leip.commandName('status')
+def k3_status(app, args):
+    """
+    Report on the progress of a run & list failed jobs
+    """
+    from xtermcolor import colorize as cz
+
+    from kea3.job import K3Job
+    from kea3 import runstate
+
+    job = K3Job(app, args, args.template)
+    job.get_template()
+
+    db = runstate.open_db(job.workdir / 'runstate.db')
+    if db is None:
+        lg.error("no runs recorded for %s", job.name)
+        exit(-1)
+
+    c_green = 106
+    c_red = 160
+    c_blue = 26
+
+    if args.list:
+        for run_id, started, command in runstate.runs(db):
+            print('%s %s' % (cz(run_id, ansi=c_blue), command))
+        return
+
+    if args.run:
+        run_id = args.run
+        command = dict((r[0], r[2]) for r in runstate.runs(db)).get(run_id)
+        if command is None:
+            lg.error("no run %s", run_id)
+            exit(-1)
+    else:
+        run_id, started, command = runstate.runs(db)[0]
+
+    # jobs submitted to a cluster report back through rc files
+    status = None
+    backend = job.data.get('pbs', {}).get('backend') or \
+        app.conf['pbs'].get('backend', 'pbs')
+    if backend != 'emulate':
+        from kea3.backend import get_backend
+        status = get_backend(backend).status
+    try:
+        runstate.update_submitted(db, job.workdir / 'runstate.db', run_id,
+                                  status)
+    except OSError as e:
+        lg.warning("cannot get the state of submitted jobs: %s", e)
+        runstate.update_submitted(db, job.workdir / 'runstate.db', run_id)
+
+    print(cz('run:', ansi=c_red), end=" ")
+    print(cz(run_id, ansi=c_green), command)
+
+    counts = runstate.summary(db, run_id)
+    total = sum(counts.values())
+    for state in runstate.STATES:
+        if counts.get(state):
+            print('- %-10s %8d (%5.1f%%)' % (state, counts[state],
+                                             100. * counts[state] / total))
+    print('- %-10s %8d' % ('total', total))
+
+    failed = runstate.failures(db, run_id, args.failures)
+    if failed:
+        print(cz('failed:', ansi=c_red))
+        for i, stamp, rc, pbs_id in failed:
+            print('- job %s: rc %s%s' % (cz(str(i), ansi=c_blue), rc,
+                                        ' (%s)' % pbs_id if pbs_id else ''))
+        if counts.get('failed', 0) > len(failed):
+            print('  ... and %d more' % (counts['failed'] - len(failed)))
+
+
 @leip.arg('template')
 @leip.commandName('update')
 def k3_update(app, args):
@@ -130,6 +298,8 @@ def k3_update(app, args):
 @leip.arg('key')
 @leip.commandName('set')
 def k3_set(app, args):
+    from kea3.job import K3Job
+
     job = K3Job(app, args)
     job.prepare()
     # see if this is in io or parmeters
@@ -1,15 +1,38 @@
 #  -*- coding: utf-8 -*-
 """
 Manage transactions
+
+Transactions (`mad ta add` command lines) are recorded in a journal,
+k3/<name>/transactions.jsonl (also for transient runs, so they are
+retried), and committed in bulk when all jobs are done:
+
+- save mode: all are appended to mad.transaction.sh in one write
+- run mode: all run in one shell session
+
+Jobs submitted with k3 pbs (in run mode) still save their transaction
+from their epilog, on the node.
 """
 
+import atexit
 import logging
+import os
+import shlex
 import subprocess as sp
 
 import leip
+from path import Path
 
 lg = logging.getLogger(__name__)
 
+#: file transactions are saved to in save mode
+TRANSACTION_FILE = 'mad.transaction.sh'
+
+JOURNAL = None
+
+
+class K3TransactionError(Exception):
+    pass
+
 
 @leip.hook('prepare', 5)
 def prep_transact(app):
@@ -33,12 +56,39 @@ def prep_transact(app):
             help="skip saving transcation")
 
 
+def get_mode(app) -> str:
+    return app.conf['plugin']['transact'].get('run_or_save', 'save')
+
+
+def journal_dir(job) -> Path:
+    """
+    Directory of the journal - not the workdir, which is a scratch
+    workspace for transient runs, cleaned up eventually
+    """
+    rv = Path('./k3') / job.name
+    rv.makedirs_p()
+    return rv
+
+
+def get_journal(job):
+    global JOURNAL
+    if JOURNAL is None:
+        from kea3.journal import K3Journal
+        JOURNAL = K3Journal(journal_dir(job) / 'transactions.jsonl')
+        # also when k3 crashes or is interrupted - transactions that are
+        # still buffered are committed next time
+        atexit.register(JOURNAL.close)
+    return JOURNAL
+
+
+def transaction_id(job) -> str:
+    return '%s.%d:%s' % (job.ctx['stamp'], os.getpid(), job.ctx['i'])
+
+
 def save_transaction(job):
     """ save transaction """
-    cl = get_transaction_cl()
-    lg.info("save transaction")
-    print(job.conf)
-    #sp.call(cl, shell=True)
+    lg.debug("save transaction")
+    get_journal(job).add(transaction_id(job), cl=get_transaction_cl(job))
 
 
 def get_transaction_cl(job) -> str:
@@ -64,24 +114,72 @@ def get_transaction_cl(job) -> str:
     return " ".join(cl)
 
 
+def commit_save(token, records, retry):
+    """
+    Append transactions to mad.transaction.sh, in one write
+    """
+    marker = '# k3 transactions %s' % token
+    if retry and os.path.exists(TRANSACTION_FILE):
+        with open(TRANSACTION_FILE) as F:
+            if any(line.rstrip('\n') == marker for line in F):
+                return
+    with open(TRANSACTION_FILE, 'a') as F:
+        F.write('\n%s\n%s\n' % (marker, '\n'.join(r['cl'] for r in records)))
+
+
+def commit_run(workdir, token, records, retry):
+    """
+    Run all transactions in one shell session - every transaction that
+    got through is listed in a .done file, so a retry skips it
+    """
+    script = workdir / ('transactions.%s.sh' % token)
+    done_file = workdir / ('transactions.%s.done' % token)
+    done = set()
+    if retry and done_file.exists():
+        done = set(done_file.lines(retain=False))
+
+    with open(script, 'w') as F:
+        F.write('#!/bin/bash\n\n')
+        for record in records:
+            if record['id'] not in done:
+                F.write('%s && echo %s >> %s\n' % (
+                    record['cl'], shlex.quote(record['id']),
+                    shlex.quote(str(done_file))))
+    rc = sp.call(['bash', str(script)])
+    # the exit status is that of the last line only - check that every
+    # transaction got through
+    if done_file.exists():
+        done |= set(done_file.lines(retain=False))
+    missing = [r['id'] for r in records if r['id'] not in done]
+    if rc != 0 or missing:
+        raise K3TransactionError('saving %d transaction(s) failed, see %s'
+                                 % (len(missing), script))
+    script.remove_p()
+    done_file.remove_p()
+
+
 @leip.hook('pre_run')
 def add_ta_to_epilog(app, job):
-    mode = app.conf['plugin']['transact'].get('run_or_save', 'save')
-    tacl = get_transaction_cl(job)
-    if mode == 'run':
-        if not app.trans['args'].sts:
-            job.ctx['epilog'].append(tacl)
+    if app.trans['args'].sts:
+        return
+    mode = get_mode(app)
+    if mode == 'run' and getattr(job, 'backend', None) is not None:
+        # runs elsewhere - save the transaction when the job is done
+        job.ctx['epilog'].append(get_transaction_cl(job))
     elif mode == 'save':
-        with open('mad.transaction.sh', 'a') as F:
-            F.write("\n" + tacl + "\n")
+        save_transaction(job)
+        # to disk before the job runs - atexit does not run when k3 is
+        # killed
+        get_journal(job).flush(sync=False)
 
 
 @leip.hook('skip_run')
 def skiprun(app, job):
     # save transaction if fts is specified
     job.save_scripts()
-    if app.trans['args'].fts:
+    if app.trans['args'].fts and get_mode(app) == 'run':
         save_transaction(job)
+        get_journal(job).flush(sync=False)
 
 
 @leip.hook('dry_run')
@@ -89,9 +187,33 @@ def dryrun(app, job):
     skiprun(app, job)
 
 
-@leip.hook('post_run')
-def postrun(app, job):
-    # save transaction
-    if not app.trans['args'].sts:
-        pass
-        #save_transaction(job)
+@leip.hook('post_run_batch')
+def postrun(app, jobs):
+    # save the transactions of jobs that ran here
+    if get_mode(app) == 'run' and not app.trans['args'].sts:
+        for job in jobs:
+            save_transaction(job)
+        get_journal(jobs[0]).flush(sync=False)
+
+
+@leip.hook('finish')
+def commit_transactions(app, job):
+    global JOURNAL
+    if JOURNAL is None:
+        return
+    if get_mode(app) == 'run':
+        workdir = journal_dir(job)
+
+        def _commit(token, records, retry):
+            commit_run(workdir, token, records, retry)
+    else:
+        _commit = commit_save
+    try:
+        done = JOURNAL.commit(_commit)
+        lg.info("committed %d transaction(s)", done)
+    except K3TransactionError as e:
+        # the journal keeps them - retried the next run
+        lg.error("%s - kept, to retry the next time k3 runs", e)
+    finally:
+        JOURNAL.close()
+        JOURNAL = None
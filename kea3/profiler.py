@@ -0,0 +1,196 @@
+"""
+Phase profiler.
+
+Times the phases of a k3 invocation (loading the template, expansion,
+rendering, checks, writing scripts, execution) and every hook, with
+the time spent in each plugin function. Events are written as a
+Chrome trace (open in chrome://tracing or https://ui.perfetto.dev),
+and summarised in a table.
+
+Profiling is off by default: jobs then use NO_PROFILER, which returns
+a shared no-op context manager & leaves the hooks alone.
+"""
+
+from contextlib import nullcontext
+import functools
+import json
+import logging
+import os
+import threading
+from time import perf_counter
+
+lg = logging.getLogger('k3.profiler')
+
+_NULL = nullcontext()
+
+
+class _NoProfiler:
+    """
+    Profiler that does nothing
+    """
+    enabled = False
+
+    def phase(self, name):
+        return _NULL
+
+    def iterate(self, name, iterable):
+        return iterable
+
+
+NO_PROFILER = _NoProfiler()
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, 'phase', self.start,
+                          perf_counter() - self.start)
+
+
+class K3Profiler:
+    enabled = True
+
+    def __init__(self):
+        self.t0 = perf_counter()
+        # (name, category, start, duration, thread id)
+        self.events = []
+        self._app = None
+        self._hooks = None
+
+    def add(self, name, cat, start, duration):
+        self.events.append((name, cat, start, duration,
+                            threading.get_ident()))
+
+    def phase(self, name):
+        """
+        Context manager timing a phase
+        """
+        return _Phase(self, name)
+
+    def iterate(self, name, iterable):
+        """
+        Time the production of each item of an iterable (e.g. a lazy
+        expansion), excluding the time spent by the consumer
+        """
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, 'phase', start, perf_counter() - start)
+                return
+            self.add(name, 'phase', start, perf_counter() - start)
+            yield item
+
+    def _wrap(self, function):
+        """
+        Return function, timed as a plugin function - in whatever thread
+        it is called
+        """
+        if not callable(function):
+            return function
+        name = '%s.%s' % (getattr(function, '__module__', None),
+                          getattr(function, '__name__', function))
+
+        @functools.wraps(function)
+        def _timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, 'plugin', start, perf_counter() - start)
+        return _timed
+
+    def attach(self, app):
+        """
+        Time all hooks run by app, attributing the time to the plugin
+        functions called
+        """
+        run_hook = app.run_hook
+
+        def _run_hook(name, *args, **kwargs):
+            start = perf_counter()
+            try:
+                return run_hook(name, *args, **kwargs)
+            finally:
+                self.add('hook:%s' % name, 'hook', start,
+                         perf_counter() - start)
+
+        app.run_hook = _run_hook
+        self._app = app
+
+        # wrap the registered hook functions (leip keeps them, possibly
+        # with their priority, in a list per hook)
+        hooks = getattr(app, 'hooks', None)
+        if isinstance(hooks, dict):
+            self._hooks = dict((name, list(items))
+                               for name, items in hooks.items())
+            for name, items in hooks.items():
+                items[:] = [
+                    tuple(self._wrap(x) for x in item)
+                    if isinstance(item, tuple) else self._wrap(item)
+                    for item in items]
+        else:
+            lg.warning("cannot find the hooks of %s - plugin functions "
+                       "are not timed", app)
+
+    def detach(self):
+        if self._app is not None:
+            del self._app.run_hook
+            if self._hooks is not None:
+                for name, items in self._hooks.items():
+                    self._app.hooks[name][:] = items
+                self._hooks = None
+            self._app = None
+
+    def trace(self) -> dict:
+        """
+        Return the events in Chrome trace format
+        """
+        pid = os.getpid()
+        return {
+            'displayTimeUnit': 'ms',
+            'traceEvents': [
+                {'name': name, 'cat': cat, 'ph': 'X', 'pid': pid,
+                 'tid': tid, 'ts': (start - self.t0) * 1e6,
+                 'dur': duration * 1e6}
+                for name, cat, start, duration, tid in self.events]}
+
+    def summary(self) -> list:
+        """
+        Return (category, name, count, total, max) per phase, hook &
+        plugin function, slowest first
+        """
+        stats = {}
+        for name, cat, start, duration, tid in self.events:
+            key = (cat, name)
+            count, total, longest = stats.get(key, (0, 0., 0.))
+            stats[key] = (count + 1, total + duration,
+                          max(longest, duration))
+        return sorted((k + v for k, v in stats.items()),
+                      key=lambda x: -x[3])
+
+    def report(self, path):
+        """
+        Write the trace to path & print a summary
+        """
+        self.detach()
+        with open(path, 'w') as F:
+            json.dump(self.trace(), F)
+        lg.info("wrote profile to %s", path)
+
+        print('%-8s %-40s %9s %10s %10s %10s' % (
+            'type', 'name', 'count', 'total(s)', 'mean(ms)', 'max(ms)'))
+        for cat, name, count, total, longest in self.summary():
+            print('%-8s %-40s %9d %10.3f %10.3f %10.3f' % (
+                cat, name, count, total, 1000 * total / count,
+                1000 * longest))
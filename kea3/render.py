@@ -0,0 +1,126 @@
+"""
+Template rendering for k3 jobs.
+
+One K3Renderer is created by the parent job and shared (by reference)
+with all expanded jobs, so every template is compiled once per
+invocation. Compiled bytecode is persisted in the job workdir so that
+repeat invocations skip compilation as well.
+
+Templates are rendered without copying the context: only the variables
+a template uses are looked up, so lazy context values that are not
+referenced are never evaluated.
+"""
+
+from collections import ChainMap
+import logging
+
+import jinja2
+import jinja2.meta
+
+lg = logging.getLogger('k3.render')
+
+#: max no of compiled template strings to keep around
+STRING_CACHE_SIZE = 10000
+
+
+class K3Renderer:
+    def __init__(self, cache_dir=None, undefined=jinja2.Undefined):
+        """
+        :param cache_dir: directory for the jinja2 bytecode cache - no
+                          on-disk cache if None
+        :param undefined: jinja2 undefined class
+        """
+        self.sources = {}
+        self._compiled = {}
+        self._strings = {}
+        self._variables = {}
+
+        bytecode_cache = None
+        if cache_dir is not None:
+            cache_dir.makedirs_p()
+            bytecode_cache = jinja2.FileSystemBytecodeCache(
+                str(cache_dir), '%s.jinja.cache')
+
+        self.env = jinja2.Environment(
+            loader=jinja2.FunctionLoader(self._load),
+            bytecode_cache=bytecode_cache,
+            undefined=undefined,
+            auto_reload=False,
+            cache_size=-1)
+
+    def _load(self, name):
+        source = self.sources.get(name)
+        if source is None:
+            return None
+        # the source never changes during an invocation
+        return source, None, lambda: True
+
+    def register(self, name, source):
+        """
+        Register a named template (e.g. template, combine,
+        batch_header) - it is compiled on first use
+        """
+        if self.sources.get(name) == source:
+            return
+        self.sources[name] = source
+        self._compiled.pop(name, None)
+
+    def get(self, name):
+        """
+        Return the compiled template registered as `name`
+        """
+        template = self._compiled.get(name)
+        if template is None:
+            lg.debug("compile template %s", name)
+            template = self.env.get_template(name)
+            self._compiled[name] = template
+        return template
+
+    def _render(self, template, ctx) -> str:
+        # unlike template.render, do not copy ctx into a dict
+        try:
+            return str(template.make_module(
+                ChainMap(ctx, template.globals), shared=True))
+        except Exception:
+            # re-raised with the template lines in the traceback
+            self.env.handle_exception()
+
+    def render(self, name, ctx) -> str:
+        """
+        Render the registered template `name` with `ctx`
+        """
+        return self._render(self.get(name), ctx)
+
+    def compile_string(self, source, cache=True):
+        """
+        Compile a template string, caching the result on the source
+        """
+        template = self._strings.get(source)
+        if template is None:
+            template = self.env.from_string(source)
+            if cache:
+                if len(self._strings) >= STRING_CACHE_SIZE:
+                    self._strings.clear()
+                self._strings[source] = template
+        return template
+
+    def render_string(self, source, ctx, cache=True) -> str:
+        """
+        Render a template string. Use `cache=False` for one-off strings
+        (e.g. the output of an earlier render pass).
+        """
+        return self._render(self.compile_string(source, cache=cache), ctx)
+
+    def variables(self, source) -> frozenset:
+        """
+        Return the names of the (undeclared) variables a template string
+        refers to - cached on the source
+        """
+        names = self._variables.get(source)
+        if names is None:
+            if len(self._variables) >= STRING_CACHE_SIZE:
+                self._variables.clear()
+            names = frozenset(jinja2.meta.find_undeclared_variables(
+                self.env.parse(source)))
+            self._variables[source] = names
+        return names
@@ -0,0 +1,135 @@
+"""
+Resolve parameters that refer to each other with {{ }} references.
+
+The references between variables are read with jinja2.meta, after which
+every variable is rendered exactly once, in dependency order.
+"""
+
+from collections import ChainMap
+import logging
+
+lg = logging.getLogger('k3.resolve')
+
+# 'ignore' warnings already given - these repeat for every job
+_warned = set()
+
+
+class K3ResolveError(Exception):
+    """
+    Parameters cannot be resolved - `names` holds the culprits
+    """
+    def __init__(self, message, names):
+        super().__init__(message)
+        self.names = names
+
+
+def is_template(value) -> bool:
+    return isinstance(value, str) and ('{{' in value or '{%' in value)
+
+
+def _find_cycle(graph, nodes):
+    """
+    Return one cycle (as a list of names) in `graph` within `nodes`
+    """
+    for start in sorted(nodes):
+        path, seen = [start], {start: 0}
+        while True:
+            nxt = sorted(d for d in graph[path[-1]] if d in nodes)
+            if not nxt:
+                break
+            node = nxt[0]
+            if node in seen:
+                return path[seen[node]:] + [node]
+            seen[node] = len(path)
+            path.append(node)
+    return sorted(nodes)
+
+
+def resolve(values, renderer, context=None, missing='error') -> dict:
+    """
+    Render all template strings in `values`.
+
+    :param values: mapping name -> value, only string values containing
+                   jinja markup are rendered
+    :param renderer: K3Renderer used to analyse & render the strings
+    :param context: mapping with additional, already resolved, variables
+    :param missing: what to do with references to unknown variables:
+                    'error' - raise K3ResolveError
+                    'defer' - leave the variable (and everything depending
+                              on it) unrendered
+                    'ignore' - render anyway (unknowns render as empty)
+    :returns: dict with the rendered values (name -> rendered string)
+    :raises K3ResolveError: on circular references, or on unknown
+                            variables if missing == 'error'
+    """
+    known = ChainMap(values, context or {}, renderer.env.globals)
+
+    graph = {}
+    missing_vars = {}
+    for name, value in values.items():
+        if not is_template(value):
+            continue
+        refs = renderer.variables(value)
+        graph[name] = refs
+        unknown = [r for r in refs if r not in known]
+        if unknown:
+            missing_vars[name] = sorted(unknown)
+
+    if not graph:
+        return {}
+
+    if missing_vars:
+        description = ', '.join(
+            '%s (%s)' % (k, ', '.join(v))
+            for k, v in sorted(missing_vars.items()))
+        if missing == 'error':
+            raise K3ResolveError(
+                'unknown variables in: %s' % description,
+                sorted(missing_vars))
+        elif missing == 'defer':
+            lg.debug('cannot resolve parameters at the moment: %s',
+                     description)
+        elif description in _warned:
+            lg.debug('unknown variables in: %s', description)
+        else:
+            _warned.add(description)
+            lg.warning('unknown variables in: %s', description)
+
+    # Kahn's algorithm - only dependencies on other templated values
+    # constrain the order
+    dependents = {name: [] for name in graph}
+    indegree = {}
+    for name, refs in graph.items():
+        deps = [r for r in refs if r in graph and r != name]
+        indegree[name] = len(deps) + (1 if name in refs else 0)
+        for dep in deps:
+            dependents[dep].append(name)
+
+    ready = sorted(name for name, n in indegree.items() if n == 0)
+    order = []
+    while ready:
+        name = ready.pop()
+        order.append(name)
+        for dependent in dependents[name]:
+            indegree[dependent] -= 1
+            if indegree[dependent] == 0:
+                ready.append(dependent)
+
+    if len(order) < len(graph):
+        cycle = _find_cycle(graph, set(graph) - set(order))
+        raise K3ResolveError(
+            'circular reference between parameters: %s'
+            % ' -> '.join(cycle), sorted(set(cycle)))
+
+    rendered = {}
+    deferred = set(missing_vars) if missing == 'defer' else set()
+    render_ctx = ChainMap(rendered, values, context or {})
+    for name in order:
+        if deferred & (graph[name] | {name}):
+            deferred.add(name)
+            continue
+        rendered[name] = renderer.render_string(values[name], render_ctx)
+        lg.debug('resolved %s: %s -> %s', name, values[name],
+                 rendered[name])
+
+    return rendered
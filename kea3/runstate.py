@@ -0,0 +1,232 @@
+"""
+Run state store.
+
+Every expanded job is recorded in an SQLite database in
+k3/<name>/runstate.db: its index, stamp, state, return code, start &
+end time and (for k3 pbs) the id of the PBS job running it. Updates are
+buffered and written in batches, in one transaction, so recording does
+not slow down planning.
+
+States: planned, skipped, dryrun, running, done, failed, submitted
+
+Jobs submitted to a cluster cannot write to the database: they write
+their rc to k3/<name>/rc/<run>/<i> when done. `k3 status` moves these
+into the database, and asks the cluster about the jobs that did not
+finish yet.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+lg = logging.getLogger('k3.runstate')
+
+#: flush the buffer when it holds this many jobs...
+BATCH_SIZE = 5000
+#: ...or when the last flush is this many seconds ago
+FLUSH_INTERVAL = 2.0
+
+STATES = ('planned', 'skipped', 'dryrun', 'running', 'submitted', 'done',
+          'failed')
+
+FIELDS = ('stamp', 'state', 'rc', 'start', 'end', 'pbs_id')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY, started REAL, command TEXT);
+CREATE TABLE IF NOT EXISTS jobs (
+    run TEXT, i INTEGER, stamp TEXT, state TEXT, rc INTEGER,
+    start REAL, end REAL, pbs_id TEXT,
+    PRIMARY KEY (run, i));
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (run, state);
+"""
+
+UPSERT = """
+INSERT INTO jobs (run, i, stamp, state, rc, start, end, pbs_id)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (run, i) DO UPDATE SET
+    stamp = coalesce(excluded.stamp, stamp),
+    state = coalesce(excluded.state, state),
+    rc = coalesce(excluded.rc, rc),
+    start = coalesce(excluded.start, start),
+    end = coalesce(excluded.end, end),
+    pbs_id = coalesce(excluded.pbs_id, pbs_id)
+"""
+
+
+def connect(path) -> sqlite3.Connection:
+    db = sqlite3.connect(str(path), check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+def rc_dir(path, run) -> str:
+    """
+    Directory jobs running elsewhere (k3 pbs) write their rc to
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(str(path))), 'rc',
+                        run)
+
+
+class K3RunState:
+    def __init__(self, path, run, command=''):
+        """
+        :param path: database file
+        :param run: id of this invocation
+        :param command: command line of this invocation
+        """
+        self.path = path
+        self.run = run
+        self._db = connect(path)
+        self._lock = threading.Lock()
+        self._buffer = {}
+        self._last_flush = time.time()
+        self._rc_dir = None
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)',
+                             (run, time.time(), command))
+
+    def update(self, i, **fields):
+        """
+        Record (some of the) fields of job i
+        """
+        with self._lock:
+            self._buffer.setdefault(i, {}).update(fields)
+            if len(self._buffer) >= BATCH_SIZE or \
+                    time.time() - self._last_flush > FLUSH_INTERVAL:
+                self._flush()
+
+    def rc_file(self, i) -> str:
+        """
+        File job i writes its rc & end time to, when it runs elsewhere
+        """
+        if self._rc_dir is None:
+            self._rc_dir = rc_dir(self.path, self.run)
+            os.makedirs(self._rc_dir, exist_ok=True)
+        return os.path.join(self._rc_dir, str(i))
+
+    def _flush(self):
+        if self._buffer:
+            rows = [(self.run, i) + tuple(f.get(k) for k in FIELDS)
+                    for i, f in self._buffer.items()]
+            with self._db:
+                self._db.executemany(UPSERT, rows)
+            lg.debug("recorded the state of %d jobs", len(rows))
+            self._buffer = {}
+        self._last_flush = time.time()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.close()
+
+
+def runs(db) -> list:
+    """
+    Return (run, started, command) of all runs, latest first
+    """
+    return db.execute('SELECT run, started, command FROM runs '
+                      'ORDER BY started DESC').fetchall()
+
+
+def summary(db, run) -> dict:
+    """
+    Return the no of jobs per state of a run
+    """
+    return dict(db.execute('SELECT state, count(*) FROM jobs WHERE run = ? '
+                           'GROUP BY state', (run,)))
+
+
+def failures(db, run, limit=20) -> list:
+    """
+    Return (i, stamp, rc, pbs_id) of failed jobs of a run
+    """
+    return db.execute('SELECT i, stamp, rc, pbs_id FROM jobs '
+                      'WHERE run = ? AND state = ? ORDER BY i LIMIT ?',
+                      (run, 'failed', limit)).fetchall()
+
+
+def _read_rc(filename):
+    """
+    Return (rc, end) from an rc file, None if it is not (fully) written
+    """
+    try:
+        with open(filename) as F:
+            rc, end = F.read().split()
+        return int(rc), float(end)
+    except (OSError, ValueError):
+        return None
+
+
+def update_submitted(db, path, run, status=None) -> int:
+    """
+    Update the jobs of a run submitted to a cluster, from the rc files
+    written by the finished ones. Returns the no of jobs updated.
+
+    :param path: the database file
+    :param status: function mapping cluster job ids to their state
+                   (Q, R or C - see K3Backend.status), to find running
+                   jobs & jobs that ended without writing an rc (e.g.
+                   killed at their walltime)
+    """
+    jobs = db.execute('SELECT i, pbs_id FROM jobs WHERE run = ? AND '
+                      'state IN (?, ?) AND pbs_id IS NOT NULL',
+                      (run, 'submitted', 'running')).fetchall()
+    if not jobs:
+        return 0
+    directory = rc_dir(path, run)
+    try:
+        names = set(os.listdir(directory))
+    except OSError:
+        names = set()
+
+    def _done(i, rc, end):
+        return i, 'done' if rc == 0 else 'failed', rc, end
+
+    updates = []
+    waiting = []
+    for i, pbs_id in jobs:
+        done = _read_rc(os.path.join(directory, str(i))) \
+            if str(i) in names else None
+        if done is None:
+            waiting.append((i, pbs_id))
+        else:
+            updates.append(_done(i, *done))
+
+    if status is not None and waiting:
+        states = status(sorted(set(pbs_id for i, pbs_id in waiting)))
+        for i, pbs_id in waiting:
+            state = states.get(pbs_id)
+            if state == 'R':
+                updates.append((i, 'running', None, None))
+            elif state == 'C':
+                # it might have finished since the directory was listed
+                done = _read_rc(os.path.join(directory, str(i)))
+                if done is None:
+                    updates.append((i, 'failed', None, None))
+                else:
+                    updates.append(_done(i, *done))
+
+    with db:
+        db.executemany('UPDATE jobs SET state = ?, rc = coalesce(?, rc), '
+                       'end = coalesce(?, end) WHERE run = ? AND i = ?',
+                       [(state, rc, end, run, i)
+                        for i, state, rc, end in updates])
+    return len(updates)
+
+
+def open_db(path):
+    """
+    Open an existing run state database (None if it does not exist)
+    """
+    if not os.path.exists(path):
+        return None
+    return connect(path)
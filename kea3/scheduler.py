@@ -0,0 +1,174 @@
+"""
+Resource aware local scheduler.
+
+Jobs declare what they need in the `resources` field of the template,
+e.g.:
+
+    resources:
+      cores: 4
+      mem: 8G
+      io: 1
+
+The scheduler packs jobs against the capacity of the machine (slots,
+cores, memory & custom tokens) and never runs more than fits. Submitting
+a job blocks until it fits, so planning runs no further ahead of
+execution than the machine allows.
+"""
+
+import logging
+import os
+import re
+import threading
+
+lg = logging.getLogger('k3.scheduler')
+
+_size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+
+def parse_size(value) -> float:
+    """
+    Parse a resource amount, with an optional K/M/G/T suffix (e.g. 4G)
+    """
+    if isinstance(value, (int, float)):
+        return value
+    m = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)B?\s*$', str(value).upper())
+    if not m:
+        raise ValueError('invalid resource amount: %s' % value)
+    return float(m.group(1)) * _size_units[m.group(2)]
+
+
+def parse_cores(value, all_cores) -> int:
+    """
+    Parse a no of cores: a whole number (e.g. 2, '2' or '2.0'), or 'all'
+    for all_cores
+    """
+    if isinstance(value, str) and value.strip().lower() == 'all':
+        return all_cores
+    try:
+        cores = float(value)
+    except (TypeError, ValueError):
+        cores = 0
+    if cores < 1 or cores != int(cores):
+        raise ValueError('invalid no of cores: %r (expected a whole '
+                         'number or all)' % value)
+    return int(cores)
+
+
+def parse_resource(value) -> tuple:
+    """
+    Parse a resource capacity given as name=amount (e.g. mem=64G),
+    return (name, amount)
+    """
+    name, sep, amount = value.partition('=')
+    if not sep or not name.strip():
+        raise ValueError('expected name=amount (e.g. mem=64G), not %r'
+                         % value)
+    return name.strip(), parse_size(amount)
+
+
+def machine_capacity(slots=None, resources=None) -> dict:
+    """
+    Capacity of the local machine
+
+    :param slots: max no of jobs running at the same time
+    :param resources: dict with extra/overriding capacities
+    """
+    capacity = {'cores': os.cpu_count() or 1}
+    try:
+        capacity['mem'] = os.sysconf('SC_PAGE_SIZE') * \
+            os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        pass
+    if slots is not None:
+        capacity['slots'] = slots
+
+    for name, amount in (resources or {}).items():
+        capacity[name.strip()] = parse_size(amount)
+    return capacity
+
+
+class K3Scheduler:
+    def __init__(self, capacity):
+        self.capacity = dict(capacity)
+        self.available = dict(capacity)
+        self.running = 0
+        self.errors = 0
+        self._cond = threading.Condition()
+        self._warned = set()
+
+    def fit(self, demand) -> dict:
+        """
+        Return the demand for the resources this scheduler manages; a
+        demand larger than the capacity is reduced, so the job can run
+        (alone).
+        """
+        rv = {}
+        for name, amount in demand.items():
+            if name not in self.capacity:
+                if name not in self._warned:
+                    lg.debug("no capacity defined for %s - ignoring", name)
+                    self._warned.add(name)
+                continue
+            amount = parse_size(amount)
+            if amount > self.capacity[name]:
+                lg.warning("job requests %s %s, capacity is %s", amount,
+                           name, self.capacity[name])
+                amount = self.capacity[name]
+            rv[name] = amount
+        if 'slots' in self.capacity:
+            rv['slots'] = 1
+        return rv
+
+    def _fits(self, demand):
+        return all(self.available[k] >= v for k, v in demand.items())
+
+    def acquire(self, demand) -> dict:
+        """
+        Block until the demand fits, then reserve it. Returns the
+        reserved demand, to be released later.
+        """
+        demand = self.fit(demand)
+        with self._cond:
+            while not self._fits(demand):
+                self._cond.wait()
+            for k, v in demand.items():
+                self.available[k] -= v
+            self.running += 1
+        return demand
+
+    def release(self, demand):
+        with self._cond:
+            for k, v in demand.items():
+                self.available[k] += v
+            self.running -= 1
+            self._cond.notify_all()
+
+    def submit(self, function, demand):
+        """
+        Run function in a thread as soon as demand fits
+        """
+        reserved = self.acquire(demand)
+
+        def _run():
+            try:
+                function()
+            except Exception:
+                lg.exception("job failed")
+                with self._cond:
+                    self.errors += 1
+            finally:
+                self.release(reserved)
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+
+    def join(self):
+        """
+        Wait for all jobs to finish
+        """
+        with self._cond:
+            while self.running > 0:
+                self._cond.wait()
+        if self.errors:
+            lg.warning("%d job(s) raised an error", self.errors)
@@ -0,0 +1,211 @@
+"""
+Scratch space for transient runs (k3 t).
+
+A transient invocation gets one workspace, shared by all its jobs, in
+the scratch base directory. The base is, in order of preference:
+
+- $K3_SCRATCH - e.g. /dev/shm/k3 (tmpfs) or node local disk on a cluster
+- `scratch_dir` from the k3 configuration
+- ~/.k3
+
+When a workspace is allocated, old workspaces are removed: those older
+than `scratch_max_age` days, and then the oldest ones until all fit in
+`scratch_max_size`.
+
+An invocation holds a lock (flock) on the .k3.lock file in its
+workspace until it exits - workspaces with a held lock are never
+removed, also not by invocations on other hosts sharing the base (e.g.
+an NFS home). The size of finished workspaces is recorded in .k3.sizes
+in the base, so they are measured only once.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import tempfile
+import time
+
+from path import Path
+
+from kea3.scheduler import parse_size
+
+lg = logging.getLogger('k3.scratch')
+
+DEFAULT_BASE = '~/.k3'
+#: days
+DEFAULT_MAX_AGE = 7
+DEFAULT_MAX_SIZE = '10G'
+
+LOCK_FILE = '.k3.lock'
+SIZES_FILE = '.k3.sizes'
+
+# locks of the workspaces of this process - held until it exits
+_locks = []
+
+# k3.<host>.<pid>.<random> - or a uuid4, as used by earlier versions
+_workspace = re.compile(
+    r'^(k3\.(?P<host>[^.]+)\.(?P<pid>\d+)\.[^.]+|'
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$')
+
+
+def _hostname():
+    return socket.gethostname().split('.')[0] or 'localhost'
+
+
+def _in_use(path) -> bool:
+    """
+    Is the lock of this workspace held by a running invocation?
+    """
+    try:
+        fd = os.open(os.path.join(path, LOCK_FILE), os.O_RDONLY)
+    except OSError:
+        # no lock - a crashed, or a legacy workspace
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def _size(path) -> int:
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class K3Scratch:
+    def __init__(self, base=DEFAULT_BASE, max_age=DEFAULT_MAX_AGE,
+                 max_size=DEFAULT_MAX_SIZE):
+        """
+        :param base: directory holding the workspaces
+        :param max_age: remove workspaces older than this (days)
+        :param max_size: max total size of all workspaces
+        """
+        self.base = Path(base).expanduser()
+        self.max_age = float(max_age) * 24 * 3600
+        self.max_size = parse_size(max_size)
+
+    @classmethod
+    def from_conf(cls, conf):
+        base = os.environ.get('K3_SCRATCH') or \
+            conf.get('scratch_dir') or DEFAULT_BASE
+        return cls(base, conf.get('scratch_max_age', DEFAULT_MAX_AGE),
+                   conf.get('scratch_max_size', DEFAULT_MAX_SIZE))
+
+    def allocate(self) -> Path:
+        """
+        Clean up & create a new workspace
+        """
+        self.base.makedirs_p()
+        self.cleanup()
+        workspace = Path(tempfile.mkdtemp(
+            prefix='k3.%s.%d.' % (_hostname(), os.getpid()),
+            dir=self.base))
+        lock = open(workspace / LOCK_FILE, 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _locks.append(lock)
+        lg.debug("scratch workspace: %s", workspace)
+        return workspace
+
+    def workspaces(self) -> list:
+        """
+        Return (mtime, path, in use) of all workspaces, oldest first
+        """
+        rv = []
+        try:
+            entries = list(os.scandir(self.base))
+        except OSError:
+            return rv
+        for entry in entries:
+            match = _workspace.match(entry.name)
+            if match is None or not entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+            rv.append((mtime, entry.path, _in_use(entry.path)))
+        return sorted(rv)
+
+    def _read_sizes(self) -> dict:
+        try:
+            with open(self.base / SIZES_FILE) as F:
+                return json.load(F)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_sizes(self, sizes):
+        filename = self.base / SIZES_FILE
+        tmp = '%s.%d' % (filename, os.getpid())
+        try:
+            with open(tmp, 'w') as F:
+                json.dump(sizes, F)
+            os.replace(tmp, filename)
+        except OSError as e:
+            lg.debug("cannot write %s: %s", filename, e)
+
+    def sizes(self, workspaces) -> list:
+        """
+        Return the size of workspaces - recorded for finished ones, so
+        these are walked only once
+        """
+        recorded = self._read_sizes()
+        known = {}
+        rv = []
+        for mtime, path, in_use in workspaces:
+            name = os.path.basename(path)
+            if in_use:
+                # still growing
+                rv.append(_size(path))
+                continue
+            record = recorded.get(name)
+            if record is None or record[0] != mtime:
+                record = [mtime, _size(path)]
+            known[name] = record
+            rv.append(record[1])
+        if known != recorded:
+            self._write_sizes(known)
+        return rv
+
+    def _remove(self, path, reason):
+        lg.info("removing scratch workspace %s (%s)", path, reason)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def cleanup(self) -> int:
+        """
+        Remove workspaces that are too old, then the oldest until the
+        rest fits in max_size. Returns the no of workspaces removed.
+        """
+        removed = 0
+        cutoff = time.time() - self.max_age
+        keep = []
+        for mtime, path, in_use in self.workspaces():
+            if mtime < cutoff and not in_use:
+                self._remove(path, 'age')
+                removed += 1
+            else:
+                keep.append((mtime, path, in_use))
+
+        sizes = self.sizes(keep)
+        total = sum(sizes)
+        for (mtime, path, in_use), size in zip(keep, sizes):
+            if total <= self.max_size:
+                break
+            if in_use:
+                continue
+            self._remove(path, 'size')
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,154 @@
+"""
+Batched stat prefetch for network file systems.
+
+Checking if jobs are up to date stats every io file of every job. On
+NFS/Lustre every stat is a round trip to a metadata server. The
+K3StatCache groups the paths of a chunk of jobs per directory, lists
+each directory once with os.scandir (which tells which files exist at
+no extra cost) and stats only the files that exist - all of this on a
+thread pool, so many round trips are in flight at once. Lookups are
+then served from this snapshot.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+
+lg = logging.getLogger('k3.statcache')
+
+#: no of threads used to prefetch
+THREADS = 16
+
+
+class K3StatCache:
+    def __init__(self, threads=THREADS):
+        self.threads = threads
+        self._pool = None
+        self._lock = threading.Lock()
+        # dirname -> set of names in the directory
+        self._listings = {}
+        # path -> os.stat_result, or None if the path does not exist
+        self._stats = {}
+        # dirname -> no of times paths in it were invalidated
+        self._generation = {}
+        # syscalls that would have been made without the cache
+        self.lookups = 0
+        # syscalls actually made
+        self.syscalls = 0
+
+    @property
+    def saved(self) -> int:
+        return self.lookups - self.syscalls
+
+    def _list(self, dirname):
+        try:
+            with os.scandir(dirname or '.') as it:
+                names = set(e.name for e in it)
+        except OSError:
+            names = set()
+        return dirname, names
+
+    def _stat(self, path):
+        try:
+            return path, os.stat(path)
+        except OSError:
+            return path, None
+
+    def prefetch(self, paths):
+        """
+        Fetch the metadata of all paths, one os.scandir per directory
+        """
+        todo = {}
+        with self._lock:
+            for path in paths:
+                path = str(path)
+                if path in self._stats:
+                    continue
+                dirname, name = os.path.split(path)
+                todo.setdefault(dirname, set()).add(name)
+            # jobs finishing on other threads invalidate paths while this
+            # runs - work on a snapshot, & drop what was invalidated since
+            listings = dict((d, self._listings[d]) for d in todo
+                            if d in self._listings)
+            generation = dict((d, self._generation.get(d, 0))
+                              for d in todo)
+        if not todo:
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.threads)
+
+        to_list = [d for d in todo if d not in listings]
+        listings.update(self._pool.map(self._list, to_list))
+
+        to_stat = []
+        missing = []
+        with self._lock:
+            self.syscalls += len(to_list)
+            for dirname, names in todo.items():
+                if self._generation.get(dirname, 0) != generation[dirname]:
+                    continue
+                listing = listings[dirname]
+                self._listings[dirname] = listing
+                for name in names:
+                    path = os.path.join(dirname, name)
+                    if name in listing:
+                        to_stat.append(path)
+                    else:
+                        missing.append(path)
+            for path in missing:
+                self._stats[path] = None
+
+        stats = list(self._pool.map(self._stat, to_stat))
+        with self._lock:
+            self.syscalls += len(to_stat)
+            self._stats.update(
+                (path, st) for path, st in stats
+                if self._generation.get(os.path.dirname(path), 0) ==
+                generation[os.path.dirname(path)])
+
+        lg.debug("prefetched %d paths in %d directories", len(to_stat) +
+                 len(missing), len(todo))
+
+    def stat(self, path):
+        """
+        Return the os.stat_result of path, or None if it does not exist
+        """
+        path = str(path)
+        with self._lock:
+            self.lookups += 1
+            if path in self._stats:
+                return self._stats[path]
+            self.syscalls += 1
+        return self._stat(path)[1]
+
+    def exists(self, path) -> bool:
+        return self.stat(path) is not None
+
+    def mtime(self, path) -> float:
+        st = self.stat(path)
+        if st is None:
+            raise FileNotFoundError(path)
+        return st.st_mtime
+
+    def invalidate(self, paths):
+        """
+        Forget paths - e.g. outputs written by a job
+        """
+        with self._lock:
+            for path in paths:
+                path = str(path)
+                dirname = os.path.dirname(path)
+                self._stats.pop(path, None)
+                self._listings.pop(dirname, None)
+                self._generation[dirname] = \
+                    self._generation.get(dirname, 0) + 1
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self.lookups:
+            lg.info("stat cache: %d lookups, %d syscalls, %d saved",
+                    self.lookups, self.syscalls, self.saved)
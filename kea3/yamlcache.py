@@ -0,0 +1,98 @@
+"""
+Cache of parsed template files.
+
+Parsing a template with fantail (YAML) is slow for large templates with
+embedded scripts. The parsed data is pickled into a cache file, keyed
+by the sha1 of the template: as long as the template does not change it
+is not parsed again. Saving is skipped if the data did not change since
+it was loaded or saved.
+
+The cache file is a sidecar (.<name>.pickle) of the template, or a
+given file - templates that are not k3's own (k3/<name>/template.k3)
+are cached in k3/<name>, never next to the template.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+
+lg = logging.getLogger('k3.yamlcache')
+
+
+def sidecar(path) -> str:
+    dirname, basename = os.path.split(str(path))
+    return os.path.join(dirname, '.%s.pickle' % basename)
+
+
+def _digest(path) -> str:
+    with open(str(path), 'rb') as F:
+        return hashlib.sha1(F.read()).hexdigest()
+
+
+def _dumps(data):
+    try:
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        lg.debug("cannot pickle template data: %s", e)
+        return None
+
+
+def _read(filename):
+    # returns (digest, pickled data) of the cache file
+    try:
+        with open(filename, 'rb') as F:
+            return pickle.load(F)
+    except Exception:
+        return None, None
+
+
+def _write(filename, digest, blob):
+    if blob is None:
+        return
+    tmp = '%s.%d' % (filename, os.getpid())
+    try:
+        with open(tmp, 'wb') as F:
+            pickle.dump((digest, blob), F, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    except OSError as e:
+        # e.g. a read only template dir
+        lg.debug("cannot write %s: %s", filename, e)
+
+
+def load(path, loader, cache=None):
+    """
+    Return the data of the template at path - parsed with loader(path),
+    unless it did not change since it was parsed last
+
+    :param cache: cache file (default: the sidecar of the template)
+    """
+    cache = str(cache or sidecar(path))
+    digest = _digest(path)
+    cached_digest, blob = _read(cache)
+    if blob is not None and cached_digest == digest:
+        try:
+            return pickle.loads(blob)
+        except Exception as e:
+            lg.debug("ignoring template cache of %s: %s", path, e)
+    lg.debug("parse template %s", path)
+    data = loader(path)
+    _write(cache, digest, _dumps(data))
+    return data
+
+
+def save(data, path, saver) -> bool:
+    """
+    Save data to the template at path with saver(data, path) - unless
+    the file holds exactly this data already. Returns True if saved.
+    """
+    blob = _dumps(data)
+    cache = sidecar(path)
+    if blob is not None and os.path.exists(str(path)):
+        cached_digest, cached_blob = _read(cache)
+        if cached_blob == blob and cached_digest == _digest(path):
+            return False
+    lg.debug("save template %s", path)
+    saver(data, path)
+    _write(cache, _digest(path), blob)
+    return True
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+from kea3 import aexec
+from kea3.aexec import K3AsyncExecutor
+from kea3.scheduler import K3Scheduler
+
+
+def _alive(pid) -> bool:
+    # killed children might linger as zombies, until init reaps them
+    try:
+        with open('/proc/%d/stat' % pid) as F:
+            return F.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def _logs(tmpdir, name):
+    return (os.path.join(str(tmpdir), '%s.out' % name),
+            os.path.join(str(tmpdir), '%s.err' % name))
+
+
+def test_aexec_rc_and_logs(tmpdir):
+    executor = K3AsyncExecutor()
+    rcs = {}
+    for name, cl in (('ok', 'echo out; echo err >&2'), ('failed', 'exit 3')):
+        out, err = _logs(tmpdir, name)
+        executor.submit(cl, out, err,
+                        callback=lambda rc, name=name: rcs.update({name: rc}))
+    executor.close()
+    assert rcs == {'ok': 0, 'failed': 3}
+    out, err = _logs(tmpdir, 'ok')
+    assert open(out).read() == 'out\n'
+    assert open(err).read() == 'err\n'
+
+
+def test_aexec_timeout_kills_group(tmpdir, monkeypatch):
+    monkeypatch.setattr(aexec, 'KILL_GRACE', 1)
+    pidfile = os.path.join(str(tmpdir), 'child.pid')
+    out, err = _logs(tmpdir, 'slow')
+    executor = K3AsyncExecutor()
+    start = time.time()
+    future = executor.submit('sleep 30 & echo $! > %s; wait' % pidfile,
+                             out, err, timeout=0.5)
+    executor.close()
+    assert time.time() - start < 10
+    assert future.result() != 0
+    # the background child is killed with the job
+    time.sleep(0.1)
+    assert not _alive(int(open(pidfile).read()))
+
+
+def test_aexec_scheduler_limits_concurrency(tmpdir):
+    executor = K3AsyncExecutor(K3Scheduler({'slots': 2}))
+    for i in range(6):
+        out, err = _logs(tmpdir, 'job%d' % i)
+        executor.submit('date +%s.%N; sleep 0.2; date +%s.%N', out, err,
+                        demand={})
+    executor.close()
+
+    events = []
+    for i in range(6):
+        start, end = open(_logs(tmpdir, 'job%d' % i)[0]).read().split()
+        events.extend([(float(start), 1), (float(end), -1)])
+    running, max_running = 0, 0
+    for t, change in sorted(events):
+        running += change
+        max_running = max(max_running, running)
+    assert max_running == 2
+
+
+def test_aexec_callback_off_loop(tmpdir):
+    executor = K3AsyncExecutor()
+    threads = []
+    out, err = _logs(tmpdir, 'cb')
+    executor.submit('true', out, err,
+                    callback=lambda rc: threads.append(threading.get_ident()))
+    executor.close()
+    assert len(threads) == 1
+    assert threads[0] != executor._thread.ident
@@ -0,0 +1,70 @@
+
+import os
+
+from kea3.backend import PbsEmulatorBackend, get_backend, pool_batch
+
+
+def _script(path, body, directives=''):
+    with open(path, 'w') as F:
+        F.write('#!/bin/bash\n%s\n%s\n' % (directives, body))
+    return path
+
+
+def test_emulator_runs_jobs(tmpdir):
+    d = str(tmpdir)
+    backend = get_backend('emulate', slots=2)
+    assert isinstance(backend, PbsEmulatorBackend)
+    ids = []
+    for i in range(4):
+        script = _script(os.path.join(d, 'j%d.qsub' % i),
+                         'echo $PBS_JOBID > %s/done.%d' % (d, i),
+                         '#PBS -o %s/j%d.$PBS_JOBID.out' % (d, i))
+        ids.append(backend.submit(script))
+    backend.close()
+    assert set(backend.status(ids).values()) == {'C'}
+    assert sorted(f for f in os.listdir(d) if f.startswith('done')) == \
+        ['done.%d' % i for i in range(4)]
+    stats = backend.stats()
+    assert stats['jobs'] == 4
+    assert stats['failed'] == 0
+    assert 0 < stats['efficiency'] <= 1
+
+
+def test_emulator_array(tmpdir):
+    d = str(tmpdir)
+    backend = get_backend('emulate', slots=3)
+    script = _script(os.path.join(d, 'a.qsub'),
+                     'touch %s/el.$PBS_ARRAYID' % d, '#PBS -t 0-4')
+    jobid = backend.submit(script)
+    backend.close()
+    assert backend.status([jobid]) == {jobid: 'C'}
+    assert sorted(f for f in os.listdir(d) if f.startswith('el')) == \
+        ['el.%d' % i for i in range(5)]
+
+
+def test_pool_batch(tmpdir):
+    d = str(tmpdir)
+    jobs = [(1 + i % 2, ['touch %s/pool.%d' % (d, i)]) for i in range(6)]
+    script = _script(os.path.join(d, 'batch.sh'), pool_batch(jobs, 2),
+                     'set -e')
+    assert os.system('bash %s' % script) == 0
+    assert len([f for f in os.listdir(d) if f.startswith('pool.')]) == 6
+
+
+def test_emulator_depend(tmpdir):
+    d = str(tmpdir)
+    backend = get_backend('emulate', slots=2)
+    ok = backend.submit(_script(os.path.join(d, 'ok.qsub'),
+                                'sleep 0.2; touch %s/ok' % d))
+    failed = backend.submit(_script(os.path.join(d, 'failed.qsub'),
+                                    'exit 1'))
+    after_ok = backend.submit(_script(os.path.join(d, 'after_ok.qsub'),
+                                      'test -e %s/ok' % d), depend=[ok])
+    after_failed = backend.submit(
+        _script(os.path.join(d, 'after_failed.qsub'), 'touch %s/no' % d),
+        depend=[ok, failed])
+    backend.close()
+    rc = dict((j.jobid, j.rc) for j in backend.jobs.values())
+    assert rc[after_ok] == 0
+    assert rc[after_failed] != 0
+    assert not os.path.exists(os.path.join(d, 'no'))
@@ -0,0 +1,38 @@
+
+import os
+
+from kea3.builddb import K3BuildDB, signature
+
+
+def test_signature():
+    assert signature('a', 'b') == signature('a', 'b')
+    assert signature('a', 'b') != signature('ab')
+
+
+def test_builddb_roundtrip(tmpdir):
+    path = os.path.join(str(tmpdir), 'build.log')
+    db = K3BuildDB(path)
+    assert db.get('k1') is None
+    db.record('k1', 's1')
+    db.record('k2', 's2')
+    db.record('k1', 's3')
+    db.close()
+
+    db = K3BuildDB(path)
+    assert db.get('k1') == 's3'
+    assert db.get('k2') == 's2'
+
+
+def test_builddb_truncated_line(tmpdir):
+    path = os.path.join(str(tmpdir), 'build.log')
+    db = K3BuildDB(path)
+    db.record('k1', 's1')
+    db.close()
+    with open(path, 'a') as F:
+        F.write('k2')
+    db = K3BuildDB(path)
+    assert db.index == {'k1': 's1'}
+    # appending after the torn line
+    db.record('k3', 's3')
+    db.close()
+    assert K3BuildDB(path).index == {'k1': 's1', 'k3': 's3'}
@@ -0,0 +1,57 @@
+
+
+from kea3.context import K3Context, Lazy
+
+
+def test_context_layers():
+    parent = K3Context()
+    parent['a'] = 1
+    parent['prolog'] = ['x']
+    frozen = parent.freeze()
+
+    c1 = K3Context(frozen)
+    c2 = K3Context(frozen)
+    c1['a'] = 2
+    c1['prolog'].insert(0, 'module load y')
+    assert c1['a'] == 2
+    assert c2['a'] == 1
+    assert c1['prolog'] == ['module load y', 'x']
+    assert c2['prolog'] == ['x']
+    assert parent['prolog'] == ['x']
+    assert sorted(c1) == ['a', 'prolog']
+    assert len(c2) == 2
+    assert dict(c2.view()) == {'a': 1, 'prolog': ['x']}
+
+
+def test_context_overlay_is_small():
+    parent = K3Context()
+    for i in range(1000):
+        parent['k%d' % i] = 'v' * 100
+    frozen = parent.freeze()
+    c = K3Context(frozen)
+    c['i'] = 1
+    assert not hasattr(c, '__dict__')
+    assert len(c._local) == 1
+    assert c['k10'] == 'v' * 100
+
+
+def test_context_lazy():
+    calls = []
+
+    def _double(ctx):
+        calls.append(ctx['i'])
+        return 2 * ctx['i']
+
+    parent = K3Context()
+    parent['double'] = Lazy(_double)
+    frozen = parent.freeze()
+    c1 = K3Context(frozen)
+    c2 = K3Context(frozen)
+    c1['i'] = 1
+    c2['i'] = 5
+    assert calls == []
+    assert c1['double'] == 2
+    assert c1.view()['double'] == 2
+    assert c2.view()['double'] == 10
+    assert calls == [1, 5]
+    assert isinstance(c1.child()['double'], int)
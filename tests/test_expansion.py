@@ -0,0 +1,56 @@
+
+import pytest
+
+from kea3.expansion import combine, parse_groups
+
+
+def _dim(name, values):
+    return (({name: v}, {name: str(v)}) for v in values)
+
+
+def test_zip():
+    dims = {'a': _dim('a', [1, 2]), 'b': _dim('b', 'xy')}
+    rv = [v for v, m in combine(parse_groups('zip', ['a', 'b']), dims)]
+    assert rv == [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}]
+
+
+def test_zip_length_mismatch():
+    dims = {'a': _dim('a', [1, 2]), 'b': _dim('b', 'x')}
+    # before the first combination is generated
+    with pytest.raises(ValueError):
+        combine(parse_groups(None, ['a', 'b']), dims)
+
+
+def test_product():
+    dims = {'a': _dim('a', [1, 2]), 'b': _dim('b', 'xy')}
+    rv = [(v['a'], v['b']) for v, m in
+          combine(parse_groups('product', ['a', 'b']), dims)]
+    assert rv == [(1, 'x'), (1, 'y'), (2, 'x'), (2, 'y')]
+
+
+def test_groups():
+    dims = {'a': _dim('a', [1, 2]), 'b': _dim('b', 'xy'),
+            'k': _dim('k', [10, 20, 30])}
+    groups = parse_groups([['a', 'b'], 'k'], ['a', 'b', 'k'])
+    rv = list(combine(groups, dims))
+    assert len(rv) == 6
+    assert rv[0] == ({'a': 1, 'b': 'x', 'k': 10},
+                     {'a': '1', 'b': 'x', 'k': '10'})
+    with pytest.raises(ValueError):
+        parse_groups(['a'], ['a', 'b'])
+
+
+def test_product_is_lazy():
+    def endless():
+        i = 0
+        while True:
+            yield {'a': i}, {}
+            i += 1
+    dims = {'a': endless(), 'k': _dim('k', [1, 2])}
+    it = combine([['a'], ['k']], dims)
+    assert [next(it)[0] for _ in range(3)] == \
+        [{'a': 0, 'k': 1}, {'a': 0, 'k': 2}, {'a': 1, 'k': 1}]
+
+
+def test_no_dimensions():
+    assert list(combine([], {})) == [({}, {})]
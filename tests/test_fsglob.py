@@ -0,0 +1,52 @@
+import os
+
+
+from path import Path
+import pytest
+
+from kea3.fsglob import iglob, is_glob
+
+
+@pytest.fixture
+def tree(tmpdir):
+    t = Path(str(tmpdir))
+    for f in ['d/y.fq', 'd/x.fq', 'd/.hidden.fq', 'd/a/z.fq',
+              'd/a/b/w.fq', 'd/c/v.txt']:
+        (t / f).dirname().makedirs_p()
+        (t / f).touch()
+    return t
+
+
+def test_is_glob():
+    assert is_glob('data/{*}.fq')
+    assert is_glob('data/{**}.fq')
+    assert not is_glob('data/*.fq')
+    assert not is_glob(['{*}'])
+
+
+def test_iglob_sorted(tree):
+    pattern = tree / 'd' / '{*}.fq'
+    assert list(iglob(pattern)) == [
+        (tree / 'd' / 'x.fq', 'x'), (tree / 'd' / 'y.fq', 'y')]
+
+
+def test_iglob_lazy(tree):
+    it = iglob(tree / 'd' / '{*}.fq')
+    assert next(it)[1] == 'x'
+
+
+def test_iglob_recursive(tree):
+    matches = [m for _, m in iglob(tree / 'd' / '{**}.fq')]
+    assert matches == ['a/b/w', 'a/z', 'x', 'y']
+
+
+def test_iglob_directory_wildcard(tree):
+    assert [m for _, m in iglob(tree / 'd' / '{*}' / 'z.fq')] == ['a']
+
+
+def test_iglob_recursive_symlink_loop(tree):
+    # a link back up the tree, and one to a directory next to it
+    os.symlink(tree / 'd', tree / 'd' / 'a' / 'b' / 'loop')
+    os.symlink(tree / 'd' / 'c', tree / 'd' / 'link')
+    matches = [m for _, m in iglob(tree / 'd' / '{**}.txt')]
+    assert matches == ['c/v', 'link/v']
@@ -1,5 +1,5 @@
-
-import os
+import argparse
+import copy
 import tempfile
 import yaml
 
@@ -38,13 +38,13 @@ def kea3_leip_app():
     return leip.app(name='kea3')
 
 
-def test_k3_job_load_template(kea3_leip_app, template_test_01):
+def test_k3_job_load_template(kea3_leip_app, template_test_01, monkeypatch):
     app = kea3_leip_app
     job = K3Job(app, {}, template=template_test_01)
     assert isinstance(job, K3Job)
     with tempfile.TemporaryDirectory() as tmpdir:
         t = Path(tmpdir)
-        os.chdir(tmpdir)
+        monkeypatch.chdir(tmpdir)
         job.get_template()
 
         k3dir = t / 'k3'
@@ -64,3 +64,166 @@ def test_k3_job_load_template(kea3_leip_app, template_test_01):
 
         assert file_a['template'] == file_b['template']
         assert file_a['io'] == file_b['io']
+
+
+class HookRecorder:
+    def __init__(self):
+        self.calls = []
+
+    def run_hook(self, name, *args):
+        self.calls.append((name,) + args)
+
+
+def test_k3_job_post_run_batch():
+    app = HookRecorder()
+    job = K3Job(app, {})
+    jobs = [copy.copy(job) for _ in range(3)]
+    for j in jobs:
+        j.flush_post_run(j)
+    assert app.calls == []
+    job.flush_post_run()
+    assert app.calls == [('post_run_batch', jobs)]
+    job.flush_post_run()
+    assert len(app.calls) == 1
+
+
+def _incremental_job(workdir, recheck=False, **data):
+    from kea3.builddb import K3BuildDB
+
+    job = K3Job(HookRecorder(), argparse.Namespace(force=False,
+                                                   recheck=recheck))
+    job.name = 'incremental'
+    job.data = {'template': 'cat {{ input }} > {{ output }}',
+                'io': [{'name': 'input'}, {'name': 'output'}],
+                'parameters': [],
+                'cl_args': {'input': workdir / '{*}.txt',
+                            'output': workdir / '{g}.out'}}
+    job.data.update(data)
+    job.prepare_renderer()
+    job.prepare_io()
+    job.stemdb = K3BuildDB(workdir / 'expanded.log')
+    return job
+
+
+def test_k3_job_incremental(tmpdir, monkeypatch):
+    workdir = Path(str(tmpdir))
+    # the renderer caches in ./k3/<name>
+    monkeypatch.chdir(workdir)
+    for name in 'abc':
+        (workdir / ('%s.txt' % name)).write_text(name)
+
+    job = _incremental_job(workdir)
+    jobs = list(job.expand())
+    assert len(jobs) == 3
+    for j in jobs[:2]:
+        Path(j.ctx['output']).write_text('done')
+        j.stats.invalidate([j.ctx['output']])
+        j.record_stem()
+    job.stemdb.close()
+
+    # only the job that did not complete is planned again
+    job = _incremental_job(workdir)
+    assert [j.ctx['input'] for j in job.expand()] == [workdir / 'c.txt']
+    assert job.no_unchanged == 2
+
+    # as are jobs with changed input
+    (workdir / 'a.txt').write_text('changed')
+    job = _incremental_job(workdir)
+    assert len(list(job.expand())) == 2
+
+    job = _incremental_job(workdir, recheck=True)
+    assert len(list(job.expand())) == 3
+
+    # any change to the template data (e.g. modules loaded in the
+    # prolog) changes all jobs
+    job = _incremental_job(workdir, modules=['samtools'])
+    assert len(list(job.expand())) == 3
+
+
+def test_k3_job_pre_run_batch(tmpdir, monkeypatch):
+    workdir = Path(str(tmpdir))
+    monkeypatch.chdir(workdir)
+    for name in 'ab':
+        (workdir / ('%s.txt' % name)).write_text(name)
+
+    job = _incremental_job(workdir)
+    jobs = list(job.expand())
+    names = [call[0] for call in job.app.calls]
+    assert names.index('pre_check_batch') < names.index('pre_run_batch')
+    assert 'pre_run' not in names
+    batch = [call[1] for call in job.app.calls
+             if call[0] == 'pre_run_batch']
+    assert batch == [jobs]
+    # rendered before the batch hook
+    assert [j.code for j in jobs] == [
+        'cat %s > %s' % (workdir / ('%s.txt' % name),
+                         workdir / ('%s.out' % name)) for name in 'ab']
+
+
+def test_k3_job_tree_reduce(tmpdir, monkeypatch):
+    workdir = Path(str(tmpdir))
+    monkeypatch.chdir(workdir)
+    for i in range(7):
+        (workdir / ('%d.txt' % i)).write_text('%d\n' % i)
+
+    job = K3Job(HookRecorder(), argparse.Namespace(force=False,
+                                                   dryrun=False))
+    job.name = 'tree'
+    job.data = {'mode': 'tree-reduce',
+                'fan_in': 3,
+                'template': 'cat {{ input|join(" ") }} > {{ output }}',
+                'combine': 'sort -m {{ input|join(" ") }} > {{ output }}',
+                'io': [{'name': 'input'}, {'name': 'output'}],
+                'parameters': [],
+                'cl_args': {'input': '{*}.txt', 'output': 'all.txt'}}
+    job.prepare_renderer()
+    job.prepare_io()
+
+    jobs = []
+    for j in job.expand():
+        j.run()
+        jobs.append(j)
+
+    assert [(j.ctx['level'], len(j.ctx['input'])) for j in jobs] == \
+        [(0, 3), (0, 3), (0, 1), (1, 3)]
+    top = jobs[-1]
+    assert top.script_template == 'combine'
+    assert top.depends_on == jobs[:3]
+    assert top.ctx['input'] == [j.ctx['output'] for j in jobs[:3]]
+    assert top.ctx['output'] == 'all.txt'
+    assert (workdir / 'all.txt').lines(retain=False) == \
+        [str(i) for i in range(7)]
+
+
+def test_k3_job_tree_reduce_error(tmpdir, monkeypatch):
+    from kea3.scheduler import K3Scheduler
+
+    workdir = Path(str(tmpdir))
+    monkeypatch.chdir(workdir)
+    for i in range(4):
+        (workdir / ('%d.txt' % i)).write_text('%d\n' % i)
+
+    job = K3Job(HookRecorder(), argparse.Namespace(force=False,
+                                                   dryrun=False))
+    job.name = 'tree'
+    job.data = {'mode': 'tree-reduce',
+                'fan_in': 2,
+                # fails to render for the second chunk
+                'template': 'cat {{ input|join(" ") }} > {{ output }} '
+                            '# {{ 1 // (1 - chunk) }}',
+                'io': [{'name': 'input'}, {'name': 'output'}],
+                'parameters': [],
+                'cl_args': {'input': '{*}.txt', 'output': 'all.txt'}}
+    job.prepare_renderer()
+    job.prepare_io()
+    scheduler = K3Scheduler({'slots': 2})
+    job.barrier = scheduler.join
+
+    levels = []
+    for j in job.expand():
+        levels.append(j.ctx['level'])
+        scheduler.submit(j.run, {})
+    scheduler.join()
+    # the error is not combined
+    assert levels == [0, 0]
+    assert not (workdir / 'all.txt').exists()
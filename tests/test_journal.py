@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from kea3.journal import K3Journal
+
+
+def _committer(log):
+    def _commit(token, records, retry):
+        log.append((retry, [r['id'] for r in records]))
+    return _commit
+
+
+def test_journal_commit_once(tmpdir):
+    path = os.path.join(str(tmpdir), 'transactions.jsonl')
+    journal = K3Journal(path, chunk_size=2)
+    for i in range(5):
+        journal.add('t%d' % i, cl='mad ta add %d' % i)
+    log = []
+    assert journal.commit(_committer(log)) == 5
+    assert log == [(False, ['t0', 't1', 't2', 't3', 't4'])]
+    assert journal.commit(_committer(log)) == 0
+    journal.close()
+
+    journal = K3Journal(path)
+    assert not journal.pending
+    assert journal.commit(_committer(log)) == 0
+    assert len(log) == 1
+
+
+def test_journal_survives_crash(tmpdir):
+    path = os.path.join(str(tmpdir), 'transactions.jsonl')
+    journal = K3Journal(path, chunk_size=1)
+    journal.add('t0', cl='a')
+    journal.add('t1', cl='b')
+    # crash: no close, half a line written
+    with open(path, 'a') as F:
+        F.write('{"id": "t2", "c')
+
+    journal = K3Journal(path)
+    assert list(journal.pending) == ['t0', 't1']
+    journal.add('t3', cl='c')
+    journal.close()
+    assert list(K3Journal(path).pending) == ['t0', 't1', 't3']
+
+
+def test_journal_retries_interrupted_commit(tmpdir):
+    path = os.path.join(str(tmpdir), 'transactions.jsonl')
+    journal = K3Journal(path)
+    journal.add('t0', cl='a')
+
+    def _crash(token, records, retry):
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        journal.commit(_crash)
+
+    journal = K3Journal(path)
+    journal.add('t1', cl='b')
+    log = []
+    assert journal.commit(_committer(log)) == 2
+    assert log == [(True, ['t0']), (False, ['t1'])]
+    journal.close()
+    assert not K3Journal(path).pending
+
+
+def test_journal_compacts(tmpdir):
+    path = os.path.join(str(tmpdir), 'transactions.jsonl')
+    journal = K3Journal(path)
+    for i in range(10):
+        journal.add('t%d' % i, cl='a')
+    journal.commit(_committer([]))
+    journal.add('t10', cl='b')
+    journal.close()
+    # only the transaction that is not committed is left
+    with open(path) as F:
+        assert len(F.readlines()) == 1
+    journal = K3Journal(path)
+    assert list(journal.pending) == ['t10']
+    journal.close()
+
+
+def test_journal_flush_without_close(tmpdir):
+    path = os.path.join(str(tmpdir), 'transactions.jsonl')
+    journal = K3Journal(path)
+    journal.add('t0', cl='a')
+    journal.flush(sync=False)
+    # killed: no close, no atexit
+    assert list(K3Journal(path).pending) == ['t0']
@@ -0,0 +1,41 @@
+
+import subprocess
+
+from path import Path
+
+from kea3.pack import K3ScriptPack, read_index, read_job
+
+
+def test_pack_roundtrip(tmpdir):
+    pack = K3ScriptPack(Path(str(tmpdir)) / 'script', 'test',
+                        '20000101T000000', ['input'])
+    pack.add(0, '', '#!/bin/bash\necho zero\n', '', {'input': 'a.txt'})
+    cl = pack.add(1, '#!/bin/bash\n\nexport K3TEST=one',
+                  '#!/bin/bash\necho $K3TEST\n', '', {'input': 'b.txt'})
+    pack.close()
+
+    header, rows = read_index(pack.index)
+    assert header[-1] == 'input'
+    assert [r['input'] for r in rows] == ['a.txt', 'b.txt']
+    assert read_job(pack.index, 0)['main'] == '#!/bin/bash\necho zero\n'
+
+    out = subprocess.check_output(cl, shell=True)
+    assert out.decode().strip() == 'one'
+
+
+def test_pack_sparse_and_spaces(tmpdir):
+    # a script dir with spaces, jobs that are not in the pack
+    pack = K3ScriptPack(Path(str(tmpdir)) / 'my scripts', 'test',
+                        '20000101T000000')
+    cl = pack.add(5, '', '#!/bin/bash\necho five\n', '')
+    pack.add(1000, '', '#!/bin/bash\necho thousand\n', '')
+    pack.close()
+
+    out = subprocess.check_output(cl, shell=True)
+    assert out.decode().strip() == 'five'
+    driver = cl.rsplit(' ', 1)[0]
+    out = subprocess.check_output('%s 1000' % driver, shell=True)
+    assert out.decode().strip() == 'thousand'
+    for i in (0, 6, 2000):
+        assert subprocess.call('%s %d' % (driver, i), shell=True,
+                               stderr=subprocess.DEVNULL) == 1
@@ -0,0 +1,91 @@
+import argparse
+
+from path import Path
+
+from kea3.backend import get_backend
+from kea3.job import get_stamp
+from kea3.pack import K3ScriptPack
+from kea3.pbsjob import K3JobPbs
+
+
+class App:
+    def __init__(self):
+        self.cl_cache = []
+        self.array_batches = []
+        self.pbs_ids = {}
+        self.trans = {'args': argparse.Namespace(qsub=False)}
+
+    def run_hook(self, name, *args):
+        pass
+
+
+def _array_job(workdir, jobs_per_node=2):
+    job = K3JobPbs(App(), argparse.Namespace(force=False, dryrun=False))
+    job.name = 'array'
+    job.data = {'template': 'echo $PBS_ARRAYID > {{ output }}',
+                'io': [{'name': 'input'}, {'name': 'output'}],
+                'parameters': [],
+                'cl_args': {'input': workdir / '{*}.txt',
+                            'output': workdir / '{g}.done'}}
+    job.prepare_renderer()
+    job.prepare_io()
+    pbs_dir = (job.workdir / 'pbs').abspath()
+    pbs_dir.makedirs_p()
+    job.ctx['template'] = {'name': job.name}
+    job.ctx['pbs_dir'] = pbs_dir
+    job.ctx['pyenv'] = None
+    job.ctx['pbs'] = {'walltime': 1, 'group': 'test',
+                      'jobs_per_node': jobs_per_node}
+    job.backend = get_backend('emulate', slots=2)
+    job.array = K3ScriptPack(pbs_dir, job.name + '.array', get_stamp())
+    return job
+
+
+def test_pbs_array(tmpdir, monkeypatch):
+    workdir = Path(str(tmpdir))
+    monkeypatch.chdir(workdir)
+    for name in 'abcde':
+        (workdir / ('%s.txt' % name)).write_text(name)
+
+    job = _array_job(workdir)
+    job.submit_all()
+    job.backend.close()
+
+    # 5 jobs, 2 per node: one array job with 3 elements
+    assert job.app.array_batches == [[0, 1], [2, 3], [4]]
+    assert job.array.no_jobs == 3
+    assert sorted(job.app.pbs_ids.values()) == \
+        ['1.emulator[0]'] * 2 + ['1.emulator[1]'] * 2 + ['1.emulator[2]']
+    assert [(workdir / ('%s.done' % name)).read_text().strip()
+            for name in 'abcde'] == ['0', '0', '1', '1', '2']
+
+
+def test_pbs_array_no_jobs(tmpdir, monkeypatch):
+    workdir = Path(str(tmpdir))
+    monkeypatch.chdir(workdir)
+    job = _array_job(workdir)
+    job.submit_all()
+    job.backend.close()
+    assert job.array.no_jobs == 0
+    assert job.backend.jobs == {}
+
+
+def test_pbs_runstate(tmpdir, monkeypatch):
+    from kea3 import runstate
+
+    workdir = Path(str(tmpdir))
+    monkeypatch.chdir(workdir)
+    for name in 'abc':
+        (workdir / ('%s.txt' % name)).write_text(name)
+
+    job = _array_job(workdir)
+    job.prepare_runstate()
+    job.submit_all()
+    job.backend.close()
+    job.runstate.close()
+
+    path = job.workdir / 'runstate.db'
+    db = runstate.open_db(path)
+    assert runstate.summary(db, job.runstate.run) == {'submitted': 3}
+    assert runstate.update_submitted(db, path, job.runstate.run) == 3
+    assert runstate.summary(db, job.runstate.run) == {'done': 3}
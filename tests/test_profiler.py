@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+from kea3.profiler import K3Profiler, NO_PROFILER
+
+
+class App:
+    """
+    A stand-in for leip.app - hooks (priority, function) in a list per
+    hook
+    """
+    def __init__(self, hooks):
+        self.hooks = dict((name, [(50, f) for f in functions])
+                          for name, functions in hooks.items())
+
+    def run_hook(self, name, *args):
+        for priority, hook in sorted(self.hooks.get(name, []),
+                                     key=lambda x: x[0]):
+            hook(self, *args)
+
+
+def _app(hooks):
+    return App(hooks)
+
+
+def test_no_profiler():
+    with NO_PROFILER.phase('x'):
+        pass
+    items = [1, 2]
+    assert NO_PROFILER.iterate('x', items) is items
+
+
+def test_phases_and_iterate():
+    profiler = K3Profiler()
+    with profiler.phase('a'):
+        pass
+    assert list(profiler.iterate('b', range(3))) == [0, 1, 2]
+    counts = dict(((cat, name), count) for cat, name, count, total, longest
+                  in profiler.summary())
+    assert counts == {('phase', 'a'): 1, ('phase', 'b'): 4}
+
+
+def test_hook_attribution(tmpdir):
+    seen = []
+
+    def my_hook(app, job):
+        seen.append(job)
+
+    app = _app({'expanded': [my_hook]})
+    profiler = K3Profiler()
+    profiler.attach(app)
+    app.run_hook('expanded', 1)
+    app.run_hook('expanded', 2)
+    profiler.detach()
+    app.run_hook('expanded', 3)
+    assert seen == [1, 2, 3]
+
+    counts = dict(((cat, name), count) for cat, name, count, total, longest
+                  in profiler.summary())
+    assert counts == {('hook', 'hook:expanded'): 2,
+                      ('plugin', '%s.my_hook' % __name__): 2}
+
+    path = os.path.join(str(tmpdir), 'trace.json')
+    profiler.report(path)
+    with open(path) as F:
+        trace = json.load(F)
+    assert len(trace['traceEvents']) == 4
+    assert set(e['ph'] for e in trace['traceEvents']) == {'X'}
+
+
+def test_hook_in_thread():
+    def my_thread_hook(app, job):
+        pass
+
+    app = _app({'run': [my_thread_hook]})
+    profiler = K3Profiler()
+    profiler.attach(app)
+    thread = threading.Thread(target=app.run_hook, args=('run', 1))
+    thread.start()
+    thread.join()
+    profiler.detach()
+    assert app.hooks['run'] == [(50, my_thread_hook)]
+
+    events = [(cat, name, tid) for name, cat, start, duration, tid
+              in profiler.events]
+    assert ('plugin', '%s.my_thread_hook' % __name__,
+            thread.ident) in events
@@ -0,0 +1,61 @@
+import traceback
+
+from path import Path
+import pytest
+
+from kea3.context import K3Context, Lazy
+from kea3.render import K3Renderer
+
+
+def test_render_compile_once():
+    r = K3Renderer()
+    r.register('template', 'echo {{ a }}')
+    t1 = r.get('template')
+    assert r.render('template', {'a': 1}) == 'echo 1'
+    assert r.render('template', {'a': 2}) == 'echo 2'
+    assert r.get('template') is t1
+
+
+def test_render_string_cache():
+    r = K3Renderer()
+    assert r.render_string('{{ x }}', {'x': 'y'}) == 'y'
+    assert r.compile_string('{{ x }}') is r.compile_string('{{ x }}')
+    assert r.compile_string('{{ z }}', cache=False) is not \
+        r.compile_string('{{ z }}', cache=False)
+
+
+def test_render_bytecode_cache(tmpdir):
+    cache_dir = Path(str(tmpdir)) / 'jinja'
+    r = K3Renderer(cache_dir=cache_dir)
+    r.register('template', 'echo {{ a }}')
+    assert r.render('template', {'a': 1}) == 'echo 1'
+    assert len(cache_dir.files()) == 1
+
+
+def test_render_lazy_values():
+    calls = []
+
+    def _expensive(ctx):
+        calls.append(1)
+        return 'x'
+
+    ctx = K3Context()
+    ctx['a'] = 1
+    ctx['lazy'] = Lazy(_expensive)
+    r = K3Renderer()
+    assert r.render_string('{{ a }} {{ range(2)|list }}', ctx.view()) == \
+        '1 [0, 1]'
+    assert calls == []
+    assert r.render_string('{{ lazy }}', ctx.view()) == 'x'
+    assert r.render_string('{{ lazy }}{{ b }}', ctx.view()) == 'x'
+    assert calls == [1]
+
+
+def test_render_error_line():
+    r = K3Renderer()
+    r.register('template', 'echo ok\necho {{ 1 // zero }}\n')
+    with pytest.raises(ZeroDivisionError) as e:
+        r.render('template', {'zero': 0})
+    # the traceback points at the line in the template
+    frame = traceback.extract_tb(e.value.__traceback__)[-1]
+    assert (frame.filename, frame.lineno) == ('<template>', 2)
@@ -0,0 +1,45 @@
+
+import pytest
+
+from kea3.render import K3Renderer
+from kea3.resolve import K3ResolveError, resolve
+
+
+def test_resolve_chain():
+    values = {'a': 'x', 'c': '{{ b }}.c', 'b': '{{ a }}.b'}
+    rv = resolve(values, K3Renderer())
+    assert rv == {'b': 'x.b', 'c': 'x.b.c'}
+
+
+def test_resolve_deep_chain():
+    values = {'p0': 'start'}
+    for i in range(1, 50):
+        values['p%d' % i] = '{{ p%d }}' % (i - 1)
+    rv = resolve(values, K3Renderer())
+    assert rv['p49'] == 'start'
+
+
+def test_resolve_cycle():
+    values = {'a': '{{ b }}', 'b': '{{ a }}', 'c': 'ok'}
+    with pytest.raises(K3ResolveError) as e:
+        resolve(values, K3Renderer())
+    assert e.value.names == ['a', 'b']
+
+
+def test_resolve_missing():
+    values = {'a': '{{ nope }}', 'b': '{{ a }}', 'c': '{{ d }}', 'd': '1'}
+    with pytest.raises(K3ResolveError) as e:
+        resolve(values, K3Renderer())
+    assert e.value.names == ['a']
+    rv = resolve(values, K3Renderer(), missing='defer')
+    assert rv == {'c': '1'}
+
+
+def test_resolve_ignore_warns_once(caplog):
+    values = {'a': '{{ unknown_once }}', 'b': 'x'}
+    for i in range(3):
+        rv = resolve(values, K3Renderer(), missing='ignore')
+        assert rv == {'a': ''}
+    warnings = [r for r in caplog.records if r.levelname == 'WARNING']
+    assert len(warnings) == 1
+    assert 'unknown_once' in warnings[0].getMessage()
@@ -0,0 +1,72 @@
+import os
+
+from kea3 import runstate
+from kea3.runstate import K3RunState
+
+
+def test_runstate_roundtrip(tmpdir):
+    path = os.path.join(str(tmpdir), 'runstate.db')
+    rs = K3RunState(path, 'run1', 'k3 run x')
+    for i in range(10):
+        rs.update(i, state='planned')
+    rs.update(3, state='running', start=1.0)
+    rs.update(3, state='failed', rc=2, end=2.0)
+    rs.update(4, state='done', rc=0)
+    rs.close()
+
+    db = runstate.open_db(path)
+    assert runstate.runs(db)[0][0] == 'run1'
+    assert runstate.summary(db, 'run1') == \
+        {'planned': 8, 'failed': 1, 'done': 1}
+    assert runstate.failures(db, 'run1') == [(3, None, 2, None)]
+
+
+def test_runstate_update_keeps_fields(tmpdir):
+    path = os.path.join(str(tmpdir), 'runstate.db')
+    rs = K3RunState(path, 'run1')
+    rs.update(0, state='running', start=1.0, stamp='s')
+    rs.flush()
+    rs.update(0, state='done', rc=0, end=2.0)
+    rs.close()
+
+    db = runstate.open_db(path)
+    row = db.execute('SELECT stamp, state, rc, start, end FROM jobs').fetchone()
+    assert row == ('s', 'done', 0, 1.0, 2.0)
+
+
+def test_open_db_missing(tmpdir):
+    assert runstate.open_db(os.path.join(str(tmpdir), 'nope.db')) is None
+
+
+def test_update_submitted(tmpdir):
+    path = os.path.join(str(tmpdir), 'runstate.db')
+    rs = K3RunState(path, 'run1')
+    for i, pbs_id in enumerate(['0.pbs', '0.pbs', '1.pbs', '2.pbs']):
+        rs.update(i, state='submitted', pbs_id=pbs_id)
+    rs.update(4, state='running')
+    with open(rs.rc_file(0), 'w') as F:
+        F.write('0 10\n')
+    with open(rs.rc_file(1), 'w') as F:
+        F.write('3 11\n')
+    rs.close()
+
+    db = runstate.open_db(path)
+    # job 2 is still running, job 3 got killed
+    calls = []
+
+    def status(jobids):
+        calls.append(jobids)
+        return {'1.pbs': 'R', '2.pbs': 'C'}
+    assert runstate.update_submitted(db, path, 'run1', status) == 4
+    assert calls == [['1.pbs', '2.pbs']]
+    assert runstate.summary(db, 'run1') == {'done': 1, 'failed': 2,
+                                           'running': 2}
+    assert runstate.failures(db, 'run1') == [
+        (1, None, 3, '0.pbs'), (3, None, None, '2.pbs')]
+
+    # job 2 finishes
+    with open(runstate.rc_dir(path, 'run1') + '/2', 'w') as F:
+        F.write('0 12\n')
+    assert runstate.update_submitted(db, path, 'run1', status) == 1
+    assert runstate.summary(db, 'run1') == {'done': 2, 'failed': 2,
+                                           'running': 1}
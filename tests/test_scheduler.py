@@ -0,0 +1,73 @@
+
+import threading
+import time
+
+import pytest
+
+from kea3.scheduler import K3Scheduler, machine_capacity, parse_cores, \
+    parse_resource, parse_size
+
+
+def test_parse_size():
+    assert parse_size(3) == 3
+    assert parse_size('2k') == 2048
+    assert parse_size('1.5G') == 1.5 * 1024 ** 3
+
+
+def test_machine_capacity():
+    cap = machine_capacity(4, {'io': '2', 'cores': 3})
+    assert cap['slots'] == 4
+    assert cap['io'] == 2
+    assert cap['cores'] == 3
+
+
+def test_scheduler_respects_capacity():
+    sched = K3Scheduler({'slots': 10, 'cores': 4, 'io': 1})
+    lock = threading.Lock()
+    state = {'cores': 0, 'max_cores': 0, 'io': 0, 'max_io': 0}
+
+    def job(cores, io):
+        def _run():
+            with lock:
+                state['cores'] += cores
+                state['io'] += io
+                state['max_cores'] = max(state['max_cores'], state['cores'])
+                state['max_io'] = max(state['max_io'], state['io'])
+            time.sleep(0.01)
+            with lock:
+                state['cores'] -= cores
+                state['io'] -= io
+        return _run
+
+    for i in range(20):
+        demand = {'cores': 1 + i % 3, 'io': i % 2}
+        sched.submit(job(demand['cores'], demand['io']), demand)
+    sched.join()
+    assert state['max_cores'] <= 4
+    assert state['max_io'] <= 1
+    assert sched.available == sched.capacity
+
+
+def test_scheduler_oversized_job():
+    sched = K3Scheduler({'cores': 2})
+    ran = []
+    sched.submit(lambda: ran.append(1), {'cores': 8, 'gpu': 1})
+    sched.join()
+    assert ran == [1]
+
+
+def test_parse_resource():
+    assert parse_resource('mem=2k') == ('mem', 2048)
+    assert parse_resource(' io = 2') == ('io', 2)
+    for value in ('foo', '=2', 'mem=lots'):
+        with pytest.raises(ValueError):
+            parse_resource(value)
+
+
+def test_parse_cores():
+    assert parse_cores(2, 8) == 2
+    assert parse_cores('2.0', 8) == 2
+    assert parse_cores(' ALL ', 8) == 8
+    for value in ('2.5', '0', 'many', None):
+        with pytest.raises(ValueError):
+            parse_cores(value, 8)
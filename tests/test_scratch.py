@@ -0,0 +1,74 @@
+import fcntl
+import os
+import time
+
+from kea3.scratch import LOCK_FILE, SIZES_FILE, K3Scratch
+
+
+def _fill(path, size):
+    with open(os.path.join(path, 'data'), 'wb') as F:
+        F.write(b'x' * size)
+
+
+def test_scratch_allocate(tmpdir):
+    scratch = K3Scratch(str(tmpdir))
+    ws1 = scratch.allocate()
+    ws2 = scratch.allocate()
+    assert ws1 != ws2
+    assert ws1.isdir() and ws2.isdir()
+    # workspaces of this (running) process are kept
+    assert all(running for mtime, path, running in scratch.workspaces())
+
+
+def test_scratch_cleanup(tmpdir):
+    base = str(tmpdir)
+    old = os.path.join(base, 'k3.otherhost.1.abc')
+    legacy = os.path.join(base, '0f8fad5b-d9cb-469f-a165-70867728950e')
+    recent = os.path.join(base, 'k3.otherhost.2.def')
+    other = os.path.join(base, 'not-a-workspace')
+    for path in (old, legacy, recent, other):
+        os.makedirs(path)
+        _fill(path, 1000)
+    week_ago = time.time() - 8 * 24 * 3600
+    os.utime(old, (week_ago, week_ago))
+    os.utime(legacy, (week_ago + 1, week_ago + 1))
+
+    assert K3Scratch(base, max_age=7).cleanup() == 2
+    assert sorted(os.listdir(base)) == [SIZES_FILE, 'k3.otherhost.2.def',
+                                        'not-a-workspace']
+
+    # over the size budget
+    assert K3Scratch(base, max_size=500).cleanup() == 1
+    assert sorted(os.listdir(base)) == [SIZES_FILE, 'not-a-workspace']
+
+
+def test_scratch_keeps_locked(tmpdir):
+    base = str(tmpdir)
+    # a workspace of a k3 still running on another host
+    live = os.path.join(base, 'k3.otherhost.3.ghi')
+    os.makedirs(live)
+    _fill(live, 1000)
+    lock = open(os.path.join(live, LOCK_FILE), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    week_ago = time.time() - 8 * 24 * 3600
+    os.utime(live, (week_ago, week_ago))
+
+    assert K3Scratch(base, max_age=7, max_size=500).cleanup() == 0
+    assert os.path.isdir(live)
+
+    lock.close()
+    assert K3Scratch(base, max_age=7).cleanup() == 1
+    assert not os.path.exists(live)
+
+
+def test_scratch_records_sizes(tmpdir):
+    base = str(tmpdir)
+    done = os.path.join(base, 'k3.otherhost.4.jkl')
+    os.makedirs(done)
+    _fill(done, 1000)
+    scratch = K3Scratch(base)
+    assert scratch.sizes(scratch.workspaces()) == [1000]
+    # recorded - not measured again (rewriting a file leaves the mtime
+    # of the workspace as is)
+    _fill(done, 10)
+    assert scratch.sizes(scratch.workspaces()) == [1000]
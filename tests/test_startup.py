@@ -0,0 +1,78 @@
+"""
+Startup regression tests: importing k3 & its plugins must not pull in
+the heavy dependencies - these are imported when a command needs them.
+"""
+
+import json
+import os
+import subprocess as sp
+import sys
+import time
+
+import pytest
+
+#: modules only commands that need them may import
+HEAVY = ['jinja2', 'fantail', 'mad2', 'xtermcolor', 'asyncio', 'sqlite3']
+
+#: wall clock seconds python may take to start & import the cli - generous,
+#: this catches regressions, not noise
+BUDGET = 2.0
+
+CHECK = '''
+import json, sys
+for name in %(pre)r:
+    __import__(name)
+before = set(sys.modules)
+for name in %(modules)r:
+    __import__(name)
+new = set(sys.modules) - before
+print(json.dumps({'heavy': sorted(m for m in %(heavy)r if m in new)}))
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import(modules, pre=()):
+    out = sp.check_output(
+        [sys.executable, '-c', CHECK % {'pre': list(pre), 'heavy': HEAVY,
+                                        'modules': modules}],
+        cwd=ROOT)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def test_job_import_is_light():
+    rv = _import(['kea3.job'], pre=['path'])
+    assert rv['heavy'] == []
+
+
+def test_plugin_import_is_light():
+    pytest.importorskip('leip')
+    rv = _import(['kea3.cli', 'kea3.plugin.run_template',
+                  'kea3.plugin.run_pbs', 'kea3.plugin.mad_metadata',
+                  'kea3.plugin.transact', 'kea3.plugin.modules'],
+                 pre=['leip', 'path'])
+    assert rv['heavy'] == []
+
+
+def test_cli_startup_time():
+    pytest.importorskip('leip')
+    timings = []
+    # best of 3 - the first run might have to compile the modules
+    for _ in range(3):
+        start = time.perf_counter()
+        sp.check_call([sys.executable, '-c',
+                       'import kea3.cli; kea3.cli.get_app'], cwd=ROOT)
+        timings.append(time.perf_counter() - start)
+    assert min(timings) < BUDGET
+
+
+def test_run_pbs_reexports():
+    pytest.importorskip('leip')
+    from kea3.backend import PBS_SUBMIT_SCRIPT_HEADER
+    from kea3.pbsjob import K3JobPbs
+    from kea3.plugin import run_pbs
+
+    assert run_pbs.K3JobPbs is K3JobPbs
+    assert run_pbs.PBS_SUBMIT_SCRIPT_HEADER is PBS_SUBMIT_SCRIPT_HEADER
+    with pytest.raises(AttributeError):
+        run_pbs.no_such_name
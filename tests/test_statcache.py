@@ -0,0 +1,53 @@
+
+import os
+
+from kea3.statcache import K3StatCache
+
+
+def test_statcache_prefetch(tmpdir):
+    d = str(tmpdir)
+    paths = [os.path.join(d, 'f%d' % i) for i in range(10)]
+    for p in paths[:5]:
+        open(p, 'w').close()
+
+    sc = K3StatCache()
+    sc.prefetch(paths)
+    # one listing & 5 stats
+    assert sc.syscalls == 6
+    for p in paths:
+        assert sc.exists(p) == (p in paths[:5])
+        if sc.exists(p):
+            assert sc.mtime(p) == os.path.getmtime(p)
+    assert sc.syscalls == 6
+    assert sc.saved == 25 - 6
+    sc.close()
+
+
+def test_statcache_invalidate(tmpdir):
+    p = os.path.join(str(tmpdir), 'out')
+    sc = K3StatCache()
+    sc.prefetch([p])
+    assert not sc.exists(p)
+    open(p, 'w').close()
+    sc.invalidate([p])
+    assert sc.exists(p)
+    sc.close()
+
+
+def test_statcache_invalidate_during_prefetch(tmpdir):
+    d = str(tmpdir)
+    p = os.path.join(d, 'out')
+
+    class Racing(K3StatCache):
+        # a job writes & invalidates its output while the directory is
+        # being listed
+        def _list(self, dirname):
+            rv = super()._list(dirname)
+            open(p, 'w').close()
+            self.invalidate([p])
+            return rv
+
+    sc = Racing()
+    sc.prefetch([p])
+    assert sc.exists(p)
+    sc.close()
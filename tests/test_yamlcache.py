@@ -0,0 +1,73 @@
+import json
+import os
+
+from kea3 import yamlcache
+
+
+class Counter:
+    def __init__(self):
+        self.loads = 0
+        self.saves = 0
+
+    def load(self, path):
+        self.loads += 1
+        with open(path) as F:
+            return json.load(F)
+
+    def save(self, data, path):
+        self.saves += 1
+        with open(path, 'w') as F:
+            json.dump(data, F)
+
+
+def test_yamlcache_load(tmpdir):
+    path = os.path.join(str(tmpdir), 'template.k3')
+    with open(path, 'w') as F:
+        json.dump({'a': 1}, F)
+    c = Counter()
+    assert yamlcache.load(path, c.load) == {'a': 1}
+    assert yamlcache.load(path, c.load) == {'a': 1}
+    assert c.loads == 1
+
+    # same content, other mtime - still cached
+    os.utime(path, (1, 1))
+    assert yamlcache.load(path, c.load) == {'a': 1}
+    assert c.loads == 1
+
+    with open(path, 'w') as F:
+        json.dump({'a': 2}, F)
+    assert yamlcache.load(path, c.load) == {'a': 2}
+    assert c.loads == 2
+
+
+def test_yamlcache_save_if_changed(tmpdir):
+    path = os.path.join(str(tmpdir), 'template.k3')
+    c = Counter()
+    assert yamlcache.save({'a': 1}, path, c.save)
+    assert not yamlcache.save({'a': 1}, path, c.save)
+    data = yamlcache.load(path, c.load)
+    assert c.loads == 0
+    assert not yamlcache.save(data, path, c.save)
+    data['b'] = 2
+    assert yamlcache.save(data, path, c.save)
+    assert c.saves == 2
+
+    # edited by hand - save again
+    with open(path, 'w') as F:
+        json.dump({'x': 1}, F)
+    assert yamlcache.save(data, path, c.save)
+    assert c.saves == 3
+
+
+def test_yamlcache_cache_file(tmpdir):
+    source = tmpdir.mkdir('templates')
+    path = os.path.join(str(source), 'shared.k3')
+    cache = os.path.join(str(tmpdir), 'shared.pickle')
+    with open(path, 'w') as F:
+        json.dump({'a': 1}, F)
+    c = Counter()
+    assert yamlcache.load(path, c.load, cache=cache) == {'a': 1}
+    assert yamlcache.load(path, c.load, cache=cache) == {'a': 1}
+    assert c.loads == 1
+    # nothing written next to the template
+    assert os.listdir(str(source)) == ['shared.k3']